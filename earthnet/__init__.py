@@ -5,9 +5,41 @@ __version__ = "0.3.10"
 __author__ = 'Vitus Benson, Christian Requena-Mesa'
 __credits__ = 'Max-Planck-Institute for Biogeochemistry'
 
-from earthnet.parallel_score import EarthNetScore
-from earthnet.download import Downloader
-from earthnet.coords import get_coords_from_cube, get_coords_from_tile
-from earthnet.plot_cube import cube_gallery, cube_ndvi_timeseries
-from earthnet.download_v2 import download, load_minicube, load_en21x_as_npz
-from earthnet.score_v2 import normalized_NSE, score_over_dataset
+import importlib
+
+# Public names are imported lazily on first access, such that `import earthnet` stays fast in the CLI and in spawned worker processes.
+_LAZY_ATTRIBUTES = {
+    "EarthNetScore": "earthnet.parallel_score",
+    "Downloader": "earthnet.download",
+    "get_coords_from_cube": "earthnet.coords",
+    "get_coords_from_tile": "earthnet.coords",
+    "get_coords_from_cubes": "earthnet.coords",
+    "cube_gallery": "earthnet.plot_cube",
+    "cube_ndvi_timeseries": "earthnet.plot_cube",
+    "download": "earthnet.download_v2",
+    "load_minicube": "earthnet.download_v2",
+    "load_en21x_as_npz": "earthnet.download_v2",
+    "convert_en21x_to_npz": "earthnet.download_v2",
+    "normalized_NSE": "earthnet.score_v2",
+    "score_over_dataset": "earthnet.score_v2",
+    "compute_stats": "earthnet.stats",
+}
+
+_SUBMODULES = ["catalog", "coords", "download", "download_v2", "kernels", "manifest", "parallel_score", "plot_cube", "render", "score_v2", "shards", "stats", "store", "workers"]
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f"earthnet.{name}")
+    else:
+        raise AttributeError(f"module 'earthnet' has no attribute '{name}'")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__ + _SUBMODULES)
@@ -0,0 +1,215 @@
+"""Metadata catalog of a local EarthNet dataset with spatial and temporal queries.
+"""
+from typing import Optional, Sequence, Tuple
+
+import sqlite3
+import warnings
+import numpy as np
+from pathlib import Path
+
+if __name__ == "__main__":
+    from coords import parse_cubenames, get_coords_from_cubes, _coords_table
+    from store import is_cube_path
+else:
+    from earthnet.coords import parse_cubenames, get_coords_from_cubes, _coords_table
+    from earthnet.store import is_cube_path
+
+BBOX_COLUMNS = ["lon_min", "lat_min", "lon_max", "lat_max"]
+
+
+def build_catalog(data_dir: str, output_file: Optional[str] = None):
+    """Scan a local EarthNet dataset once and collect the metadata of all minicubes
+
+    Finds all `.npz` (EarthNet2021) and `.nc` (EarthNet2021x) minicubes under `data_dir`, other files like cached statistics are skipped. The cubename gives tile, dates and pixel extents. The Lon-Lat bounding boxes are computed with `get_coords_from_cubes` and are NaN for tiles without known coordinates. The split is the first directory below `data_dir`, and `kind` is "context" or "target" for test sets stored in such subdirectories.
+
+    Args:
+        data_dir (str): Root directory of the dataset, e.g. `data/earthnet2021/`
+        output_file (Optional[str], optional): If given, saves the catalog to this path, as Parquet if it ends with .parquet, else as SQLite. Defaults to None.
+
+    Returns:
+        pd.DataFrame: one row per minicube file
+    """
+    import pandas as pd
+
+    data_dir = Path(data_dir)
+    paths = sorted([path for suffix in ["npz", "nc"] for path in data_dir.glob(f"**/*.{suffix}") if is_cube_path(path)])
+    print(f"Cataloging {len(paths)} minicubes in {data_dir}...")
+
+    df = parse_cubenames([path.name for path in paths])
+
+    relpaths = [path.relative_to(data_dir) for path in paths]
+    df["split"] = [relpath.parts[0] if len(relpath.parts) > 1 else "" for relpath in relpaths]
+    df["kind"] = [next((part for part in relpath.parts[:-1] if part in ["context", "target"]), "") for relpath in relpaths]
+    df["size"] = np.array([path.stat().st_size for path in paths], dtype = np.int64)
+    df["path"] = [str(relpath) for relpath in relpaths]
+
+    for col in BBOX_COLUMNS:
+        df[col] = np.nan
+    try:
+        known = df.tile.isin(list(_coords_table().keys())).values
+    except ImportError:
+        known = np.zeros(len(df), dtype = bool)
+    if known.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            coords = get_coords_from_cubes(df.cubename[known], ignore_warning = True)
+        df.loc[known, BBOX_COLUMNS] = coords[BBOX_COLUMNS].values
+
+    if output_file is not None:
+        save_catalog(df, output_file)
+
+    print("Catalog built.")
+    return df
+
+
+def save_catalog(df, output_file: str):
+    """Save a catalog as Parquet (if `output_file` ends with .parquet) or as SQLite table `cubes`
+
+    Args:
+        df (pd.DataFrame): Catalog from `build_catalog`
+        output_file (str): Output filepath, recommended to end with .parquet or .sqlite
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents = True, exist_ok = True)
+    if output_file.suffix == ".parquet":
+        df.to_parquet(output_file, index = False)
+    else:
+        with sqlite3.connect(output_file) as con:
+            df.to_sql("cubes", con, if_exists = "replace", index = False)
+            con.execute("CREATE INDEX IF NOT EXISTS idx_tile ON cubes (tile)")
+    print(f"Saved catalog to {output_file}.")
+
+
+def load_catalog(catalog_file: str):
+    """Load a catalog saved by `save_catalog`
+
+    Args:
+        catalog_file (str): Path to .parquet or SQLite catalog
+
+    Returns:
+        pd.DataFrame: Catalog
+    """
+    import pandas as pd
+
+    catalog_file = Path(catalog_file)
+    if catalog_file.suffix == ".parquet":
+        return pd.read_parquet(catalog_file)
+    with sqlite3.connect(catalog_file) as con:
+        return pd.read_sql("SELECT * FROM cubes", con, parse_dates = ["start_date", "end_date"])
+
+
+class Catalog:
+    """Queryable catalog of minicubes with an in-memory grid index over the Lon-Lat bounding boxes
+
+    Example:
+
+        >>> catalog = Catalog.build("data/earthnet2021/", output_file = "data/earthnet2021/catalog.sqlite")
+        >>> catalog = Catalog("data/earthnet2021/catalog.sqlite", data_dir = "data/earthnet2021/")
+        >>> df = catalog.query(tile = "32UNC", start = "2018-05-01", end = "2018-08-31")
+        >>> paths = catalog.paths(bbox = (8.0, 47.5, 9.0, 48.5), split = "train")
+    """
+    def __init__(self, catalog, data_dir: Optional[str] = None, cell_size: float = 0.5):
+        """Initialize Catalog
+
+        Args:
+            catalog (Union[str, pd.DataFrame]): Catalog from `build_catalog` or path to a saved catalog
+            data_dir (Optional[str], optional): Root directory of the dataset, used to turn relative paths into full paths. Defaults to the directory of the saved catalog.
+            cell_size (float, optional): Size of the grid cells of the spatial index in degrees. Defaults to 0.5.
+        """
+        if isinstance(catalog, (str, Path)):
+            if data_dir is None:
+                data_dir = Path(catalog).parent
+            catalog = load_catalog(catalog)
+        self.df = catalog.reset_index(drop = True)
+        self.data_dir = Path(data_dir) if data_dir is not None else None
+        self.cell_size = cell_size
+        self._build_index()
+
+    @classmethod
+    def build(cls, data_dir: str, output_file: Optional[str] = None, cell_size: float = 0.5) -> "Catalog":
+        """Build the catalog of a dataset and optionally save it, see `build_catalog`
+
+        Args:
+            data_dir (str): Root directory of the dataset
+            output_file (Optional[str], optional): If given, saves the catalog to this path. Defaults to None.
+            cell_size (float, optional): Size of the grid cells of the spatial index in degrees. Defaults to 0.5.
+
+        Returns:
+            Catalog: Catalog
+        """
+        return cls(build_catalog(data_dir, output_file = output_file), data_dir = data_dir, cell_size = cell_size)
+
+    def _cells(self, lon_min: np.ndarray, lat_min: np.ndarray, lon_max: np.ndarray, lat_max: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        return tuple(np.floor(np.asarray(v, dtype = np.float64) / self.cell_size).astype(np.int64) for v in (lon_min, lat_min, lon_max, lat_max))
+
+    def _build_index(self):
+        """Grid index: maps each grid cell to the rows whose bounding box overlaps it
+        """
+        self.index = {}
+        valid = np.nonzero(self.df[BBOX_COLUMNS].notna().all(axis = 1).values)[0]
+        x0, y0, x1, y1 = self._cells(*(self.df[col].values[valid] for col in BBOX_COLUMNS))
+        for row, cx0, cy0, cx1, cy1 in zip(valid, x0, y0, x1, y1):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.index.setdefault((cx, cy), []).append(row)
+
+    def query(self, tile: Optional[str] = None, split: Optional[str] = None, kind: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None, bbox: Optional[Sequence[float]] = None):
+        """Select minicubes
+
+        Args:
+            tile (Optional[str], optional): MGRS tile or list of tiles. Defaults to None.
+            split (Optional[str], optional): Split or list of splits. Defaults to None.
+            kind (Optional[str], optional): One of "context", "target", "". Defaults to None.
+            start (Optional[str], optional): Keep cubes ending on or after this date. Defaults to None.
+            end (Optional[str], optional): Keep cubes starting on or before this date. Defaults to None.
+            bbox (Optional[Sequence[float]], optional): Keep cubes intersecting this box (Min-Lon, Min-Lat, Max-Lon, Max-Lat). Defaults to None.
+
+        Returns:
+            pd.DataFrame: selected rows of the catalog
+        """
+        import pandas as pd
+
+        df = self.df
+        if bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            x0, y0, x1, y1 = (int(v) for v in self._cells(lon_min, lat_min, lon_max, lat_max))
+            rows = sorted({row for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1) for row in self.index.get((cx, cy), [])})
+            df = df.iloc[rows]
+            df = df[(df.lon_min <= lon_max) & (df.lon_max >= lon_min) & (df.lat_min <= lat_max) & (df.lat_max >= lat_min)]
+
+        mask = np.ones(len(df), dtype = bool)
+        if tile is not None:
+            mask &= df.tile.isin([tile] if isinstance(tile, str) else tile).values
+        if split is not None:
+            mask &= df.split.isin([split] if isinstance(split, str) else split).values
+        if kind is not None:
+            mask &= (df.kind == kind).values
+        if start is not None:
+            mask &= (df.end_date >= pd.Timestamp(start)).values
+        if end is not None:
+            mask &= (df.start_date <= pd.Timestamp(end)).values
+        return df[mask]
+
+    def paths(self, **kwargs) -> Sequence[Path]:
+        """Paths of the minicubes selected by `Catalog.query`
+
+        Returns:
+            Sequence[Path]: full paths if the dataset directory is known, else relative paths
+        """
+        return [self.data_dir/path if self.data_dir is not None else Path(path) for path in self.query(**kwargs).path]
+
+    def cubenames(self, **kwargs) -> Sequence[str]:
+        """Cubenames of the minicubes selected by `Catalog.query`
+
+        Returns:
+            Sequence[str]: cubenames
+        """
+        return self.query(**kwargs).cubename.unique().tolist()
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(build_catalog)
@@ -1,17 +1,120 @@
 
+from typing import Sequence
+
 import warnings
 
 import os
 import json
-from pyproj import Transformer
-
-if __name__ == "__main__":
-    from coords_dict import COORDS
-else:
-    from earthnet.coords_dict import COORDS
+import functools
+import numpy as np
 
 EXTREME_TILES = ["32UMC", "32UNC", "32UPC", "32UQC"]
 
+COORDS_WARNING = 'Getting coordinates to a cube is experimental. The resulting coordinates on Lon-Lat-Grid will never be pixel perfect. Under certain circumstances, the whole bounding box might shifted by up to 0.02° in either direction. Use with caution. EarthNet2021 does not provide geo-referenced data.'
+
+def _coords_table() -> dict:
+    """Import the large table of tile coordinates on first use
+
+    Returns:
+        dict: {tilename: {"EPSG", "MinLon", "MinLat", "MaxLon", "MaxLat"}}
+    """    
+    if __name__ == "__main__":
+        from coords_dict import COORDS
+    else:
+        from earthnet.coords_dict import COORDS
+    return COORDS
+
+@functools.lru_cache(maxsize = None)
+def _get_transformer(epsg: int):
+    """Cached Transformer from the given CRS to Lon-Lat (EPSG:4326)
+
+    Args:
+        epsg (int): EPSG code of the source CRS
+
+    Returns:
+        pyproj.Transformer: Transformer with always_xy = True
+    """    
+    from pyproj import Transformer
+
+    return Transformer.from_crs(epsg, 4326, always_xy = True)
+
+def parse_cubenames(cubenames: Sequence[str]):
+    """
+
+    Parse many cubenames at once.
+
+    Accepts cubenames or paths, with or without file extension and with or without a prefix like `target_` or `experiment_`.
+
+    Args:
+        cubenames (Sequence[str]): cubenames (have format tile_startyear_startmonth_startday_endyear_endmonth_endday_hrxmin_hrxmax_hrymin_hrymax_mesoxmin_mesoxmax_mesoymin_mesoymax.npz)
+
+    Returns:
+        pd.DataFrame: columns cubename, tile, start_date, end_date, hr_x_min, hr_x_max, hr_y_min, hr_y_max, meso_x_min, meso_x_max, meso_y_min, meso_y_max
+    """    
+    import pandas as pd
+
+    pattern = r"(?P<cubename>(?P<tile>\d{2}[A-Z]{3})_(?P<start_date>[\d-]+)_(?P<end_date>[\d-]+)_(?P<hr_x_min>\d+)_(?P<hr_x_max>\d+)_(?P<hr_y_min>\d+)_(?P<hr_y_max>\d+)_(?P<meso_x_min>\d+)_(?P<meso_x_max>\d+)_(?P<meso_y_min>\d+)_(?P<meso_y_max>\d+))(?:\.npz|\.nc)?$"
+    df = pd.Series(list(map(str, cubenames)), dtype = object).str.extract(pattern)
+    assert(not df.cubename.isna().any()),"Cubenames do not have the format tile_startdate_enddate_hrxmin_hrxmax_hrymin_hrymax_mesoxmin_mesoxmax_mesoymin_mesoymax."
+
+    df["start_date"] = pd.to_datetime(df.start_date, format = "%Y-%m-%d")
+    df["end_date"] = pd.to_datetime(df.end_date, format = "%Y-%m-%d")
+    for col in ["hr_x_min", "hr_x_max", "hr_y_min", "hr_y_max", "meso_x_min", "meso_x_max", "meso_y_min", "meso_y_max"]:
+        df[col] = df[col].astype(np.int64)
+    return df
+
+def get_coords_from_cubes(cubenames: Sequence[str], return_meso: bool = False, ignore_warning = False):
+    """
+
+    Get the coordinates for many Cubes in Lon-Lat-Grid.
+
+    Vectorized version of `get_coords_from_cube`: cubes are grouped by the CRS of their tile and all corners of a group are transformed in a single call.
+
+    Args:
+        cubenames (Sequence[str]): cubenames (have format tile_startyear_startmonth_startday_endyear_endmonth_endday_hrxmin_hrxmax_hrymin_hrymax_mesoxmin_mesoxmax_mesoymin_mesoymax.npz)
+        return_meso (bool, optional): If True returns also the coordinates for the Meso-scale variables in the cubes. Defaults to False.
+
+    Returns:
+        pd.DataFrame: columns cubename, tile, lon_min, lat_min, lon_max, lat_max and if return_meso also meso_lon_min, meso_lat_min, meso_lon_max, meso_lat_max
+    """    
+    import pandas as pd
+
+    if not ignore_warning:
+        warnings.warn(COORDS_WARNING)
+
+    df = parse_cubenames(cubenames)
+    table = _coords_table()
+
+    tiles = pd.DataFrame.from_dict({tile: table[tile] for tile in df.tile.unique()}, orient = "index")
+    tile_x_min = np.empty(len(tiles))
+    tile_y_max = np.empty(len(tiles))
+    for epsg, idxs in tiles.groupby("EPSG").indices.items():
+        tile_x_min[idxs], tile_y_max[idxs] = _get_transformer(epsg).transform(tiles.MinLon.values[idxs], tiles.MaxLat.values[idxs], direction = "INVERSE")
+    tiles["x_min"], tiles["y_max"] = tile_x_min, tile_y_max
+
+    x_min = tiles.x_min.reindex(df.tile).values
+    y_max = tiles.y_max.reindex(df.tile).values
+    epsgs = tiles.EPSG.reindex(df.tile).values
+
+    hr_shift = np.where(df.tile.isin(EXTREME_TILES), 57, 0)
+    corners = {
+        "": (x_min + 20. * df.hr_y_min.values, x_min + 20. * df.hr_y_max.values, y_max - 20. * (df.hr_x_min.values + hr_shift), y_max - 20. * (df.hr_x_max.values + hr_shift))
+    }
+    if return_meso:
+        corners["meso_"] = (x_min + 20. * df.meso_x_min.values, x_min + 20. * df.meso_x_max.values, y_max - 20. * df.meso_y_min.values, y_max - 20. * df.meso_y_max.values)
+
+    out = df[["cubename", "tile"]].copy()
+    for prefix, (cube_x_min, cube_x_max, cube_y_min, cube_y_max) in corners.items():
+        lon_min, lat_min, lon_max, lat_max = (np.empty(len(df)) for _ in range(4))
+        for epsg in np.unique(epsgs):
+            idxs = np.nonzero(epsgs == epsg)[0]
+            lons, lats = _get_transformer(epsg).transform(np.concatenate([cube_x_min[idxs], cube_x_max[idxs]]), np.concatenate([cube_y_max[idxs], cube_y_min[idxs]]))
+            lon_min[idxs], lon_max[idxs] = lons[:len(idxs)], lons[len(idxs):]
+            lat_min[idxs], lat_max[idxs] = lats[:len(idxs)], lats[len(idxs):]
+        out[f"{prefix}lon_min"], out[f"{prefix}lat_min"], out[f"{prefix}lon_max"], out[f"{prefix}lat_max"] = lon_min, lat_min, lon_max, lat_max
+
+    return out
+
 def get_coords_from_cube(cubename: str, return_meso: bool = False, ignore_warning = False):
     """
 
@@ -26,13 +129,13 @@ def get_coords_from_cube(cubename: str, return_meso: bool = False, ignore_warnin
     """    
     
     if not ignore_warning:
-        warnings.warn('Getting coordinates to a cube is experimental. The resulting coordinates on Lon-Lat-Grid will never be pixel perfect. Under certain circumstances, the whole bounding box might shifted by up to 0.02° in either direction. Use with caution. EarthNet2021 does not provide geo-referenced data.')
-    
+        warnings.warn(COORDS_WARNING)
+
     cubetile,_, _,hr_x_min, hr_x_max, hr_y_min, hr_y_max, meso_x_min, meso_x_max, meso_y_min, meso_y_max = os.path.splitext(cubename)[0].split("_")
 
-    tile = COORDS[cubetile]
+    tile = _coords_table()[cubetile]
 
-    transformer = Transformer.from_crs(tile["EPSG"], 4326, always_xy = True)
+    transformer = _get_transformer(tile["EPSG"])
 
     tile_x_min, tile_y_max = transformer.transform(tile["MinLon"],tile["MaxLat"], direction = "INVERSE")
 
@@ -72,7 +175,7 @@ def get_coords_from_tile(tilename: str):
     Returns:
         tuple: Min-Lon, Min-Lat, Max-Lon, Max-Lat
     """    
-    tile = COORDS[tilename]
+    tile = _coords_table()[tilename]
     
     return tile["MinLon"], tile["MinLat"], tile["MaxLon"], tile["MaxLat"]
 
@@ -1,5 +1,5 @@
 
-from typing import Sequence, Union
+from typing import Optional, Sequence, Union
 import hashlib
 import pickle
 import os
@@ -9,8 +9,12 @@ import tarfile
 
 if __name__ == "__main__":
     from download_links import DOWNLOAD_LINKS
+    from shards import repack_tarball
+    from manifest import load_manifest, update_manifest, verify_dataset
 else:
     from earthnet.download_links import DOWNLOAD_LINKS
+    from earthnet.shards import repack_tarball
+    from earthnet.manifest import load_manifest, update_manifest, verify_dataset
 
 class DownloadProgressBar(tqdm):
     def update_to(self, b=1, bsize=1, tsize=None):
@@ -44,7 +48,7 @@ class Downloader():
         os.makedirs(data_dir, exist_ok = True)
 
     @classmethod
-    def get(cls, data_dir: str, splits: Union[str,Sequence[str]], overwrite: bool = False, delete: bool = True):
+    def get(cls, data_dir: str, splits: Union[str,Sequence[str]], overwrite: bool = False, delete: bool = True, keep_shards: bool = False, num_workers: Optional[int] = None):
         """Download the EarthNet2021 Dataset
         
         Before downloading, ensure that you have enough free disk space. We recommend 1 TB.
@@ -58,6 +62,8 @@ class Downloader():
             splits (Sequence[str]): Either "all" or a subset of ["train","iid","ood","extreme","seasonal"]. This determines the splits that are downloaded.
             overwrite (bool, optional): If True, overwrites an existing gzipped tarball by downloading it again. Defaults to False.
             delete (bool, optional): If True, deletes the downloaded tarball after unpacking it. Defaults to True.
+            keep_shards (bool, optional): If True, does not extract the tarballs, but repacks each into an uncompressed shard `data_dir/shards/split/name.tar` with a member offset index, to be read with `earthnet.shards.ShardDataset`. Defaults to False.
+            num_workers (Optional[int], optional): Number of processes for hashing the extracted files, defaults to the number of CPUs. Defaults to None.
         """        
         self = cls(data_dir)
         print(splits)
@@ -89,28 +95,83 @@ class Downloader():
                 if filename in progress_list and not overwrite:
                     print(f"{filename} allready downloaded")
                     continue
-                tmp_path = os.path.join(self.data_dir, filename)
-                print("Downloading...")
-                with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=filename) as t:
-                    urllib.request.urlretrieve(dl_url, filename = tmp_path, reporthook=t.update_to)
-                print("Downloaded!")
-                print("Asserting SHA256 Hash.")
-                assert(sha == get_sha_of_file(tmp_path))
-                print("SHA256 Hash is correct!")
-                print("Extracting tarball...")
-                with tarfile.open(tmp_path, 'r:gz') as tar:
-                    members = tar.getmembers()
-                    for member in tqdm(iterable=members, total=len(members)):
-                        tar.extract(member=member,path=self.data_dir)
-                print("Extracted!")
-                if delete:
-                    print("Deleting tarball...")
-                    os.remove(tmp_path)
-                
+                self.fetch(split, filename, dl_url, sha, delete = delete, keep_shards = keep_shards, num_workers = num_workers)
+
                 progress_list.append(filename)
                 with open(progress_file, "wb") as fp:
                     pickle.dump(progress_list, fp)
 
+    def fetch(self, split: str, filename: str, dl_url: str, sha: str, delete: bool = True, keep_shards: bool = False, num_workers: Optional[int] = None):
+        """Download, check and extract a single tarball
+
+        The extracted files are hashed in parallel and added to the manifest `data_dir/MANIFEST.json`, which is used by `Downloader.verify`.
+
+        Args:
+            split (str): Split of the tarball
+            filename (str): Filename of the tarball
+            dl_url (str): Download link
+            sha (str): SHA256 of the tarball
+            delete (bool, optional): If True, deletes the downloaded tarball after unpacking it. Defaults to True.
+            keep_shards (bool, optional): If True, repacks the tarball into a shard instead of extracting it. Defaults to False.
+            num_workers (Optional[int], optional): Number of processes for hashing, defaults to the number of CPUs. Defaults to None.
+        """        
+        tmp_path = os.path.join(self.data_dir, filename)
+        print("Downloading...")
+        with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=filename) as t:
+            urllib.request.urlretrieve(dl_url, filename = tmp_path, reporthook=t.update_to)
+        print("Downloaded!")
+        print("Asserting SHA256 Hash.")
+        assert(sha == get_sha_of_file(tmp_path))
+        print("SHA256 Hash is correct!")
+        if keep_shards:
+            print("Repacking tarball into shard...")
+            repack_tarball(tmp_path, os.path.join(self.data_dir, "shards", split, filename.replace(".tar.gz", ".tar")))
+            print("Repacked!")
+        else:
+            print("Extracting tarball...")
+            with tarfile.open(tmp_path, 'r:gz') as tar:
+                members = tar.getmembers()
+                for member in tqdm(iterable=members, total=len(members)):
+                    tar.extract(member=member,path=self.data_dir)
+            print("Extracted!")
+            update_manifest(self.data_dir, {member.name: filename for member in members if member.isfile()}, num_workers = num_workers)
+        if delete:
+            print("Deleting tarball...")
+            os.remove(tmp_path)
+
+    @classmethod
+    def verify(cls, data_dir: str, repair: bool = False, num_workers: Optional[int] = None, delete: bool = True) -> dict:
+        """Verify an extracted EarthNet2021 Dataset and optionally repair it
+
+        Every file in the manifest `data_dir/MANIFEST.json` is checked by size and SHA256, hashing in parallel. Datasets extracted without a manifest are checked by the zip checksums of the `.npz` cubes, and a manifest is built for later runs. With `repair`, only the tarballs containing missing or corrupt cubes are downloaded and extracted again.
+
+        Args:
+            data_dir (str): The directory where the data is saved in
+            repair (bool, optional): If True, downloads the tarballs of missing or corrupt cubes again. Defaults to False.
+            num_workers (Optional[int], optional): Number of processes for hashing, defaults to the number of CPUs. Defaults to None.
+            delete (bool, optional): If True, deletes the downloaded tarballs after unpacking them. Defaults to True.
+
+        Returns:
+            dict: relative paths of "missing" and "corrupt" files and their "sources"
+        """        
+        self = cls(data_dir)
+        report = verify_dataset(self.data_dir, num_workers = num_workers)
+
+        for relpath in report["missing"] + report["corrupt"]:
+            print(f"{'Missing' if relpath in report['missing'] else 'Corrupt'}: {relpath}")
+
+        if repair and (report["missing"] or report["corrupt"]):
+            manifest = load_manifest(self.data_dir)
+            unknown = [relpath for relpath in report["missing"] + report["corrupt"] if not manifest.get(relpath, {}).get("source")]
+            if unknown:
+                print(f"The tarballs of {len(unknown)} files are unknown, these cannot be repaired.")
+            for split, links in self.__URL__.items():
+                for filename, dl_url, sha in links:
+                    if filename in report["sources"]:
+                        print(f"Repairing {filename}")
+                        self.fetch(split, filename, dl_url, sha, delete = delete, num_workers = num_workers)
+
+        return report
 
 
 if __name__ == "__main__":
@@ -1,16 +1,32 @@
 
 
 import numpy as np
-import s3fs
-import xarray as xr
 from pathlib import Path
 from tqdm import tqdm
 
+if __name__ == "__main__":
+    from manifest import check_files, load_manifest, update_manifest
+else:
+    from earthnet.manifest import check_files, load_manifest, update_manifest
+
 SPLITS = {
     "earthnet2021x": ["train","iid","ood","extreme","seasonal"]
 }
 
-def download(dataset = "earthnet2021x", split = "train", save_directory = "data/", proxy = None, limit = None):
+def _s3_filesystem(proxy = None):
+    import s3fs
+
+    return s3fs.S3FileSystem(anon=True,
+            client_kwargs={
+            'endpoint_url': 'https://s3.bgc-jena.mpg.de:9000',
+            'region_name': 'thuringia',
+            },
+            config_kwargs = {
+            "proxies": {'http': proxy}
+            } if proxy else {}
+        )
+
+def download(dataset = "earthnet2021x", split = "train", save_directory = "data/", proxy = None, limit = None, num_workers = None):
     """Download the recent EarthNet datasets
         
         Before downloading, ensure that you have enough free disk space. We recommend 1 TB.
@@ -27,31 +43,73 @@ def download(dataset = "earthnet2021x", split = "train", save_directory = "data/
             save_directory (str): The directory where the data shall be saved in, we recommend data/
             proxy (str, optional): If you need to use a http-proxy to access the internet, you may specify it here.
             limit (int, optional): If you only want to download a certain number of samples, you can set a limit here.
+            num_workers (int, optional): Number of processes for hashing the downloaded files into the manifest `save_directory/MANIFEST.json`, defaults to the number of CPUs.
     """  
     if split == "all":
         for split in SPLITS[dataset]:
-            download(dataset = dataset, split = split, save_directory=save_directory, proxy = proxy, limit = limit)
+            download(dataset = dataset, split = split, save_directory=save_directory, proxy = proxy, limit = limit, num_workers = num_workers)
     else:
-        s3 = s3fs.S3FileSystem(anon=True,
-                client_kwargs={
-                'endpoint_url': 'https://s3.bgc-jena.mpg.de:9000',
-                'region_name': 'thuringia',
-                },
-                config_kwargs = {
-                "proxies": {'http': proxy}
-                } if proxy else {}
-            )
+        s3 = _s3_filesystem(proxy)
 
         print(f"Finding files of {dataset}, split {split} to download.")
         files = s3.find(f"earthnet/{dataset}/{split}")
         print(f"Downloading files of {dataset}, split {split}")
-        for file in tqdm(files[:limit] if limit else files):
+        files = files[:limit] if limit else files
+        for file in tqdm(files):
             savepath = Path(save_directory)/file[9:]
             savepath.parent.mkdir(parents = True, exist_ok = True)
             s3.download(file, str(savepath))
+        update_manifest(save_directory, {file[9:]: file for file in files}, num_workers = num_workers)
         print(f"Downloaded {dataset}, split {split}.")
 
 
+def verify(dataset = "earthnet2021x", split = "train", save_directory = "data/", repair = False, proxy = None, num_workers = None):
+    """Verify a downloaded split of the recent EarthNet datasets and optionally repair it
+
+        Every object of the split on S3 has to exist locally with the same size. Files in the manifest `save_directory/MANIFEST.json` are also checked by SHA256, hashing in parallel. With `repair`, only the missing or corrupt objects are downloaded again.
+
+        Args:
+            dataset (str): The dataset
+            split (str): A split of the given dataset, can also be `"all"`
+            save_directory (str): The directory where the data is saved in
+            repair (bool, optional): If True, downloads missing or corrupt files again.
+            proxy (str, optional): If you need to use a http-proxy to access the internet, you may specify it here.
+            num_workers (int, optional): Number of processes for hashing, defaults to the number of CPUs.
+
+        Returns:
+            dict: relative paths of "missing" and "corrupt" files and their "sources" on S3
+    """
+    if split == "all":
+        reports = [verify(dataset = dataset, split = split, save_directory = save_directory, repair = repair, proxy = proxy, num_workers = num_workers) for split in SPLITS[dataset]]
+        return {k: sum([report[k] for report in reports], []) for k in ["missing", "corrupt", "sources"]}
+
+    s3 = _s3_filesystem(proxy)
+
+    print(f"Finding files of {dataset}, split {split} to verify.")
+    objects = s3.find(f"earthnet/{dataset}/{split}", detail = True)
+
+    manifest = load_manifest(save_directory)
+    entries = {}
+    for file, info in objects.items():
+        entry = manifest.get(file[9:])
+        if entry is None or entry["size"] != info["size"]:
+            entry = {"size": info["size"], "sha256": None}
+        entries[file[9:]] = {**entry, "source": file}
+
+    report = check_files(save_directory, entries, num_workers = num_workers)
+    print(f"Verified {dataset}, split {split}: {len(report['missing'])} missing, {len(report['corrupt'])} corrupt.")
+
+    if repair and report["sources"]:
+        print(f"Repairing {len(report['sources'])} files of {dataset}, split {split}")
+        for file in tqdm(report["sources"]):
+            savepath = Path(save_directory)/file[9:]
+            savepath.parent.mkdir(parents = True, exist_ok = True)
+            s3.download(file, str(savepath))
+        update_manifest(save_directory, {file[9:]: file for file in report["sources"]}, num_workers = num_workers)
+
+    return report
+
+
 def load_minicube(dataset = "earthnet2021x", split = "train", id = "29SND_2018-09-03_2019-01-30_441_569_2745_2873_6_86_42_122", region = None, proxy = None):
     """Load a minicube from a recent EarthNet dataset
 
@@ -68,15 +126,9 @@ def load_minicube(dataset = "earthnet2021x", split = "train", id = "29SND_2018-0
             proxy (str, optional): If you need to use a http-proxy to access the internet, you may specify it here.
     
     """
-    s3 = s3fs.S3FileSystem(anon=True,
-            client_kwargs={
-            'endpoint_url': 'https://s3.bgc-jena.mpg.de:9000',
-            'region_name': 'thuringia',
-            },
-            config_kwargs = {
-            "proxies": {'http': proxy}
-            } if proxy else {}
-        )
+    import xarray as xr
+
+    s3 = _s3_filesystem(proxy)
     if region:
         file = f"earthnet/{dataset}/{split}/{region}/{id}.nc"
     else:
@@ -88,6 +140,62 @@ def load_minicube(dataset = "earthnet2021x", split = "train", id = "29SND_2018-0
 
     return mc
 
+# E-OBS variables of EarthNet2021x are normalized as (x + shift)/scale, see also `earthnet.stats.SplitStats.eobs_normalization`
+EOBS_VARIABLES = ["eobs_rr", "eobs_pp", "eobs_tg", "eobs_tn", "eobs_tx"]
+EOBS_SHIFT = [0.0, -900., 50., 50., 50.]
+EOBS_SCALE = [50., 200., 100., 100., 100.]
+
+def _en21x_arrays(minicube_path):
+    """Read a minicube from the EarthNet2021x dataset into compact EarthNet2021-like arrays
+
+        Mesoscale data is returned with singleton spatial axes: `mesodynamic` of shape 1 x 1 x 5 x time and `mesostatic` of shape 1 x 1 x 1.
+
+        Args:
+            minicube_path (str): Path to the minicube from EarthNet2021x.
+
+        Returns:
+            dict: arrays with keys `['highresdynamic', 'highresstatic', 'mesodynamic', 'mesostatic']`
+    """
+    import xarray as xr
+
+    with xr.open_dataset(minicube_path) as minicube:
+
+        minicube["s2_mask"] = minicube.s2_mask.where(minicube.s2_mask == 0.0, 1.0)
+
+        hrd_fake = minicube[["s2_B02", "s2_B03", "s2_B04", "s2_B8A", "s2_mask"]].to_array("band").isel(time = slice(4, None, 5)).transpose("lat", "lon", "band", "time").values
+
+        eobs_shift = xr.DataArray(data = EOBS_SHIFT, coords = {"var": EOBS_VARIABLES})
+        eobs_scale = xr.DataArray(data = EOBS_SCALE, coords = {"var": EOBS_VARIABLES})
+
+        md_fake = ((minicube[EOBS_VARIABLES].to_array("var") + eobs_shift)/eobs_scale).transpose("var", "time").values[None, None, :, :]
+
+        hrs_fake = (minicube.cop_dem.values[:, :, None] + 2000)/4000
+
+    ms_fake = np.full((1, 1, 1), np.nanmean(hrs_fake))
+
+    return {
+        'highresdynamic': hrd_fake,
+        'highresstatic': hrs_fake,
+        'mesodynamic': md_fake,
+        'mesostatic': ms_fake
+    }
+
+def expand_meso(npz):
+    """Broadcast compact mesoscale arrays to the 80x80 mesoscale grid of EarthNet2021
+
+        Returns read-only views, no data is copied. Arrays that already have the full grid are returned as is.
+
+        Args:
+            npz (dict): Dictionary or `numpy.lib.npyio.NpzFile` with keys `['highresdynamic', 'highresstatic', 'mesodynamic', 'mesostatic']`
+
+        Returns:
+            dict: arrays with keys `['highresdynamic', 'highresstatic', 'mesodynamic', 'mesostatic']`
+    """
+    npz = {k: npz[k] for k in ['highresdynamic', 'highresstatic', 'mesodynamic', 'mesostatic']}
+    for k in ['mesodynamic', 'mesostatic']:
+        npz[k] = np.broadcast_to(npz[k], (80, 80) + npz[k].shape[2:])
+    return npz
+
 def load_en21x_as_npz(minicube_path):
     """Load a minicube from the EarthNet2021x dataset as an EarthNet2021-like fake NPZ
 
@@ -95,7 +203,7 @@ def load_en21x_as_npz(minicube_path):
         
         Attention!
             - `highresdynamic` has just 5 channels (like in the EarthNet2021 test sets)
-            - mesoscale data is just a single value repeated over the 80x80 mesoscale grid
+            - mesoscale data is just a single value repeated over the 80x80 mesoscale grid, given as read-only `np.broadcast_to` views. Use `np.array(npz['mesodynamic'])` to get a writeable copy.
             - the COPDEM in EarthNet2021x has slightly higher resolution than the EU-DEM from EarthNet2021.
             - This function returns a dictionary and not a `numpy.lib.npyio.NpzFile`
 
@@ -103,27 +211,74 @@ def load_en21x_as_npz(minicube_path):
             minicube_path (str): Path to the minicube from EarthNet2021x to be loaded as a fake NPZ.
     
     """
+    return expand_meso(_en21x_arrays(minicube_path))
 
-    minicube = xr.open_dataset(minicube_path)
+def _convert_minicube(task):
+    """Convert a single EarthNet2021x minicube and write it to disk, runs inside a worker
 
-    minicube["s2_mask"] = minicube.s2_mask.where(minicube.s2_mask == 0.0, 1.0)
+        Args:
+            task (tuple): input path, output path, compact
 
-    hrd_fake = minicube[["s2_B02", "s2_B03", "s2_B04", "s2_B8A", "s2_mask"]].to_array("band").isel(time = slice(4, None, 5)).transpose("lat", "lon", "band", "time").values
+        Returns:
+            tuple: input path, error message or None
+    """
+    minicube_path, output_path, compact = task
+    try:
+        npz = _en21x_arrays(minicube_path)
+        if not compact:
+            npz = expand_meso(npz)
+        output_path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = output_path.with_name(output_path.stem + ".tmp.npz")
+        np.savez_compressed(tmp_path, **npz)
+        tmp_path.replace(output_path)
+    except Exception as e:
+        return minicube_path, f"{type(e).__name__}: {e}"
+    return minicube_path, None
 
-    eobs_shift = xr.DataArray(data = [0.0, -900., 50., 50., 50.], coords = {"var": ["eobs_rr", "eobs_pp", "eobs_tg", "eobs_tn", "eobs_tx"]})
-    eobs_scale = xr.DataArray(data = [50., 200., 100., 100., 100.], coords = {"var": ["eobs_rr", "eobs_pp", "eobs_tg", "eobs_tn", "eobs_tx"]})
+def convert_en21x_to_npz(input_dir, output_dir, num_workers = 1, compact = True, overwrite = False, chunksize = 4):
+    """Convert a split of EarthNet2021x to EarthNet2021-like `.npz` minicubes
 
-    md_fake = ((minicube[["eobs_rr", "eobs_pp", "eobs_tg", "eobs_tn", "eobs_tx"]].to_array("var") + eobs_shift)/eobs_scale).transpose("var", "time").values[None, None, :, :].repeat(80, 0).repeat(80, 1)
+        Minicubes are streamed through a process pool, each worker converts one minicube at a time and writes it directly to `output_dir`, keeping the directory structure of `input_dir`. Already converted minicubes are skipped unless `overwrite` is set, so an interrupted conversion can be resumed.
 
-    hrs_fake = (minicube.cop_dem.values[:, :, None] + 2000)/4000
+        Minicubes are saved as compressed `.npz`. By default (`compact = True`), `mesodynamic` is saved with shape 1 x 1 x 5 x time and `mesostatic` with shape 1 x 1 x 1 instead of repeating every value over the 80x80 mesoscale grid. Use `expand_meso` to get read-only views of the full grid after loading, `earthnet.plot_cube` does this itself. With `compact = False`, the full grid is saved as in EarthNet2021.
 
-    ms_fake = np.nanmean(hrs_fake) * np.ones((80, 80, 1))
+        Args:
+            input_dir (str): Directory with EarthNet2021x minicubes, e.g. `data/earthnet2021x/train/`
+            output_dir (str): Directory to save the `.npz` minicubes in
+            num_workers (int, optional): Number of worker processes. Defaults to 1.
+            compact (bool, optional): If True, saves mesoscale data without the 80x80 grid. Defaults to True.
+            overwrite (bool, optional): If True, converts minicubes that already exist in `output_dir`. Defaults to False.
+            chunksize (int, optional): Number of minicubes sent to a worker at once. Defaults to 4.
+
+        Returns:
+            list: input paths and error messages of minicubes that failed to convert
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+
+    minicube_paths = sorted(list(input_dir.glob("**/*.nc")))
+    tasks = [(path, (output_dir/path.relative_to(input_dir)).with_suffix(".npz"), compact) for path in minicube_paths]
+    if not overwrite:
+        tasks = [task for task in tasks if not task[1].exists()]
+
+    print(f"Converting {len(tasks)} of {len(minicube_paths)} minicubes from {input_dir} to {output_dir}...")
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            results = list(tqdm(pool.map(_convert_minicube, tasks, chunksize = chunksize), total = len(tasks)))
+    else:
+        results = [_convert_minicube(task) for task in tqdm(tasks)]
+
+    failed = [(str(path), error) for path, error in results if error is not None]
+    for path, error in failed:
+        print(f"Failed to convert {path}: {error}")
+
+    print(f"Converted {len(tasks) - len(failed)} minicubes.")
+    return failed
 
-    npz_fake = {
-        'highresdynamic': hrd_fake,
-        'highresstatic': hrs_fake,
-        'mesodynamic': md_fake,
-        'mesostatic': ms_fake
-    }
 
-    return npz_fake
\ No newline at end of file
+if __name__ == "__main__":
+    import fire
+    fire.Fire(convert_en21x_to_npz)
@@ -0,0 +1,150 @@
+"""Compiled per-pixel kernels for the EarthNetScore, used if Numba is installed.
+"""
+from typing import Callable, Tuple
+
+import types
+import importlib.util
+import numpy as np
+
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+# Kernels use `prange` for their parallel loops. It is a plain `range` when they run uncompiled, the compiled kernels get `numba.prange`.
+prange = range
+
+_COMPILED = {}
+
+
+def _compiled(func: Callable) -> Callable:
+    """Compile a kernel with Numba on first use, such that importing this module does not import Numba
+
+    The kernel is compiled from a copy of the function that sees `numba.prange` as `prange`, the module itself is not changed.
+
+    Args:
+        func (Callable): Kernel written in the Numba subset of Python
+
+    Returns:
+        Callable: compiled kernel, or `func` itself if Numba is not installed
+    """
+    if not HAS_NUMBA:
+        return func
+    if func not in _COMPILED:
+        import numba
+        from numba import prange
+
+        kernel = types.FunctionType(func.__code__, dict(func.__globals__, prange = prange), func.__name__, func.__defaults__, func.__closure__)
+        kernel.__module__, kernel.__qualname__ = func.__module__, func.__qualname__
+        _COMPILED[func] = numba.njit(parallel = True, cache = True)(kernel)
+    return _COMPILED[func]
+
+
+def _w1_loop(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    n, t = preds.shape
+    dists = np.empty(n)
+    for i in prange(n):
+        v = targs[i][masks[i]]
+        nv = len(v)
+        if nv < 2:
+            dists[i] = np.nan
+            continue
+        u = np.sort(preds[i])
+        v = np.sort(v)
+        nu = t
+        j = 0
+        k = 0
+        prev = min(u[0], v[0])
+        dist = 0.0
+        while j < nu or k < nv:
+            if k >= nv or (j < nu and u[j] <= v[k]):
+                x = u[j]
+            else:
+                x = v[k]
+            dist += abs(j / nu - k / nv) * (x - prev)
+            prev = x
+            while j < nu and u[j] == x:
+                j += 1
+            while k < nv and v[k] == x:
+                k += 1
+        dists[i] = dist
+    return dists
+
+
+def _ols_loop(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray, noise: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    n, t = preds.shape
+    btarg = np.empty(n)
+    bpred = np.empty(n)
+    x = np.linspace(1, 2, t)
+    for i in prange(n):
+        count = 0
+        xmin = np.inf
+        xmax = -np.inf
+        for s in range(t):
+            if masks[i, s]:
+                count += 1
+                xmin = min(xmin, x[s])
+                xmax = max(xmax, x[s])
+        scale = xmax - xmin + 1e-8
+
+        t00 = t01 = t11 = tr0 = tr1 = 0.0
+        p00 = p01 = p11 = pr0 = pr1 = 0.0
+        if count >= 2:
+            for s in range(t):
+                if x[s] < xmin or x[s] > xmax:
+                    continue
+                a = 2 * ((x[s] - xmin) / scale + 1)
+                p00 += a * a
+                p01 += a
+                p11 += 1
+                pr0 += a * preds[i, s]
+                pr1 += preds[i, s]
+                if masks[i, s]:
+                    t00 += a * a
+                    t01 += a
+                    t11 += 1
+                    tr0 += a * targs[i, s]
+                    tr1 += targs[i, s]
+
+        m00 = t00 + noise[i, 0, 0]
+        m01 = t01 + noise[i, 0, 1]
+        m10 = t01 + noise[i, 1, 0]
+        m11 = t11 + noise[i, 1, 1]
+        btarg[i] = (m11 * tr0 - m01 * tr1) / (m00 * m11 - m01 * m10)
+
+        m00 = p00 + noise[i, 0, 0]
+        m01 = p01 + noise[i, 0, 1]
+        m10 = p01 + noise[i, 1, 0]
+        m11 = p11 + noise[i, 1, 1]
+        bpred[i] = (m11 * pr0 - m01 * pr1) / (m00 * m11 - m01 * m10)
+    return btarg, bpred
+
+
+def w1_distances(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """Pixelwise w1 distances between the value distributions of predicted and non-masked target timeseries
+
+    Equivalent to `CubeCalculator.compute_w1` applied along the last axis.
+
+    Args:
+        preds (np.ndarray): Predictions, shape n,t
+        targs (np.ndarray): Targets, shape n,t
+        masks (np.ndarray): Masks, shape n,t, True (or 1) if non-masked
+
+    Returns:
+        np.ndarray: w1 distances, shape n, NaN where less than 2 target values are non-masked
+    """
+    return _compiled(_w1_loop)(np.ascontiguousarray(preds, dtype = np.float64), np.ascontiguousarray(targs, dtype = np.float64), np.ascontiguousarray(masks, dtype = np.bool_))
+
+
+def ols_slopes(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray, noise: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Pixelwise OLS slopes of target and predicted timeseries as in `CubeCalculator.OLS`
+
+    Target slopes are fitted over non-masked values, predicted slopes over all values between the first and last non-masked value. Pixels with less than 2 non-masked values get slope 0.
+
+    Args:
+        preds (np.ndarray): Predictions, shape n,t
+        targs (np.ndarray): Targets, shape n,t
+        masks (np.ndarray): Masks, shape n,t, True (or 1) if non-masked
+        noise (np.ndarray): Regularization added to the normal equations, shape n,2,2
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: target slopes, predicted slopes, each of shape n
+    """
+    return _compiled(_ols_loop)(np.ascontiguousarray(preds, dtype = np.float64), np.ascontiguousarray(targs, dtype = np.float64), np.ascontiguousarray(masks, dtype = np.bool_), np.ascontiguousarray(noise, dtype = np.float64))
@@ -0,0 +1,185 @@
+"""Per-file manifests (size and SHA256) for verifying downloaded datasets.
+"""
+from typing import Dict, Optional, Sequence, Tuple
+
+import os
+import json
+import hashlib
+import zipfile
+import multiprocessing
+from pathlib import Path
+from tqdm import tqdm
+
+MANIFEST_NAME = "MANIFEST.json"
+
+
+def hash_file(path: str, buf_size: int = 16*1024*1024) -> Tuple[int, str]:
+    """Size and SHA256 of a file
+
+    Args:
+        path (str): Path to file
+        buf_size (int, optional): Read buffer size in bytes. Defaults to 16 MB.
+
+    Returns:
+        Tuple[int, str]: size in bytes, hex digest
+    """
+    sha = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(buf_size)
+            if not data:
+                break
+            sha.update(data)
+            size += len(data)
+    return size, sha.hexdigest()
+
+
+def _hash_task(task: Tuple[str, str]) -> Tuple[str, Optional[int], Optional[str]]:
+    relpath, path = task
+    try:
+        size, sha = hash_file(path)
+    except OSError:
+        return relpath, None, None
+    return relpath, size, sha
+
+
+def _check_task(task: Tuple[str, str, Optional[dict]]) -> Tuple[str, str]:
+    """Check a single file against its manifest entry, runs inside a worker
+
+    Entries without "sha256" are checked by size only. Without an entry, `.npz` files are checked by the CRC32 checksums of the zip archive.
+
+    Args:
+        task (Tuple[str, str, Optional[dict]]): relative path, full path, manifest entry
+
+    Returns:
+        Tuple[str, str]: relative path, one of "ok", "missing", "corrupt"
+    """
+    relpath, path, entry = task
+    if not os.path.isfile(path):
+        return relpath, "missing"
+    if entry is None:
+        if path.endswith(".npz"):
+            try:
+                with zipfile.ZipFile(path) as archive:
+                    if archive.testzip() is not None:
+                        return relpath, "corrupt"
+            except (zipfile.BadZipFile, OSError):
+                return relpath, "corrupt"
+        return relpath, "ok"
+    if os.path.getsize(path) != entry["size"]:
+        return relpath, "corrupt"
+    if entry.get("sha256") is None:
+        return relpath, "ok"
+    return relpath, "ok" if hash_file(path)[1] == entry["sha256"] else "corrupt"
+
+
+def _imap(func, tasks: Sequence, num_workers: Optional[int], desc: str):
+    num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(num_workers) as p:
+            yield from tqdm(p.imap_unordered(func, tasks, chunksize = 16), total = len(tasks), desc = desc)
+    else:
+        yield from tqdm(map(func, tasks), total = len(tasks), desc = desc)
+
+
+def load_manifest(data_dir: str) -> Dict[str, dict]:
+    """Load the manifest of a dataset directory
+
+    Args:
+        data_dir (str): Dataset directory
+
+    Returns:
+        Dict[str, dict]: {relative path: {"size", "sha256", "source"}}, empty if there is no manifest
+    """
+    manifest_file = Path(data_dir)/MANIFEST_NAME
+    if not manifest_file.is_file():
+        return {}
+    with open(manifest_file, "r") as fp:
+        return json.load(fp)
+
+
+def save_manifest(data_dir: str, manifest: Dict[str, dict]):
+    """Save the manifest of a dataset directory
+
+    Args:
+        data_dir (str): Dataset directory
+        manifest (Dict[str, dict]): {relative path: {"size", "sha256", "source"}}
+    """
+    manifest_file = Path(data_dir)/MANIFEST_NAME
+    tmp_file = manifest_file.with_name(MANIFEST_NAME + ".tmp")
+    with open(tmp_file, "w") as fp:
+        json.dump(dict(sorted(manifest.items())), fp, indent = 0)
+    tmp_file.replace(manifest_file)
+
+
+def update_manifest(data_dir: str, sources: Dict[str, Optional[str]], num_workers: Optional[int] = None) -> Dict[str, dict]:
+    """Hash files in parallel and add them to the manifest of a dataset directory
+
+    Args:
+        data_dir (str): Dataset directory
+        sources (Dict[str, Optional[str]]): {relative path: source}, the source is the tarball or S3 object a file came from
+        num_workers (Optional[int], optional): Number of processes, defaults to the number of CPUs. Defaults to None.
+
+    Returns:
+        Dict[str, dict]: Updated manifest
+    """
+    manifest = load_manifest(data_dir)
+    tasks = [(relpath, os.path.join(data_dir, relpath)) for relpath in sources]
+    for relpath, size, sha in _imap(_hash_task, tasks, num_workers, "Hashing"):
+        if size is not None:
+            manifest[relpath] = {"size": size, "sha256": sha, "source": sources[relpath]}
+    save_manifest(data_dir, manifest)
+    return manifest
+
+
+def check_files(data_dir: str, entries: Dict[str, Optional[dict]], num_workers: Optional[int] = None) -> Dict[str, list]:
+    """Check files against manifest entries in parallel
+
+    Args:
+        data_dir (str): Dataset directory
+        entries (Dict[str, Optional[dict]]): {relative path: manifest entry or None}
+        num_workers (Optional[int], optional): Number of processes, defaults to the number of CPUs. Defaults to None.
+
+    Returns:
+        Dict[str, list]: relative paths of "missing" and "corrupt" files and their "sources"
+    """
+    tasks = [(relpath, os.path.join(data_dir, relpath), entry) for relpath, entry in entries.items()]
+    report = {"missing": [], "corrupt": []}
+    for relpath, status in _imap(_check_task, tasks, num_workers, "Verifying"):
+        if status != "ok":
+            report[status].append(relpath)
+
+    report["missing"].sort()
+    report["corrupt"].sort()
+    report["sources"] = sorted({entries[relpath]["source"] for relpath in report["missing"] + report["corrupt"] if entries[relpath] and entries[relpath].get("source")})
+    return report
+
+
+def verify_dataset(data_dir: str, num_workers: Optional[int] = None, patterns: Sequence[str] = ("**/*.npz", "**/*.nc")) -> Dict[str, list]:
+    """Verify all files of a dataset directory in parallel
+
+    Files listed in the manifest are checked by size and SHA256. If there is no manifest, the files found in `data_dir` are checked (`.npz` by their zip checksums) and the intact ones are saved as a new manifest, so later runs can detect any change.
+
+    Args:
+        data_dir (str): Dataset directory
+        num_workers (Optional[int], optional): Number of processes, defaults to the number of CPUs. Defaults to None.
+        patterns (Sequence[str], optional): Glob patterns of files to check if there is no manifest. Defaults to ("**/*.npz", "**/*.nc").
+
+    Returns:
+        Dict[str, list]: relative paths of "missing" and "corrupt" files and their "sources"
+    """
+    manifest = load_manifest(data_dir)
+    if manifest:
+        entries = manifest
+    else:
+        print(f"No manifest found in {data_dir}, building one from the files present.")
+        entries = {str(path.relative_to(data_dir)): None for pattern in patterns for path in sorted(Path(data_dir).glob(pattern))}
+
+    report = check_files(data_dir, entries, num_workers = num_workers)
+
+    if not manifest:
+        update_manifest(data_dir, {relpath: None for relpath in entries if relpath not in set(report["corrupt"])}, num_workers = num_workers)
+
+    print(f"Verified {len(entries)} files: {len(report['missing'])} missing, {len(report['corrupt'])} corrupt.")
+    return report
@@ -6,22 +6,382 @@ import argparse
 import re
 import json
 import time
+import zlib
+import zipfile
 import numpy as np
-from skimage import metrics
-import scipy.stats
 from pathlib import Path
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import warnings
 
+if __name__ == "__main__":
+    import kernels
+    import store
+    from workers import GuardedTask, MemoryBudget, WorkerSetup, available_cpus, bounded_map, robust_imap
+else:
+    from earthnet import kernels, store
+    from earthnet.workers import GuardedTask, MemoryBudget, WorkerSetup, available_cpus, bounded_map, robust_imap
+
+def read_npz_headers(filepath: Path) -> dict:
+    """Read shapes and dtypes of all arrays in a NPZ file without loading or decompressing the data
+
+    Args:
+        filepath (Path): Path to NPZ file
+
+    Returns:
+        dict: {key: (shape, dtype)}
+    """    
+    headers = {}
+    with zipfile.ZipFile(filepath) as archive:
+        for name in archive.namelist():
+            if not name.endswith(".npy"):
+                continue
+            with archive.open(name) as fp:
+                version = np.lib.format.read_magic(fp)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            headers[name[:-4]] = (shape, dtype)
+    return headers
+
+
+def read_cube_headers(filepath: Path) -> dict:
+    """Read shapes and dtypes of all arrays of a minicube without loading or decompressing the data
+
+    Args:
+        filepath (Path): Path to `.npz` minicube or virtual path into a store
+
+    Returns:
+        dict: {key: (shape, dtype)}
+    """
+    filepath = Path(filepath)
+    if not filepath.is_file() and store.is_store(filepath.parent):
+        cubestore = store.open_store(filepath.parent)
+        assert(filepath.name in cubestore),f"{filepath.name} is not in the store."
+        return {variable: (cubestore.shape(variable)[1:], np.dtype(meta["dtype"])) for variable, meta in cubestore.arrays.items()}
+    return read_npz_headers(filepath)
+
+
+def check_prediction(filepaths: dict) -> dict:
+    """Check a prediction against its target from the array headers only, runs inside a worker
+
+    Finds the problems that would otherwise fail an assertion in `CubeCalculator` while scoring: unreadable files, a missing `highresdynamic` in the target, non-numeric predictions, predictions with another shape than the target or with fewer than 4 bands, and predictions longer than 40 frames whose length is not divisible by 20.
+
+    Args:
+        filepaths (dict): Has keys "pred_filepath", "targ_filepath" with respective paths.
+
+    Returns:
+        dict: "pred_filepath", "targ_filepath" and a list of "problems", empty if the prediction can be scored
+    """
+    problems = []
+    try:
+        targ_headers = read_cube_headers(filepaths["targ_filepath"])
+    except Exception as e:
+        targ_headers = {}
+        problems.append(f"Target cannot be read: {e!r}")
+    try:
+        pred_headers = read_cube_headers(filepaths["pred_filepath"])
+    except Exception as e:
+        pred_headers = {}
+        problems.append(f"Prediction cannot be read: {e!r}")
+
+    targ_shape = targ_headers["highresdynamic"][0] if "highresdynamic" in targ_headers else None
+    if targ_headers and targ_shape is None:
+        problems.append("Target has no highresdynamic array.")
+
+    if pred_headers:
+        pred_key = "highresdynamic" if "highresdynamic" in pred_headers else list(pred_headers.keys())[0]
+        pred_shape, pred_dtype = pred_headers[pred_key]
+        if pred_dtype.kind not in "fiu":
+            problems.append(f"Prediction {pred_key} has non-numeric dtype {pred_dtype}.")
+        if len(pred_shape) != 4:
+            problems.append(f"Prediction {pred_key} has shape {pred_shape}, expected h,w,c,t.")
+        else:
+            if pred_shape[2] < 4:
+                problems.append(f"Prediction {pred_key} has {pred_shape[2]} bands, expected at least 4 (blue, green, red, nir).")
+            if pred_shape[3] > 40 and pred_shape[3] % 20 != 0:
+                problems.append(f"Prediction {pred_key} has {pred_shape[3]} frames, more than 40 frames must be divisible by 20.")
+            if targ_shape is not None and len(targ_shape) == 4 and (tuple(pred_shape[:2]) != tuple(targ_shape[:2]) or pred_shape[3] > targ_shape[3]):
+                problems.append(f"Prediction {pred_key} has shape {pred_shape}, but target highresdynamic has shape {targ_shape}.")
+    elif not problems:
+        problems.append("Prediction has no arrays.")
+
+    return {"pred_filepath": str(filepaths["pred_filepath"]), "targ_filepath": str(filepaths["targ_filepath"]), "problems": problems}
+
+
+def preflight_check(filepaths: Sequence[dict], n_workers: Optional[int] = -1) -> Sequence[dict]:
+    """Check all predictions against their targets in parallel before scoring, see `check_prediction`
+
+    Only the array headers are read, so this takes seconds, and all problems are reported at once.
+
+    Args:
+        filepaths (Sequence[dict]): List of dicts with keys "pred_filepath", "targ_filepath" with respective paths.
+        n_workers (Optional[int], optional): Number of workers, if -1 uses all CPUs, if 0 uses no multiprocessing. Defaults to -1.
+
+    Returns:
+        Sequence[dict]: Outputs of `check_prediction` for all predictions with problems
+    """
+    if n_workers == -1:
+        n_workers = multiprocessing.cpu_count()
+    if n_workers > 1 and len(filepaths) > 1:
+        with multiprocessing.Pool(n_workers) as p:
+            results = list(tqdm(p.imap(check_prediction, filepaths, chunksize = 16), total = len(filepaths), desc = "Preflight"))
+    else:
+        results = [check_prediction(filepaths) for filepaths in tqdm(filepaths, desc = "Preflight")]
+
+    failed = [result for result in results if result["problems"]]
+    for result in failed:
+        print(f"{result['pred_filepath']}: {' '.join(result['problems'])}")
+    print(f"Preflight checked {len(results)} predictions, {len(failed)} with problems.")
+    return failed
+
+
+def estimate_cost(filepaths: dict) -> float:
+    """Estimate the relative cost of scoring a prediction against its target
+
+    The cost is the number of predicted values to score, read from the NPZ header, plus the compressed size of both files as a proxy for loading and decompression (cubes inside a store count without size). Falls back to file sizes if the header cannot be read.
+
+    Args:
+        filepaths (dict): Has keys "pred_filepath", "targ_filepath" with respective paths.
+
+    Returns:
+        float: estimated cost
+    """    
+    filesize = sum(Path(filepaths[key]).stat().st_size for key in ["pred_filepath", "targ_filepath"] if Path(filepaths[key]).is_file())
+    try:
+        headers = read_npz_headers(filepaths["pred_filepath"])
+        shape, _ = headers["highresdynamic"] if "highresdynamic" in headers else next(iter(headers.values()))
+        return float(np.prod(shape)) + filesize
+    except Exception:
+        return float(filesize)
+
+
+def schedule_tasks(filepaths: Sequence[dict], n_workers: int, chunks_per_worker: int = 8) -> Sequence[Sequence[dict]]:
+    """Group tasks into batches, most expensive first
+
+    Tasks are sorted by their estimated cost in descending order, such that stragglers start early. Expensive tasks are dispatched alone, cheaper tasks are batched until a batch reaches the target cost of total cost / (n_workers * chunks_per_worker), which reduces the IPC overhead per task.
+
+    Args:
+        filepaths (Sequence[dict]): Tasks, dicts with keys "pred_filepath", "targ_filepath"
+        n_workers (int): Number of workers
+        chunks_per_worker (int, optional): Average number of batches per worker. Defaults to 8.
+
+    Returns:
+        Sequence[Sequence[dict]]: batches of tasks
+    """    
+    costs = [estimate_cost(task) for task in filepaths]
+    order = np.argsort(costs, kind = "stable")[::-1]
+    target_cost = sum(costs) / max(1, n_workers * chunks_per_worker)
+
+    batches = []
+    batch, batch_cost = [], 0
+    for idx in order:
+        batch.append(filepaths[idx])
+        batch_cost += costs[idx]
+        if batch_cost >= target_cost:
+            batches.append(batch)
+            batch, batch_cost = [], 0
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+SUBSCORE_NAMES = ["Value (MAD)", "Trend (OLS)", "Distribution (EMD)", "Perceptual (SSIM)"]
+
+
+def _harmonic_means(vals: np.ndarray) -> np.ndarray:
+    """Vectorized `EarthNetScore.__harmonic_mean` over the last axis
+
+    Gives exactly the same values as the scalar version: zeros are left out (pass missing subscores as 0, the scalar version leaves out None as well), NaN is kept and gives 1 like `min(1, nan)`, and NaN is returned where no value is left.
+
+    Args:
+        vals (np.ndarray): array of shape ... x k
+
+    Returns:
+        np.ndarray: harmonic means of shape ...
+    """
+    valid = vals != 0
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        hmean = valid.sum(-1) / np.where(valid, 1 / (vals + 1e-8), 0).sum(-1)
+    return np.where(valid.any(-1), np.fmin(1, hmean), np.nan)
+
+
+def _bootstrap_means(scores: Sequence[np.ndarray], n_boot: int, seed: Optional[int] = None, max_elements: int = 2**24) -> Sequence[np.ndarray]:
+    """Mean subscores of bootstrap replicates, resampling cubes with replacement
+
+    Every replicate is a vector of counts, how often each cube is drawn, so the NaN-safe means of a chunk of replicates are two matrix products. All arrays in `scores` are resampled with the same cubes, which gives paired replicates.
+
+    Args:
+        scores (Sequence[np.ndarray]): arrays of shape cubes x 4 with the same cubes, missing subscores are NaN
+        n_boot (int): Number of replicates
+        seed (Optional[int], optional): Random seed. Defaults to None.
+        max_elements (int, optional): Maximum size of the count matrix of a chunk of replicates. Defaults to 2**24.
+
+    Returns:
+        Sequence[np.ndarray]: mean subscores of shape n_boot x 4, one array per array in `scores`
+    """
+    rng = np.random.default_rng(seed)
+    n_cubes = scores[0].shape[0]
+    values = [np.nan_to_num(s, nan = 0.) for s in scores]
+    valid = [(~np.isnan(s)).astype(np.float64) for s in scores]
+    means = [np.empty((n_boot, s.shape[1]), dtype = np.float64) for s in scores]
+    chunk = max(1, max_elements // max(n_cubes, 1))
+    for start in range(0, n_boot, chunk):
+        n = min(chunk, n_boot - start)
+        idxs = rng.integers(0, n_cubes, (n, n_cubes)) + n_cubes * np.arange(n)[:, np.newaxis]
+        counts = np.bincount(idxs.reshape(-1), minlength = n * n_cubes).reshape(n, n_cubes).astype(np.float64)
+        for i in range(len(scores)):
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                means[i][start:start + n] = (counts @ values[i]) / (counts @ valid[i])
+    return means
+
+
+def _interval(replicates: np.ndarray, alpha: float) -> Tuple[float, float]:
+    lower, upper = np.nanpercentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return float(lower), float(upper)
+
+
+SEASONS = ["DJF", "DJF", "MAM", "MAM", "MAM", "JJA", "JJA", "JJA", "SON", "SON", "SON", "DJF"]
+
+
+def cube_stratum(cubename: str) -> Tuple[str, str]:
+    """Tile and season of a cube, parsed from its cubename
+
+    Args:
+        cubename (str): cubename, optionally with experiment prefix, format tile_startdate_enddate_...
+
+    Returns:
+        Tuple[str, str]: tile, season of the start date, one of "DJF", "MAM", "JJA", "SON"
+    """
+    components = Path(cubename).name.split("_")
+    regex = re.compile(r'\d{2}[A-Z]{3}')
+    if not regex.match(components[0]):
+        components = components[1:]
+    return components[0], SEASONS[int(components[1][5:7]) - 1]
+
+
+def stratified_order(cubenames: Sequence[str], seed: int = 0) -> Sequence[str]:
+    """Deterministic order of cubes, such that every prefix is a proportionally stratified sample by tile and season
+
+    Within a stratum, cubes are ordered by a hash of their cubename. The i-th of n cubes of a stratum gets the key (i + 0.5) / n, and all cubes are sorted by key, so the strata are interleaved according to their size.
+
+    Args:
+        cubenames (Sequence[str]): cubenames
+        seed (int, optional): Changes the order within the strata. Defaults to 0.
+
+    Returns:
+        Sequence[str]: cubenames in sampling order
+    """
+    strata = {}
+    for cubename in cubenames:
+        strata.setdefault(cube_stratum(cubename), []).append(cubename)
+    keys = []
+    for members in strata.values():
+        members = sorted(members, key = lambda cubename: (zlib.crc32(f"{seed}_{cubename}".encode()), cubename))
+        for i, cubename in enumerate(members):
+            keys.append(((i + 0.5) / len(members), zlib.crc32(f"{cubename}_{seed}".encode()), cubename))
+    return [cubename for _, _, cubename in sorted(keys)]
+
+
+def _stratified_estimate(scores: np.ndarray, strata: Sequence[tuple], stratum_sizes: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Stratified estimate of the mean subscores of all cubes from a sample of cubes
+
+    The strata are weighted by their number of cubes. Missing subscores (NaN) are left out, so if all cubes are sampled the estimate equals the mean over all cubes. The covariance of the estimate includes the finite population correction, strata with a single sampled cube use the pooled covariance.
+
+    Args:
+        scores (np.ndarray): array of shape sampled cubes x 4
+        strata (Sequence[tuple]): stratum of every sampled cube
+        stratum_sizes (dict): {stratum: number of cubes in the population}
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: mean subscores of shape 4, their covariance of shape 4 x 4
+    """
+    strata = np.array([str(stratum) for stratum in strata])
+    sizes = {str(stratum): size for stratum, size in stratum_sizes.items()}
+    valid = ~np.isnan(scores)
+    if len(scores) > 1:
+        pooled = np.ma.cov(np.ma.masked_invalid(scores), rowvar = False, allow_masked = True).filled(0)
+    else:
+        pooled = np.full((scores.shape[1], scores.shape[1]), np.inf)
+
+    weights, means, covs = [], [], []
+    for stratum in np.unique(strata):
+        idxs = strata == stratum
+        n = idxs.sum()
+        weights.append(sizes[stratum] * valid[idxs].mean(0))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            means.append(np.nan_to_num(np.nanmean(scores[idxs], axis = 0)))
+        if n >= sizes[stratum]:
+            covs.append(np.zeros_like(pooled))
+        else:
+            cov = np.ma.cov(np.ma.masked_invalid(scores[idxs]), rowvar = False, allow_masked = True).filled(0) if n > 1 else pooled
+            covs.append(cov / n * (1 - n / sizes[stratum]))
+
+    weights = np.array(weights)
+    with np.errstate(invalid = "ignore"):
+        weights = weights / weights.sum(0)
+    mean = np.where(np.isnan(weights).all(0), np.nan, (np.nan_to_num(weights) * np.array(means)).sum(0))
+    weights = np.nan_to_num(weights)
+    cov = sum(np.outer(w, w) * c for w, c in zip(weights, covs))
+    return mean, cov
+
+
+def _harmonic_mean_error(mean: np.ndarray, cov: np.ndarray) -> float:
+    """Standard error of the harmonic mean of estimated mean subscores, by the delta method
+    """
+    valid = (mean != 0) & ~np.isnan(mean)
+    if not valid.any():
+        return np.nan
+    hmean = _harmonic_means(mean)
+    grad = np.where(valid, hmean**2 / (valid.sum() * (np.where(valid, mean, 1) + 1e-8)**2), 0)
+    return float(np.sqrt(max(0, grad @ cov @ grad))) if np.isfinite(cov).all() else np.inf
+
+
+def _subsample_pixels(arrays: Sequence[np.ndarray], fraction: float, seed: int) -> Sequence[np.ndarray]:
+    """Random subset of the pixels of h x w x c x t arrays, as arrays of shape n x 1 x c x t
+
+    Args:
+        arrays (Sequence[np.ndarray]): arrays with the same pixels
+        fraction (float): Fraction of the pixels to keep
+        seed (int): Random seed
+
+    Returns:
+        Sequence[np.ndarray]: arrays with the same pixel subset
+    """
+    h, w = arrays[0].shape[:2]
+    idxs = np.sort(np.random.default_rng(seed).choice(h * w, max(1, int(round(fraction * h * w))), replace = False))
+    return [np.reshape(array, (h * w, 1) + array.shape[2:])[idxs] for array in arrays]
+
+
 class CubeCalculator:
     """Loads single cube and calculates subscores for EarthNetScore
 
+    The pixelwise OLS and EMD computations run either on the NumPy/SciPy reference implementation or on compiled Numba kernels (see `CubeCalculator.set_backend`).
+
     Example:
 
         >>> scores = CubeCalculator.get_scores({"pred_filepath": Path/to/pred.npz, "targ_filepath": Path/to/targ.npz})
     """    
 
+    backend = "numba" if kernels.HAS_NUMBA else "numpy"
+
+    @classmethod
+    def set_backend(cls, backend: str):
+        """Choose the implementation of the pixelwise OLS and EMD computations
+
+        Args:
+            backend (str): One of "numpy" (reference), "numba" (compiled parallel loops, needs Numba installed), "auto" (numba if installed, else numpy)
+        """        
+        assert(backend in ["numpy", "numba", "auto"])
+        if backend == "auto":
+            backend = "numba" if kernels.HAS_NUMBA else "numpy"
+        if backend == "numba" and not kernels.HAS_NUMBA:
+            raise ImportError("The numba backend needs Numba, install it with `pip install numba`.")
+        cls.backend = backend
+
     @staticmethod
     def MAD(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> Tuple[float, dict]:
         """Median absolute deviation score
@@ -31,12 +391,11 @@ class CubeCalculator:
         Args:
             preds (np.ndarray): Predictions, shape h,w,c,t
             targs (np.ndarray): Targets, shape h,w,c,t
-            masks (np.ndarray): Masks, shape h,w,c,t, 1 if non-masked, else 0
+            masks (np.ndarray): Boolean masks, shape h,w,c,t or h,w,1,t, True if non-masked
         Returns:
             Tuple[float, dict]: mad-score, debugging information
         """        
-        dists = np.abs(preds-targs)
-        dists[masks == 0] = np.nan
+        dists = np.where(masks, np.abs(preds-targs), np.nan)
 
         scaling_factor = 0.06649346971087526 # Computed via the expected distance from pixelwise timeseries variance
         dists = dists.astype(np.float64)
@@ -57,6 +416,7 @@ class CubeCalculator:
                 if mean is np.nan:
                     mean = 1000
                 MAE_frames.append(mean)
+            frame_mads = np.clip(1 - np.nanmedian(np.reshape(scaled_dists, (-1, scaled_dists.shape[-1])), axis = 0), 0, 1)
         
         debug_info = {
                         "minimum distance": float(np.nanmin(dists)), 
@@ -65,12 +425,13 @@ class CubeCalculator:
                         "median distance": float(np.nanmedian(dists)), 
                         "number nan": float(np.isnan(dists).sum()), 
                         "MAD score": float(mad),
-                        "frames": MAE_frames 
+                        "frames": MAE_frames,
+                        "lead_time": (np.nan_to_num(frame_mads), (~np.isnan(frame_mads)).astype(np.float64))
                     }
         return mad, debug_info
 
-    @staticmethod
-    def OLS(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> Tuple[float, dict]:
+    @classmethod
+    def OLS(cls, preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> Tuple[float, dict]:
         """Ordinary least squares slope deviation score
 
         Mean absolute difference between ordinary least squares slopes of target and predicted pixelwise NDVI timeseries. Target slopes are calculated over non-masked values. Predicted slopes are calculated for all values between the first and last non-masked value of a given timeseries. Scaled by a scaling factor such that a distance the size of a 99.7% confidence interval of the variance of the pixelwise centered NDVI timeseries is scaled to 0.9 (such that the ols-score becomes 0.1). If the timeseries is longer than 40 steps, it is split up into parts of length 20. The ols-score is 1-mean(abs(b_targ - b_pred)), it is scaled from 0 (worst) to 1 (best).
@@ -78,7 +439,7 @@ class CubeCalculator:
         Args:
             preds (np.ndarray): NDVI Predictions, shape h,w,1,t
             targs (np.ndarray): NDVI Targets, shape h,w,1,t
-            masks (np.ndarray): NDVI Masks, shape h,w,1,t, 1 if non-masked, else 0
+            masks (np.ndarray): Boolean NDVI Masks, shape h,w,1,t, True if non-masked. Pixels with less than 2 non-masked values are set to False in place, if `masks` can be reshaped without copying.
 
         Returns:
             Tuple[float, dict]: ols-score, debugging information
@@ -94,33 +455,38 @@ class CubeCalculator:
             masks = np.reshape(masks, (h, w, -1, 20))
             h, w, c, t = preds.shape
         
-        A = np.vstack([np.linspace(1,2,t),np.ones(t)]).T[np.newaxis,:,:].repeat(c*h*w, 0)
         targs = np.reshape(targs, (-1, t))[:,:,np.newaxis]
         preds = np.reshape(preds, (-1, t))[:,:,np.newaxis]
         masks = np.reshape(masks, (-1, t))[:,:,np.newaxis]
-        masks[(masks.sum(1, keepdims = True) < 2).repeat(t,1)] = 0
-        targsmasked = targs * masks
+        masks[(masks.sum(1, keepdims = True) < 2).repeat(t,1)] = False
+
+        noise = np.random.rand(c*h*w,2,2)/10000
 
-        Atarg = A * masks
-        Atargmin = np.ma.masked_equal(Atarg, 0.0, copy=True)
-        Atarg[:,:,0] = np.where(Atarg[:,:,0] > 0, Atarg[:,:,0] - Atargmin[:,:,0].min(1,keepdims = True), Atarg[:,:,0]) 
-        Atarg[:,:,0] = 2 * np.where(Atarg[:,:,1] > 0, Atarg[:,:,0] / (Atarg[:,:,0].max(1, keepdims = True) + 1e-8) + 1, Atarg[:,:,0])
-        AtargT = Atarg.transpose(0,2,1)
+        if cls.backend == "numba":
+            btarg, bpred = kernels.ols_slopes(preds[:,:,0], targs[:,:,0], masks[:,:,0], noise)
+            btarg, bpred = btarg[:,np.newaxis,np.newaxis], bpred[:,np.newaxis,np.newaxis]
+        else:
+            A = np.vstack([np.linspace(1,2,t),np.ones(t)]).T[np.newaxis,:,:].repeat(c*h*w, 0)
+            targsmasked = targs * masks
 
-        predmask = np.where((A[:,:,0] >= Atargmin[:,:,0].min(1,keepdims = True)) & (A[:,:,0] <= Atargmin[:,:,0].max(1,keepdims = True)), np.ones_like(A[:,:,0]), np.zeros_like(A[:,:,0]))[:,:,np.newaxis]
-        A = A * predmask
-        A[:,:,0] = np.where(A[:,:,0] > 0, A[:,:,0] - Atargmin[:,:,0].min(1,keepdims = True), A[:,:,0]) 
-        A[:,:,0] = 2 * np.where(A[:,:,1] > 0, A[:,:,0] / (A[:,:,0].max(1, keepdims = True) + 1e-8) + 1, A[:,:,0])
+            Atarg = A * masks
+            Atargmin = np.ma.masked_equal(Atarg, 0.0, copy=True)
+            Atarg[:,:,0] = np.where(Atarg[:,:,0] > 0, Atarg[:,:,0] - Atargmin[:,:,0].min(1,keepdims = True), Atarg[:,:,0]) 
+            Atarg[:,:,0] = 2 * np.where(Atarg[:,:,1] > 0, Atarg[:,:,0] / (Atarg[:,:,0].max(1, keepdims = True) + 1e-8) + 1, Atarg[:,:,0])
+            AtargT = Atarg.transpose(0,2,1)
 
-        predsmasked = preds * predmask
+            predmask = np.where((A[:,:,0] >= Atargmin[:,:,0].min(1,keepdims = True)) & (A[:,:,0] <= Atargmin[:,:,0].max(1,keepdims = True)), np.ones_like(A[:,:,0]), np.zeros_like(A[:,:,0]))[:,:,np.newaxis]
+            A = A * predmask
+            A[:,:,0] = np.where(A[:,:,0] > 0, A[:,:,0] - Atargmin[:,:,0].min(1,keepdims = True), A[:,:,0]) 
+            A[:,:,0] = 2 * np.where(A[:,:,1] > 0, A[:,:,0] / (A[:,:,0].max(1, keepdims = True) + 1e-8) + 1, A[:,:,0])
 
-        AT = A.transpose(0,2,1)
+            predsmasked = preds * predmask
 
-        noise = np.random.rand(c*h*w,2,2)/10000
+            AT = A.transpose(0,2,1)
 
-        btarg = np.matmul(np.linalg.inv(np.matmul(AtargT,Atarg)+noise),np.matmul(AtargT,targsmasked))
-        
-        bpred = np.matmul(np.linalg.inv(np.matmul(AT ,A) + noise),np.matmul(AT,predsmasked))      
+            btarg = np.matmul(np.linalg.inv(np.matmul(AtargT,Atarg)+noise),np.matmul(AtargT,targsmasked))
+            
+            bpred = np.matmul(np.linalg.inv(np.matmul(AT ,A) + noise),np.matmul(AT,predsmasked))      
 
         dists = np.abs(btarg[:,0,0] - bpred[:,0,0])/2
 
@@ -136,6 +502,10 @@ class CubeCalculator:
         else:
             ols = max(0,min(1, 1-distmean))
 
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            window_ols = np.clip(1 - np.nanmean(np.reshape(scaled_dists, (-1, c)), axis = 0), 0, 1)
+
         debug_info = {
                         #"target slopes": btarg[:,0,0].tolist(), 
                         #"predicted slopes": bpred[:,0,0].tolist(), 
@@ -152,12 +522,13 @@ class CubeCalculator:
                         "mean distance": float(np.nanmean(dists)), 
                         "median distance": float(np.nanmedian(dists)), 
                         "number nan": float(np.isnan(dists).sum()), 
-                        "ols score": float(ols)}
+                        "ols score": float(ols),
+                        "lead_time": (np.nan_to_num(window_ols), (~np.isnan(window_ols)).astype(np.float64))}
 
         return ols, debug_info
 
     @classmethod
-    def EMD(cls, preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> Tuple[float, dict]:
+    def EMD(cls, preds: np.ndarray, targs: np.ndarray, masks: np.ndarray, lead_time: bool = True) -> Tuple[float, dict]:
         """Earth mover distance score
 
         The earth mover distance (w1 metric) is computed between target and predicted pixelwise NDVI timeseries value distributions. For the target distributions, only non-masked values are considered. Scaled by a scaling factor such that a distance the size of a 99.7% confidence interval of the variance of the pixelwise centered NDVI timeseries is scaled to 0.9 (such that the ols-score becomes 0.1). The emd-score is 1-mean(emd), it is scaled from 0 (worst) to 1 (best).
@@ -165,13 +536,13 @@ class CubeCalculator:
         Args:
             preds (np.ndarray): NDVI Predictions, shape h,w,1,t
             targs (np.ndarray): NDVI Targets, shape h,w,1,t
-            masks (np.ndarray): NDVI Masks, shape h,w,1,t, 1 if non-masked, else 0
+            masks (np.ndarray): Boolean NDVI Masks, shape h,w,1,t, True if non-masked
+            lead_time (bool, optional): If True and t > 40, the distances are computed a second time per window of 20 frames for the lead time curves. Else no lead time values are returned for t > 40. Defaults to True.
 
         Returns:
             Tuple[float, dict]: emd-score, debugging information
         """        
-        data = np.concatenate([preds, targs, masks], axis = -1)
-        dists = np.apply_along_axis(cls.compute_w1, axis = -1, arr = data)
+        dists = cls.w1_distances(preds, targs, masks)
         
         scaling_factor = 0.10082047548620601 # Computed via the expected distance from pixelwise timeseries variance
 
@@ -186,17 +557,48 @@ class CubeCalculator:
         else:
             emd = max(0,min(1, 1-distmean))
 
+        h, t = preds.shape[0], preds.shape[-1]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            if t > 40 and not lead_time:
+                window_emd = np.zeros(0, dtype = np.float64)
+            elif t > 40: # Windows of 20 steps, as in OLS
+                assert(t%20 == 0)
+                window_dists = cls.w1_distances(np.reshape(preds, (h, -1, 1, 20)), np.reshape(targs, (h, -1, 1, 20)), np.reshape(masks, (h, -1, 1, 20)))
+                window_emd = np.clip(1 - np.nanmean(np.reshape(np.abs(window_dists).astype(np.float64) ** scaling_factor, (-1, t // 20)), axis = 0), 0, 1)
+            else:
+                window_emd = np.clip(np.array([1 - distmean], dtype = np.float64), 0, 1)
+
         debug_info = {
                         "minimum distance": float(np.nanmin(dists)), 
                         "maximum distance": float(np.nanmax(dists)), 
                         "mean distance": float(np.nanmean(dists)), 
                         "median distance": float(np.nanmedian(dists)), 
                         "number nan": float(np.isnan(dists).sum()), 
-                        "w1 score": float(emd)
+                        "w1 score": float(emd),
+                        "lead_time": (np.nan_to_num(window_emd), (~np.isnan(window_emd)).astype(np.float64))
                     }
 
         return emd, debug_info
 
+    @classmethod
+    def w1_distances(cls, preds: np.ndarray, targs: np.ndarray, masks: np.ndarray) -> np.ndarray:
+        """Pixelwise w1 distances with the current backend
+
+        Args:
+            preds (np.ndarray): NDVI Predictions, shape h,w,1,t
+            targs (np.ndarray): NDVI Targets, shape h,w,1,t
+            masks (np.ndarray): Boolean NDVI Masks, shape h,w,1,t, True if non-masked
+
+        Returns:
+            np.ndarray: w1 distances, NaN for pixels with less than 2 non-masked values
+        """        
+        if cls.backend == "numba":
+            t = preds.shape[-1]
+            return kernels.w1_distances(np.reshape(preds, (-1, t)), np.reshape(targs, (-1, t)), np.reshape(masks, (-1, t)))
+        data = np.concatenate([preds, targs, masks], axis = -1)
+        return np.apply_along_axis(cls.compute_w1, axis = -1, arr = data)
+
     @staticmethod
     def compute_w1(datarow: np.ndarray) -> Union[np.ndarray, None]:
         """Computing w1 distance for np.apply_along_axis
@@ -207,6 +609,8 @@ class CubeCalculator:
         Returns:
             Union[np.ndarray, None]: w1 distance between prediction and target, if not completely masked, else None.
         """        
+        import scipy.stats
+
         preds, targs, masks = np.split(datarow, 3)
         targs = targs[masks == 1]
         if len(targs) > 1:
@@ -223,22 +627,24 @@ class CubeCalculator:
         Args:
             preds (np.ndarray): Predictions, shape h,w,c,t
             targs (np.ndarray): Targets, shape h,w,c,t
-            masks (np.ndarray): Masks, shape h,w,c,t, 1 if non-masked, else 0
+            masks (np.ndarray): Boolean masks, shape h,w,c,t or h,w,1,t, True if non-masked
 
         Returns:
             Tuple[float, dict]: ssim-score, debugging information
         """        
+        from skimage import metrics
 
+        h, w, c, t = preds.shape
         ssim_targs = np.where(masks, targs, preds)
-        new_shape = (-1, preds.shape[0], preds.shape[1])
+        new_shape = (-1, h, w)
         ssim_targs = np.transpose(np.reshape(np.transpose(ssim_targs, (3,2,0,1)), new_shape),(1,2,0))
         ssim_preds = np.transpose(np.reshape(np.transpose(preds, (3,2,0,1)), new_shape),(1,2,0))
-        ssim_masks = np.transpose(np.reshape(np.transpose(masks, (3,2,0,1)), new_shape),(1,2,0))
+        valid_counts = np.broadcast_to(np.count_nonzero(masks, axis = (0,1)), (c, t)).T.reshape(-1)
         running_ssim = 0
         counts = 0
         ssim_frames = []
         for i in range(ssim_targs.shape[-1]):
-            if ssim_masks[:,:,i].sum() > 0.7*ssim_masks[:,:,i].size:
+            if valid_counts[i] > 0.7*h*w:
                 curr_ssim = metrics.structural_similarity(ssim_targs[:,:,i], ssim_preds[:,:,i])
                 running_ssim += curr_ssim
                 counts += 1
@@ -246,6 +652,9 @@ class CubeCalculator:
                 curr_ssim = 1000
             ssim_frames.append(curr_ssim)
         
+        frames = np.reshape(np.array(ssim_frames, dtype = np.float64), (preds.shape[-1], preds.shape[2]))
+        valid_frames = frames != 1000
+
         if counts == 0:
             ssim = None
         else:
@@ -263,7 +672,8 @@ class CubeCalculator:
                         "Standard deviation SSIM": str(np.ma.filled(np.ma.masked_equal(np.array(ssim_frames), 1000.0).std(), np.nan)),
                         "Valid SSIM frames": counts,
                         "SSIM score": ssim,
-                        "frames": ssim_frames
+                        "frames": ssim_frames,
+                        "lead_time": (np.where(valid_frames, frames, 0).sum(1), valid_frames.sum(1).astype(np.float64))
                     }
 
         return ssim, debug_info
@@ -272,6 +682,8 @@ class CubeCalculator:
     def load_file(pred_filepath: Path, targ_filepath: Path) -> Sequence[np.ndarray]:
         """Load a single target cube and a matching prediction
 
+        The masks are boolean, True if non-masked, and not repeated over the channels: `masks` has shape h,w,1,t and `ndvi_masks` is a copy of it.
+
         Args:
             pred_filepath (Path): Path to predicted cube
             targ_filepath (Path): Path to target cube
@@ -280,14 +692,15 @@ class CubeCalculator:
             Sequence[np.ndarray]: preds, targs, masks, ndvi_preds, ndvi_targs, ndvi_masks
         """        
         
-        pred_npz = np.load(pred_filepath)
-        targ_npz = np.load(targ_filepath)
+        pred_npz = store.load_cube(pred_filepath)
+        targ_npz = store.load_cube(targ_filepath)
 
         pred_key = "highresdynamic" if "highresdynamic" in pred_npz.keys() else list(pred_npz.keys())[0]
 
         preds = pred_npz[pred_key][:,:,:4,:]
-        targs = targ_npz["highresdynamic"][:,:,:4,:]
-        masks = ((1 - targ_npz["highresdynamic"][:,:,-1,:])[:,:,np.newaxis,:]).repeat(4,2)
+        targ_hrd = targ_npz["highresdynamic"]
+        targs = targ_hrd[:,:,:4,:]
+        masks = store.cube_mask(targ_hrd)[:,:,np.newaxis,:]
 
         if preds.shape[-1] < targs.shape[-1]:
             targs = targs[:,:,:,-preds.shape[-1]:]
@@ -304,7 +717,7 @@ class CubeCalculator:
 
         ndvi_preds = ((preds[:,:,3,:] - preds[:,:,2,:])/(preds[:,:,3,:] + preds[:,:,2,:] + 1e-6))[:,:,np.newaxis,:]
         ndvi_targs = ((targs[:,:,3,:] - targs[:,:,2,:])/(targs[:,:,3,:] + targs[:,:,2,:] + 1e-6))[:,:,np.newaxis,:]
-        ndvi_masks = masks[:,:,0,:][:,:,np.newaxis,:]
+        ndvi_masks = masks.copy()
 
         return preds, targs, masks, ndvi_preds, ndvi_targs, ndvi_masks
 
@@ -312,25 +725,37 @@ class CubeCalculator:
     def get_scores(cls, filepaths: dict) -> dict:
         """Get all subscores for a given cube
 
+        If `filepaths` has the key "pixel_fraction" below 1, OLS and EMD are approximated on this fraction of the pixels. The pixels are chosen at random, but deterministically for every target cube and "pixel_seed".
+
+        EMD per window of 20 frames, for the lead time curves of predictions longer than 40 frames, is only computed if `filepaths` has the key "emd_lead_time" set to True, as it doubles the cost of EMD.
+
         Args:
-            filepaths (dict): Has keys "pred_filepath", "targ_filepath" with respective paths.
+            filepaths (dict): Has keys "pred_filepath", "targ_filepath" with respective paths, optionally "pixel_fraction", "pixel_seed" and "emd_lead_time".
 
         Returns:
-            dict: subscores and debugging info for the input cube
+            dict: subscores and debugging info for the input cube, and the per-lead-time values for `LeadTimeCurves` under "lead_time"
         """        
         assert({"pred_filepath", "targ_filepath"}.issubset(set(filepaths.keys())))
         
         preds, targs, masks, ndvi_preds, ndvi_targs, ndvi_masks = cls.load_file(filepaths["pred_filepath"], filepaths["targ_filepath"])
+        first_band_masks = ndvi_masks
+
+        if filepaths.get("pixel_fraction", 1) < 1:
+            seed = zlib.crc32(f"{filepaths.get('pixel_seed', 0)}_{Path(filepaths['targ_filepath']).name}".encode())
+            ndvi_preds, ndvi_targs, ndvi_masks = _subsample_pixels([ndvi_preds, ndvi_targs, ndvi_masks], filepaths["pixel_fraction"], seed)
 
         debug_info = {}
 
         mad, debug_info["MAD"] = cls.MAD(preds, targs, masks)
 
-        ols, debug_info["OLS"] = cls.OLS(ndvi_preds, ndvi_targs, ndvi_masks)
+        # OLS drops pixels with less than 2 observations (per window of 20 frames) from its masks in place. As in previous versions, EMD and the first band of SSIM see this, except for full cubes of more than 40 frames.
+        ols_masks = ndvi_masks.copy() if ndvi_masks is first_band_masks and ndvi_masks.shape[-1] > 40 else ndvi_masks
+        ols, debug_info["OLS"] = cls.OLS(ndvi_preds, ndvi_targs, ols_masks)
 
-        emd, debug_info["EMD"] = cls.EMD(ndvi_preds, ndvi_targs, ndvi_masks)
+        emd, debug_info["EMD"] = cls.EMD(ndvi_preds, ndvi_targs, ndvi_masks, lead_time = filepaths.get("emd_lead_time", False))
 
-        ssim, debug_info["SSIM"] = cls.SSIM(preds, targs, masks)
+        ssim_masks = np.concatenate([first_band_masks, np.broadcast_to(masks, masks.shape[:2] + (preds.shape[2] - 1,) + masks.shape[3:])], axis = 2)
+        ssim, debug_info["SSIM"] = cls.SSIM(preds, targs, ssim_masks)
 
         return {
             "pred_filepath": str(filepaths["pred_filepath"]),
@@ -339,9 +764,109 @@ class CubeCalculator:
             "OLS": ols,
             "EMD": emd,
             "SSIM": ssim,
-            "debug_info": debug_info
+            "debug_info": debug_info,
+            "lead_time": {key: debug_info[key].pop("lead_time") for key in LeadTimeCurves.KEYS}
         }
 
+    @classmethod
+    def get_batch_scores(cls, batch: Sequence[dict]) -> Sequence[dict]:
+        """Get all subscores for a batch of cubes
+
+        Args:
+            batch (Sequence[dict]): List of dicts with keys "pred_filepath", "targ_filepath" with respective paths.
+
+        Returns:
+            Sequence[dict]: subscores and debugging info for each input cube
+        """        
+        return [cls.get_scores(filepaths) for filepaths in batch]
+
+
+class LeadTimeCurves:
+    """Running sums of the subscores per lead time over the best samples of all target cubes
+
+    MAD and SSIM are per predicted frame, OLS and EMD per window of 20 frames for predictions longer than 40 frames, else for the whole prediction. For predictions longer than 40 frames, EMD is only included if it was scored with "emd_lead_time" (see `CubeCalculator.get_scores`). The values of a target are kept only until all its predictions are scored, then the values of the best sample are added to fixed-size sums, so memory does not grow with the number of cubes.
+    """
+    KEYS = ["MAD", "SSIM", "OLS", "EMD"]
+    SSIM_SCALING = 10.31885115
+
+    def __init__(self, expected: Optional[dict] = None):
+        """Initialize LeadTimeCurves
+
+        Args:
+            expected (Optional[dict], optional): {target cubename: number of predictions}. Defaults to None, i.e. every sample is added directly.
+        """
+        self.expected = dict(expected) if expected is not None else {}
+        self.pending = {}
+        self.sums = {key: np.zeros(0, dtype = np.float64) for key in self.KEYS}
+        self.counts = {key: np.zeros(0, dtype = np.float64) for key in self.KEYS}
+
+    def add(self, lead_time: dict):
+        """Add the per-lead-time values of one cube to the running sums
+
+        Args:
+            lead_time (dict): {key: (values, weights)}, as returned by `CubeCalculator.get_scores` under "lead_time"
+        """
+        for key, (values, weights) in lead_time.items():
+            values, weights = np.asarray(values, dtype = np.float64), np.asarray(weights, dtype = np.float64)
+            if len(values) > len(self.sums[key]):
+                self.sums[key] = np.pad(self.sums[key], (0, len(values) - len(self.sums[key])))
+                self.counts[key] = np.pad(self.counts[key], (0, len(values) - len(self.counts[key])))
+            self.sums[key][:len(values)] += values
+            self.counts[key][:len(values)] += weights
+
+    def add_sample(self, target: str, scores: dict, lead_time: Optional[dict]):
+        """Add a scored sample, the values of a target are added once all its samples are in
+
+        Args:
+            target (str): Target cubename
+            scores (dict): Subscores of the sample with keys "MAD", "OLS", "EMD", "SSIM"
+            lead_time (Optional[dict]): Per-lead-time values of the sample, None if it failed to score
+        """
+        samples = self.pending.setdefault(target, [])
+        if lead_time is not None:
+            samples.append((scores, lead_time))
+        else:
+            self.expected[target] = self.expected.get(target, 1) - 1
+        if len(samples) < self.expected.get(target, 1):
+            return
+        del self.pending[target]
+        if len(samples) > 0:
+            samples.sort(key = lambda sample: Path(sample[0]["pred_filepath"]))
+            ens = _harmonic_means(np.array([[0 if sample[key] is None else sample[key] for key in ["MAD", "OLS", "EMD", "SSIM"]] for sample, _ in samples], dtype = np.float64))
+            best = 0 if np.isnan(ens).all() else int(np.nanargmax(ens))
+            self.add(samples[best][1])
+
+    def merge(self, other: dict):
+        """Add running sums saved by `LeadTimeCurves.to_dict`, e.g. of another shard
+
+        Args:
+            other (dict): {"sums", "counts"}
+        """
+        self.add({key: (other["sums"][key], other["counts"][key]) for key in self.KEYS})
+
+    def curves(self) -> dict:
+        """Mean subscores per lead time
+
+        Returns:
+            dict: {key: list of scores}, None where no values were added
+        """
+        curves = {}
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            for key in self.KEYS:
+                curve = self.sums[key] / self.counts[key]
+                if key == "SSIM":
+                    curve = np.maximum(curve, 0) ** self.SSIM_SCALING
+                curves[key] = [None if np.isnan(v) else float(v) for v in curve]
+        return curves
+
+    def to_dict(self) -> dict:
+        """Curves and running sums as JSON serializable dict
+
+        Returns:
+            dict: {"curves", "sums", "counts"}
+        """
+        return {"curves": self.curves(), "sums": {key: self.sums[key].tolist() for key in self.KEYS}, "counts": {key: self.counts[key].tolist() for key in self.KEYS}}
+
 
 class EarthNetScore:
     """EarthNetScore class, fast computation using multiprocessing
@@ -357,23 +882,35 @@ class EarthNetScore:
         >>> ens = ENS.summarize()
 
     """    
-    def __init__(self, pred_dir: str, targ_dir: str):
+    def __init__(self, pred_dir: str, targ_dir: str, cubenames: Optional[Sequence[str]] = None, preflight: bool = True, shard_index: Optional[int] = None, num_shards: Optional[int] = None):
         """Initialize EarthNetScore
 
         Args:
             pred_dir (str): Directory with predictions, format is one of {pred_dir/tile/cubename.npz, pred_dir/tile/experiment_cubename.npz}
-            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz}
+            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz} or a store written by `earthnet.store.convert_to_store`
+            cubenames (Optional[Sequence[str]], optional): If given, only these target cubes are scored, e.g. selected with `earthnet.catalog.Catalog`. Defaults to None.
+            preflight (bool, optional): If True, checks all predictions against their targets from the array headers before scoring, see `get_paths`. Defaults to True.
+            shard_index (Optional[int], optional): Index of the shard of target cubes to score, see `shard`. Defaults to None.
+            num_shards (Optional[int], optional): Total number of shards, if None scores all target cubes. Defaults to None.
         """        
-        self.get_paths(pred_dir, targ_dir)
+        self.get_paths(pred_dir, targ_dir, cubenames = cubenames, preflight = preflight, shard_index = shard_index, num_shards = num_shards)
 
-    def get_paths(self, pred_dir: str, targ_dir: str):
+    def get_paths(self, pred_dir: str, targ_dir: str, cubenames: Optional[Sequence[str]] = None, preflight: bool = True, shard_index: Optional[int] = None, num_shards: Optional[int] = None):
         """Match paths of target cubes with predicted cubes
 
         Each target cube gets 1 or more predicted cubes.
 
+        With `num_shards`, the target cubes are restricted to one shard (see `shard`) before predictions are matched and checked, so every shard only looks at its own predictions.
+
+        With `preflight`, all predictions are checked against their targets in parallel, reading only the array headers (see `check_prediction`). All problems are printed at once, before any time is spent on scoring.
+
         Args:
             pred_dir (str): Directory with predictions, format is one of {pred_dir/tile/cubename.npz, pred_dir/tile/experiment_cubename.npz}
-            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz}
+            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz} or a store written by `earthnet.store.convert_to_store`
+            cubenames (Optional[Sequence[str]], optional): If given, only these target cubes are used. Defaults to None.
+            preflight (bool, optional): If True, checks all predictions from their headers and raises an AssertionError if any cannot be scored. Defaults to True.
+            shard_index (Optional[int], optional): Index of the shard of target cubes to use, in range(num_shards). Defaults to None.
+            num_shards (Optional[int], optional): Total number of shards, if None uses all target cubes. Defaults to None.
         """        
         print("Initializing filepaths...")
 
@@ -382,9 +919,22 @@ class EarthNetScore:
         if "target" in [d.name for d in targ_dir.glob("*") if d.is_dir()]:
             targ_dir = targ_dir/"target"
 
-        assert({d.name for d in pred_dir.glob("*") if d.is_dir()}.issubset({d.name for d in targ_dir.glob("*") if d.is_dir()}))
+        if store.is_store(targ_dir):
+            targ_paths = store.store_paths(targ_dir)
+        else:
+            assert({d.name for d in pred_dir.glob("*") if d.is_dir()}.issubset({d.name for d in targ_dir.glob("*") if d.is_dir()}))
+
+            targ_paths = sorted(list(targ_dir.glob("**/*.npz")))
+
+        if cubenames is not None:
+            cubenames = {Path(cubename).stem for cubename in cubenames}
+            targ_paths = [targ_path for targ_path in targ_paths if Path(self.__name_getter(targ_path)).stem in cubenames]
 
-        targ_paths = sorted(list(targ_dir.glob("**/*.npz")))
+        if num_shards is not None:
+            assert(shard_index is not None and 0 <= shard_index < num_shards),"shard_index must be in range(num_shards)."
+            targ_paths = [targ_path for targ_path in targ_paths if self.__shard_of(targ_path, num_shards) == shard_index]
+            self.shard_index, self.num_shards = shard_index, num_shards
+            print(f"Using shard {shard_index} of {num_shards} with {len(targ_paths)} target cubes.")
 
         filepaths = []
         for targ_path in tqdm(targ_paths):
@@ -398,7 +948,30 @@ class EarthNetScore:
 
         print("Filepaths initialized.")
 
+        if preflight:
+            failed = preflight_check(filepaths)
+            assert(len(failed) == 0),f"Preflight found problems with {len(failed)} of {len(filepaths)} predictions, see above."
+
+    def shard(self, shard_index: int, num_shards: int):
+        """Restrict the filepaths to one shard of the target cubes
+
+        Target cubes are assigned to shards deterministically by a hash of their cubename, so all predictions for one target end up in the same shard and every run with the same number of shards partitions the targets identically. Passing `shard_index` and `num_shards` to `EarthNetScore` does the same before predictions are matched and checked.
+
+        Args:
+            shard_index (int): Index of the shard to keep, in range(num_shards)
+            num_shards (int): Total number of shards
+        """        
+        assert(num_shards > 0 and 0 <= shard_index < num_shards),"shard_index must be in range(num_shards)."
+
+        self.filepaths = [filepaths for filepaths in self.filepaths if self.__shard_of(filepaths["targ_filepath"], num_shards) == shard_index]
+        self.shard_index, self.num_shards = shard_index, num_shards
+
+        print(f"Using shard {shard_index} of {num_shards} with {len(self.filepaths)} filepaths.")
+
+    def __shard_of(self, targ_path: Path, num_shards: int) -> int:
+        return zlib.crc32(self.__name_getter(Path(targ_path)).encode()) % num_shards
         
+
     def __name_getter(self, path: Path) -> str:
         """Helper function gets Cubename from a Path
 
@@ -416,26 +989,95 @@ class EarthNetScore:
             assert(bool(regex.match(components[1])))
             return "_".join(components[1:]) 
 
-    def compute_scores(self, n_workers: Optional[int] = -1) -> dict:
+    def compute_scores(self, n_workers: Optional[int] = -1, robust: bool = False, timeout: Optional[float] = None, max_retries: int = 2, schedule: str = "cost", threads_per_worker: Optional[int] = None, pin_cpus: bool = False, keep_frames: bool = True, max_memory: Optional[Union[str, int]] = None, emd_lead_time: bool = False) -> dict:
         """Compute subscores for all cubepaths
 
+        With `schedule = "cost"`, cubes are dispatched in order of their estimated cost, most expensive first, and cheap cubes are batched (see `schedule_tasks`). With `schedule = "fifo"`, cubes are dispatched one by one in order of their filepaths. The resulting data is the same.
+
+        Every worker process gets a budget of `threads_per_worker` native threads (BLAS, OpenMP), by default the CPUs divided by the number of workers, to avoid oversubscription.
+
+        In robust mode, a cube failing to score (e.g. a truncated file, a timeout or a crashed worker) does not abort the run. It is recorded with its error in `self.quarantine` and left out of the EarthNetScore. With multiprocessing, a cube still running `timeout` plus `earthnet.workers.TIMEOUT_GRACE` seconds after its start, e.g. hanging in native code, is killed together with its pool. Without multiprocessing, the time limit only interrupts Python code.
+
+        Subscores per lead time of the best samples are accumulated on the fly, see `lead_time_curves`. For predictions longer than 40 frames, the EMD curve needs a second pass of EMD over windows of 20 frames and is only computed with `emd_lead_time`.
+
+        With `max_memory`, the peak memory of scoring the most expensive cube is first measured in a fresh worker. The number of workers is reduced to fit into the budget, and new cubes are only dispatched while this process and its workers stay below it (see `earthnet.workers.MemoryBudget`).
+
         Args:
             n_workers (Optional[int], optional): Number of workers, if -1 uses all CPUs, if 0 uses no multiprocessing. Defaults to -1.
+            robust (bool, optional): If True, isolates failing cubes instead of aborting. Defaults to False.
+            timeout (Optional[float], optional): Time limit per cube in seconds, only used in robust mode. Defaults to None.
+            max_retries (int, optional): Number of retries of a cube after its worker crashed, only used in robust mode. Defaults to 2.
+            schedule (str, optional): One of "cost", "fifo". Defaults to "cost".
+            threads_per_worker (Optional[int], optional): Number of native threads per worker, if None the CPUs are divided among the workers. Defaults to None.
+            pin_cpus (bool, optional): If True, pins every worker to its own set of CPUs. Defaults to False.
+            keep_frames (bool, optional): If False, the per-frame MAD and SSIM lists are dropped from the debugging info of every cube. Defaults to True.
+            max_memory (Optional[Union[str, int]], optional): Memory budget of the run, e.g. "48GB", not used without multiprocessing. Defaults to None.
+            emd_lead_time (bool, optional): If True, also computes EMD per window of 20 frames for the lead time curves of predictions longer than 40 frames. Defaults to False.
 
         Returns:
             dict: data of format {cubename: score_dict}
         """        
-        if n_workers == 0:
+        assert(schedule in ["cost", "fifo"])
+        start = time.time()
+        self.quarantine = []
+        self.keep_frames = keep_frames
+        self.curves = self.__new_curves()
+        if n_workers == -1:
+            n_workers = multiprocessing.cpu_count()
+        budget = None
+        if max_memory is not None and n_workers > 0 and len(self.filepaths) > 0:
+            budget = MemoryBudget.calibrate(max_memory, CubeCalculator.get_scores, max(self.filepaths, key = estimate_cost))
+            n_workers = budget.n_workers(n_workers)
+        setup = WorkerSetup(n_workers, threads_per_worker = threads_per_worker, pin_cpus = pin_cpus)
+        filepaths_list = [dict(filepaths, emd_lead_time = True) for filepaths in self.filepaths] if emd_lead_time else self.filepaths
+
+        if robust:
+            all_scores = []
+            if n_workers == 0:
+                print("Iteratively computing components for EarthNetScore in robust mode")
+                guarded = GuardedTask(CubeCalculator.get_scores, timeout = timeout)
+                results = ((filepaths, *guarded(filepaths)) for filepaths in filepaths_list)
+            else:
+                print(f"Computing components for EarthNetScore using {setup} in robust mode")
+                tasks = filepaths_list if schedule == "fifo" else sorted(filepaths_list, key = estimate_cost, reverse = True)
+                results = robust_imap(CubeCalculator.get_scores, tasks, n_workers, timeout = timeout, max_retries = max_retries, setup = setup, budget = budget)
+            for filepaths, ok, result in tqdm(results, total = len(self.filepaths)):
+                if ok:
+                    all_scores.append(self.__collect(result))
+                else:
+                    self.curves.add_sample(self.__name_getter(Path(filepaths["targ_filepath"])), {}, None)
+                    warnings.warn(f"Quarantined {filepaths['pred_filepath']}: {result}")
+                    self.quarantine.append({"pred_filepath": str(filepaths["pred_filepath"]), "targ_filepath": str(filepaths["targ_filepath"]), "error": result})
+        elif n_workers == 0:
             all_scores = []
             print("Iteratively computing components for EarthNetScore")
-            for filepaths in tqdm(self.filepaths):
-                all_scores.append(CubeCalculator.get_scores(filepaths))
+            for filepaths in tqdm(filepaths_list):
+                all_scores.append(self.__collect(CubeCalculator.get_scores(filepaths)))
+        elif budget is not None:
+            print(f"Computing components for EarthNetScore using {setup} within the {budget}")
+            initializer, initargs = setup.pool_args()
+            with ProcessPoolExecutor(max_workers = n_workers, initializer = initializer, initargs = initargs) as pool:
+                if schedule == "fifo":
+                    all_scores = [self.__collect(scores) for scores in tqdm(bounded_map(pool, CubeCalculator.get_scores, filepaths_list, budget.prefetch(n_workers), budget = budget), total = len(self.filepaths))]
+                else:
+                    all_scores = []
+                    with tqdm(total = len(self.filepaths)) as pbar:
+                        for batch_scores in bounded_map(pool, CubeCalculator.get_batch_scores, schedule_tasks(filepaths_list, n_workers), budget.prefetch(n_workers), budget = budget, ordered = False):
+                            all_scores.extend(self.__collect(scores) for scores in batch_scores)
+                            pbar.update(len(batch_scores))
         else:
-            if n_workers == -1:
-                n_workers = multiprocessing.cpu_count()
-            print(f"Computing components for EarthNetScore using {n_workers} processes")
-            with multiprocessing.Pool(n_workers) as p:
-                all_scores = list(tqdm(p.imap(CubeCalculator.get_scores, self.filepaths), total = len(self.filepaths)))
+            print(f"Computing components for EarthNetScore using {setup}")
+            with multiprocessing.Pool(n_workers, *setup.pool_args()) as p:
+                if schedule == "fifo":
+                    all_scores = [self.__collect(scores) for scores in tqdm(p.imap(CubeCalculator.get_scores, filepaths_list), total = len(self.filepaths))]
+                else:
+                    all_scores = []
+                    with tqdm(total = len(self.filepaths)) as pbar:
+                        for batch_scores in p.imap_unordered(CubeCalculator.get_batch_scores, schedule_tasks(filepaths_list, n_workers)):
+                            all_scores.extend(self.__collect(scores) for scores in batch_scores)
+                            pbar.update(len(batch_scores))
+
+        all_scores = sorted(all_scores, key = lambda scores: (Path(scores["targ_filepath"]), Path(scores["pred_filepath"])))
 
         data = {}
         for scores in all_scores:
@@ -447,10 +1089,154 @@ class EarthNetScore:
 
         self.data = data
 
-        print("Done computing scores.")
+        if len(self.quarantine) > 0:
+            print(f"Quarantined {len(self.quarantine)} of {len(self.filepaths)} cubes.")
+
+        print(f"Done computing scores in {time.time() - start:.1f} seconds.")
 
         return data
 
+    def quick_scores(self, precision: float = 0.005, pixel_fraction: float = 0.1, batch_size: Optional[int] = None, max_cubes: Optional[int] = None, seed: int = 0, n_workers: Optional[int] = -1, threads_per_worker: Optional[int] = None, output_file: Optional[str] = None) -> dict:
+        """Approximate EarthNetScore from a stratified subsample of the target cubes, refined until the requested precision is reached
+
+        Target cubes are scored in the deterministic order of `stratified_order`, stratified by tile and season, in batches. After every batch, the mean subscores are estimated as stratified means and the EarthNetScore with a standard error (delta method). Scoring stops once the half-width of the 95% interval is at most `precision`, or all cubes are scored. OLS and EMD can additionally be approximated on a fraction of the pixels.
+
+        The scored cubes are kept in `self.data`, so `summarize` and `bootstrap` work on the subsample.
+
+        Args:
+            precision (float, optional): Target half-width of the 95% interval of the EarthNetScore. Defaults to 0.005.
+            pixel_fraction (float, optional): Fraction of the pixels used for OLS and EMD, 1 uses all pixels. Defaults to 0.1.
+            batch_size (Optional[int], optional): Number of target cubes scored between two estimates, defaults to 4 per worker, at least 16. Defaults to None.
+            max_cubes (Optional[int], optional): Maximum number of target cubes to score. Defaults to None.
+            seed (int, optional): Seed of the cube order and the pixel subsets. Defaults to 0.
+            n_workers (Optional[int], optional): Number of workers, if -1 uses all CPUs, if 0 uses no multiprocessing. Defaults to -1.
+            threads_per_worker (Optional[int], optional): Number of native threads per worker, if None the CPUs are divided among the workers. Defaults to None.
+            output_file (Optional[str], optional): If not None, saves the estimate to this path, recommended to end with .json. Defaults to None.
+
+        Returns:
+            dict: "EarthNetScore", "error" (standard error), the four mean subscores, "n_cubes" scored and "n_total" target cubes
+        """        
+        start = time.time()
+        if n_workers == -1:
+            n_workers = multiprocessing.cpu_count()
+        if batch_size is None:
+            batch_size = max(16, 4 * n_workers)
+
+        targets = {}
+        for filepaths in self.filepaths:
+            targets.setdefault(self.__name_getter(Path(filepaths["targ_filepath"])), []).append(dict(filepaths, pixel_fraction = pixel_fraction, pixel_seed = seed))
+        stratum_sizes = {}
+        for cube in targets:
+            stratum_sizes[cube_stratum(cube)] = stratum_sizes.get(cube_stratum(cube), 0) + 1
+        order = stratified_order(list(targets), seed = seed)
+        if max_cubes is not None:
+            order = order[:max_cubes]
+        assert(len(order) > 0),"No target cubes to score."
+
+        print(f"Estimating EarthNetScore from up to {len(order)} of {len(targets)} target cubes in {len(stratum_sizes)} strata")
+        self.data, self.quarantine = {}, []
+        self.keep_frames = True
+        self.curves = self.__new_curves()
+        setup = WorkerSetup(n_workers, threads_per_worker = threads_per_worker)
+        pool = multiprocessing.Pool(n_workers, *setup.pool_args()) if n_workers > 0 else None
+        try:
+            for batch_start in range(0, len(order), batch_size):
+                tasks = [filepaths for cube in order[batch_start:batch_start + batch_size] for filepaths in targets[cube]]
+                results = pool.imap_unordered(CubeCalculator.get_scores, tasks) if pool is not None else map(CubeCalculator.get_scores, tasks)
+                for scores in sorted(map(self.__collect, results), key = lambda scores: (Path(scores["targ_filepath"]), Path(scores["pred_filepath"]))):
+                    self.data.setdefault(self.__name_getter(Path(scores["targ_filepath"])), []).append(scores)
+
+                cubes, subscores = self.subscores()
+                mean, cov = _stratified_estimate(subscores, [cube_stratum(cube) for cube in cubes], stratum_sizes)
+                ens, error = float(_harmonic_means(mean)), _harmonic_mean_error(mean, cov)
+                print(f"{len(cubes)} cubes: EarthNetScore {ens:.4f} +- {1.96 * error:.4f}")
+                if 1.96 * error <= precision:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        result = {"EarthNetScore": ens, "error": error}
+        result.update({name: float(value) for name, value in zip(SUBSCORE_NAMES, mean)})
+        result.update({"n_cubes": len(self.data), "n_total": len(targets), "pixel_fraction": pixel_fraction})
+
+        if output_file is not None:
+            Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(output_file, "w") as fp:
+                json.dump(result, fp)
+
+        print(f"Estimated EarthNetScore: {ens:.4f} +- {1.96 * error:.4f} (95%) from {len(self.data)} of {len(targets)} cubes in {time.time() - start:.1f} seconds.")
+        return result
+
+    def benchmark_setups(self, setups: Sequence[str], pin_cpus: bool = False, schedule: str = "cost", output_file: Optional[str] = None) -> dict:
+        """Time `compute_scores` for several processes x threads configurations of the workers
+
+        Every configuration scores all filepaths, so restrict them first (e.g. with `cubenames` or `shard`) to keep the benchmark short.
+
+        Args:
+            setups (Sequence[str]): Configurations like "64x1", "16x4", i.e. number of workers x threads per worker
+            pin_cpus (bool, optional): If True, pins every worker to its own set of CPUs. Defaults to False.
+            schedule (str, optional): One of "cost", "fifo". Defaults to "cost".
+            output_file (Optional[str], optional): If not None, saves the timings to this path, recommended to end with .json. Defaults to None.
+
+        Returns:
+            dict: {setup: seconds}
+        """
+        timings = {}
+        for setup in setups:
+            n_workers, threads_per_worker = [int(n) for n in str(setup).lower().split("x")]
+            start = time.time()
+            self.compute_scores(n_workers = n_workers, threads_per_worker = threads_per_worker, pin_cpus = pin_cpus, schedule = schedule, keep_frames = False)
+            timings[setup] = time.time() - start
+
+        print(f"Scored {len(self.filepaths)} cubes with {len(available_cpus())} CPUs:")
+        for setup, seconds in timings.items():
+            print(f"{setup:>8}: {seconds:8.1f} seconds")
+
+        if output_file is not None:
+            Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(output_file, "w") as fp:
+                json.dump({"n_cubes": len(self.filepaths), "n_cpus": len(available_cpus()), "pin_cpus": pin_cpus, "seconds": timings}, fp)
+        return timings
+
+    def __new_curves(self) -> LeadTimeCurves:
+        expected = {}
+        for filepaths in self.filepaths:
+            name = self.__name_getter(Path(filepaths["targ_filepath"]))
+            expected[name] = expected.get(name, 0) + 1
+        return LeadTimeCurves(expected)
+
+    def __collect(self, scores: dict) -> dict:
+        """Move the per-lead-time values of a scored sample into the lead time curves, optionally drop the frame lists
+        """        
+        self.curves.add_sample(self.__name_getter(Path(scores["targ_filepath"])), scores, scores.pop("lead_time", None))
+        if not self.keep_frames:
+            for key in ["MAD", "SSIM"]:
+                scores["debug_info"][key].pop("frames", None)
+        return scores
+
+    def lead_time_curves(self) -> dict:
+        """Subscores per lead time, averaged over the best samples of all target cubes
+
+        MAD and SSIM are given per predicted frame, OLS and EMD per window of 20 frames for predictions longer than 40 frames, else for the whole prediction. For predictions longer than 40 frames, the EMD curve is empty unless scored with `emd_lead_time`, see `compute_scores`.
+
+        Returns:
+            dict: {"MAD", "SSIM", "OLS", "EMD"}: list of scores per lead time, None where no frame was valid
+        """        
+        return self.curves.curves()
+
+    def save_lead_time_curves(self, output_file: str):
+        """Save the lead time curves and their running sums as JSON
+
+        Args:
+            output_file (str): Output filepath, recommended to end with .json
+        """        
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as fp:
+            json.dump(self.curves.to_dict(), fp)
+        print(f"Saved lead time curves to {output_file}.")
+
     def save_scores(self, output_file: str):
         """Save all subscores and debugging info as JSON
 
@@ -462,6 +1248,106 @@ class EarthNetScore:
         with open(output_file, "w") as fp:
             json.dump(self.data, fp)   
         print(f"Saved data to {output_file}.")
+
+    def save_quarantine(self, output_file: str):
+        """Save the cubes that failed in robust mode together with their errors as JSON
+
+        Args:
+            output_file (str): Output filepath, recommended to end with .json
+        """        
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as fp:
+            json.dump(self.quarantine, fp)
+        print(f"Saved quarantine list of {len(self.quarantine)} cubes to {output_file}.")
+
+    def best_samples(self) -> dict:
+        """Get the subscores of the best prediction for every target cube
+
+        Returns:
+            dict: data of format {cubename: {"pred_filepath", "targ_filepath", "MAD", "OLS", "EMD", "SSIM"}}
+        """        
+        best_samples = {}
+        for cube in self.data:
+            best_sample = self.__get_best_sample(self.data[cube])
+            best_samples[cube] = {k: best_sample[k] for k in ["pred_filepath", "targ_filepath", "MAD", "OLS", "EMD", "SSIM"]}
+        return best_samples
+
+    def save_shard(self, output_file: str):
+        """Save the best-sample subscores of this shard as JSON, to be combined later with `EarthNetScore.merge_shards`
+
+        Args:
+            output_file (str): Output filepath, recommended to end with .json
+        """        
+        print("Saving shard...")
+        shard = {
+            "shard_index": getattr(self, "shard_index", 0),
+            "num_shards": getattr(self, "num_shards", 1),
+            "cubes": self.best_samples()
+        }
+        if hasattr(self, "curves"):
+            shard["lead_time"] = self.curves.to_dict()
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_file, "w") as fp:
+            json.dump(shard, fp)
+        print(f"Saved shard to {output_file}.")
+
+    @classmethod
+    def from_shards(cls, shard_files: Sequence[str]):
+        """Load the partial results of `EarthNetScore.save_shard`, to summarize or bootstrap them without recomputing
+
+        Args:
+            shard_files (Sequence[str]): Filepaths of the saved shards
+
+        Returns:
+            EarthNetScore: with the best sample of every cube as `data` and the merged lead time curves, if saved in the shards
+        """        
+        self = cls.__new__(cls)
+
+        best_samples = {}
+        shard_indices = set()
+        num_shards = set()
+        self.curves = LeadTimeCurves()
+        for shard_file in shard_files:
+            with open(shard_file, "r") as fp:
+                shard = json.load(fp)
+            shard_indices.add(shard["shard_index"])
+            num_shards.add(shard["num_shards"])
+            best_samples.update(shard["cubes"])
+            if "lead_time" in shard:
+                self.curves.merge(shard["lead_time"])
+
+        assert(len(num_shards) == 1),"Shards were computed with different numbers of shards."
+        num_shards = num_shards.pop()
+        if shard_indices != set(range(num_shards)):
+            warnings.warn(f"Merging incomplete set of shards, missing shards {sorted(set(range(num_shards)) - shard_indices)}.")
+
+        self.data = {cube: [best_samples[cube]] for cube in sorted(best_samples, key = lambda cube: Path(best_samples[cube]["targ_filepath"]))}
+        return self
+
+    @classmethod
+    def merge_shards(cls, shard_files: Sequence[str], ens_output_file: Optional[str] = None, n_boot: Optional[int] = None, bootstrap_output_file: Optional[str] = None, lead_time_output_file: Optional[str] = None) -> Tuple[float, float, float, float, float]:
+        """Combine partial results from `EarthNetScore.save_shard` and calculate the EarthNetScore
+
+        The result is identical to the one of a single run over all shards.
+
+        Args:
+            shard_files (Sequence[str]): Filepaths of the saved shards
+            ens_output_file (Optional[str], optional): Output filepath for EarthNetScore, recommended to end with .json. Defaults to None.
+            n_boot (Optional[int], optional): If given, also computes bootstrap confidence intervals with this many replicates, see `EarthNetScore.bootstrap`. Defaults to None.
+            bootstrap_output_file (Optional[str], optional): Output filepath for the confidence intervals, recommended to end with .json. Defaults to None.
+            lead_time_output_file (Optional[str], optional): Output filepath for the merged lead time curves, recommended to end with .json. Defaults to None.
+
+        Returns:
+            Tuple[float, float, float, float, float]: ens, mad, ols, emd, ssim
+        """        
+        self = cls.from_shards(shard_files)
+
+        scores = self.summarize(output_file = ens_output_file)
+        if n_boot is not None:
+            self.bootstrap(n_boot = n_boot, output_file = bootstrap_output_file)
+        if lead_time_output_file is not None:
+            self.save_lead_time_curves(lead_time_output_file)
+        return scores
     
     def summarize(self, output_file: Optional[str] = None) -> Tuple[float, float, float, float, float]:
         """Calculate EarthNetScore from subscores and optionally save to file as JSON
@@ -472,6 +1358,9 @@ class EarthNetScore:
         Returns:
             Tuple[float, float, float, float, float]: ens, mad, ols, emd, ssim
         """        
+        quarantine = getattr(self, "quarantine", [])
+        assert(len(self.data) > 0),"No cubes were scored." + (f" All {len(quarantine)} cubes were quarantined:\n" + "\n".join(f"{cube['pred_filepath']}: {cube['error']}" for cube in quarantine) if len(quarantine) > 0 else "")
+
         print("Calculating Earth Net Score...")
         scores = []
         for cube in tqdm(self.data):
@@ -531,27 +1420,161 @@ class EarthNetScore:
         
         return samples[min_idx]
 
+    def subscores(self) -> Tuple[Sequence[str], np.ndarray]:
+        """Subscores of the best prediction for every target cube as array
+
+        Returns:
+            Tuple[Sequence[str], np.ndarray]: cubenames, array of shape cubes x 4 with MAD, OLS, EMD, SSIM, missing subscores are NaN
+        """        
+        cubes = list(self.data)
+        scores = []
+        for cube in cubes:
+            best_sample = self.__get_best_sample(self.data[cube])
+            scores.append([best_sample["MAD"],best_sample["OLS"],best_sample["EMD"],best_sample["SSIM"]])
+        return cubes, np.array(scores, dtype = np.float64).reshape(-1, 4)
+
+    def bootstrap(self, n_boot: int = 10000, alpha: float = 0.05, seed: Optional[int] = None, output_file: Optional[str] = None) -> dict:
+        """Bootstrap confidence intervals of the EarthNetScore and its subscores, resampling target cubes
+
+        Every replicate draws the best-sample subscores of as many cubes as were scored, with replacement, and recomputes the mean subscores and their harmonic mean like `EarthNetScore.summarize`.
+
+        Args:
+            n_boot (int, optional): Number of bootstrap replicates. Defaults to 10000.
+            alpha (float, optional): The intervals have coverage 1 - alpha. Defaults to 0.05.
+            seed (Optional[int], optional): Random seed. Defaults to None.
+            output_file (Optional[str], optional): If not None, saves the intervals to this path, recommended to end with .json. Defaults to None.
+
+        Returns:
+            dict: {score name: {"estimate", "lower", "upper"}} for "EarthNetScore" and the four subscores
+        """        
+        _, scores = self.subscores()
+        means = _bootstrap_means([scores], n_boot, seed = seed)[0]
+        replicates = np.concatenate([_harmonic_means(means)[:, np.newaxis], means], axis = 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            mean_scores = np.nanmean(scores, axis = 0)
+        estimates = [_harmonic_means(mean_scores)] + mean_scores.tolist()
+
+        intervals = {}
+        for i, name in enumerate(["EarthNetScore"] + SUBSCORE_NAMES):
+            lower, upper = _interval(replicates[:, i], alpha)
+            intervals[name] = {"estimate": float(estimates[i]), "lower": lower, "upper": upper}
+            print(f"{name}: {intervals[name]['estimate']:.4f} [{lower:.4f}, {upper:.4f}]")
+
+        if output_file is not None:
+            Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(output_file, "w") as fp:
+                json.dump({"n_boot": n_boot, "alpha": alpha, "n_cubes": scores.shape[0], "intervals": intervals}, fp)
+        return intervals
+
+    @classmethod
+    def compare(cls, scores_a, scores_b, n_boot: int = 10000, alpha: float = 0.05, seed: Optional[int] = None, output_file: Optional[str] = None) -> dict:
+        """Paired bootstrap comparison of two experiments scored on the same targets
+
+        Both experiments are resampled with the same cubes in every replicate. Only cubes scored in both experiments are used. The p-value is two-sided, for the null hypothesis of no difference.
+
+        Args:
+            scores_a (Union[EarthNetScore, Sequence[str]]): Computed EarthNetScore or shard files of experiment A
+            scores_b (Union[EarthNetScore, Sequence[str]]): Computed EarthNetScore or shard files of experiment B
+            n_boot (int, optional): Number of bootstrap replicates. Defaults to 10000.
+            alpha (float, optional): The intervals have coverage 1 - alpha. Defaults to 0.05.
+            seed (Optional[int], optional): Random seed. Defaults to None.
+            output_file (Optional[str], optional): If not None, saves the comparison to this path, recommended to end with .json. Defaults to None.
+
+        Returns:
+            dict: {score name: {"a", "b", "difference", "lower", "upper", "p_value"}} for "EarthNetScore" and the four subscores, the difference is a - b
+        """        
+        if not isinstance(scores_a, cls):
+            scores_a = cls.from_shards(scores_a)
+        if not isinstance(scores_b, cls):
+            scores_b = cls.from_shards(scores_b)
+        cubes_a, subscores_a = scores_a.subscores()
+        cubes_b, subscores_b = scores_b.subscores()
+
+        common = sorted(set(cubes_a) & set(cubes_b))
+        assert(len(common) > 0),"The experiments have no scored target cubes in common."
+        if len(common) < max(len(cubes_a), len(cubes_b)):
+            warnings.warn(f"Comparing only the {len(common)} target cubes scored in both experiments.")
+        idx_a = {cube: i for i, cube in enumerate(cubes_a)}
+        idx_b = {cube: i for i, cube in enumerate(cubes_b)}
+        subscores_a = subscores_a[[idx_a[cube] for cube in common]]
+        subscores_b = subscores_b[[idx_b[cube] for cube in common]]
+
+        means_a, means_b = _bootstrap_means([subscores_a, subscores_b], n_boot, seed = seed)
+        replicates_a = np.concatenate([_harmonic_means(means_a)[:, np.newaxis], means_a], axis = 1)
+        replicates_b = np.concatenate([_harmonic_means(means_b)[:, np.newaxis], means_b], axis = 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            mean_a, mean_b = np.nanmean(subscores_a, axis = 0), np.nanmean(subscores_b, axis = 0)
+        estimates_a = [_harmonic_means(mean_a)] + mean_a.tolist()
+        estimates_b = [_harmonic_means(mean_b)] + mean_b.tolist()
+
+        comparison = {}
+        for i, name in enumerate(["EarthNetScore"] + SUBSCORE_NAMES):
+            diffs = replicates_a[:, i] - replicates_b[:, i]
+            diffs = diffs[~np.isnan(diffs)]
+            lower, upper = _interval(diffs, alpha) if len(diffs) > 0 else (np.nan, np.nan)
+            p_value = min(1., 2 * min((diffs <= 0).mean(), (diffs >= 0).mean())) if len(diffs) > 0 else np.nan
+            comparison[name] = {"a": float(estimates_a[i]), "b": float(estimates_b[i]), "difference": float(estimates_a[i] - estimates_b[i]), "lower": lower, "upper": upper, "p_value": float(p_value)}
+            print(f"{name}: A {comparison[name]['a']:.4f}\t B {comparison[name]['b']:.4f}\t A - B {comparison[name]['difference']:.4f} [{lower:.4f}, {upper:.4f}]\t p = {p_value:.4f}")
+
+        if output_file is not None:
+            Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(output_file, "w") as fp:
+                json.dump({"n_boot": n_boot, "alpha": alpha, "n_cubes": len(common), "comparison": comparison}, fp)
+        return comparison
+
     
     @classmethod
-    def get_ENS(cls, pred_dir: str, targ_dir: str, n_workers: Optional[int] = -1, data_output_file: Optional[str] = None, ens_output_file: Optional[str] = None):
+    def get_ENS(cls, pred_dir: str, targ_dir: str, n_workers: Optional[int] = -1, data_output_file: Optional[str] = None, ens_output_file: Optional[str] = None, shard_index: Optional[int] = None, num_shards: Optional[int] = None, shard_output_file: Optional[str] = None, robust: bool = False, timeout: Optional[float] = None, quarantine_output_file: Optional[str] = None, schedule: str = "cost", threads_per_worker: Optional[int] = None, pin_cpus: bool = False, n_boot: Optional[int] = None, bootstrap_output_file: Optional[str] = None, lead_time_output_file: Optional[str] = None, preflight: bool = True, max_memory: Optional[Union[str, int]] = None):
         """Method to directly compute EarthNetScore
 
+        If `num_shards` is given, only the shard `shard_index` is computed and saved to `shard_output_file`. Combine all shards with `EarthNetScore.merge_shards`.
+
         Args:
             pred_dir (str): Directory with predictions, format is one of {pred_dir/tile/cubename.npz, pred_dir/tile/experiment_cubename.npz}
-            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz}
+            targ_dir (str): Directory with targets, format is one of {targ_dir/target/tile/target_cubename.npz, targ_dir/target/tile/cubename.npz, targ_dir/tile/target_cubename.npz, targ_dir/tile/cubename.npz} or a store written by `earthnet.store.convert_to_store`
             n_workers (Optional[int], optional): Number of workers, if -1 uses all CPUs, if 0 uses no multiprocessing. Defaults to -1.
             data_output_file (Optional[str], optional): Output filepath for subscores and debugging information, recommended to end with .json. Defaults to None.
             ens_output_file (Optional[str], optional): Output filepath for EarthNetScore, recommended to end with .json. Defaults to None.
+            shard_index (Optional[int], optional): Index of the shard to compute. Defaults to None.
+            num_shards (Optional[int], optional): Total number of shards, if None computes all target cubes. Defaults to None.
+            shard_output_file (Optional[str], optional): Output filepath for the partial result of the shard, recommended to end with .json. Required if `num_shards` is given. Defaults to None.
+            robust (bool, optional): If True, cubes that fail to score are quarantined instead of aborting the run. Defaults to False.
+            timeout (Optional[float], optional): Time limit per cube in seconds, only used in robust mode. Defaults to None.
+            quarantine_output_file (Optional[str], optional): Output filepath for the list of quarantined cubes, recommended to end with .json. Defaults to None.
+            schedule (str, optional): Dispatch order of the cubes, one of "cost", "fifo". Defaults to "cost".
+            threads_per_worker (Optional[int], optional): Number of native threads per worker, if None the CPUs are divided among the workers. Defaults to None.
+            pin_cpus (bool, optional): If True, pins every worker to its own set of CPUs. Defaults to False.
+            n_boot (Optional[int], optional): If given, also computes bootstrap confidence intervals with this many replicates, see `EarthNetScore.bootstrap`. Not used for shards. Defaults to None.
+            bootstrap_output_file (Optional[str], optional): Output filepath for the confidence intervals, recommended to end with .json. Defaults to None.
+            lead_time_output_file (Optional[str], optional): Output filepath for the subscores per lead time, recommended to end with .json. If given, EMD is also computed per window of 20 frames for predictions longer than 40 frames, which also goes into shards. Defaults to None.
+            preflight (bool, optional): If True, checks all predictions from their headers before scoring, see `EarthNetScore.get_paths`. Defaults to True.
+            max_memory (Optional[Union[str, int]], optional): Memory budget, e.g. "48GB", limits the number of workers and the dispatch of cubes, see `EarthNetScore.compute_scores`. Defaults to None.
         """        
 
-        self = cls(pred_dir, targ_dir)
+        if num_shards is not None:
+            assert(shard_index is not None and shard_output_file is not None),"Sharded computation needs shard_index and shard_output_file."
+
+        self = cls(pred_dir, targ_dir, preflight = preflight, shard_index = shard_index, num_shards = num_shards)
         
-        self.compute_scores(n_workers = n_workers)
+        self.compute_scores(n_workers = n_workers, robust = robust, timeout = timeout, schedule = schedule, threads_per_worker = threads_per_worker, pin_cpus = pin_cpus, keep_frames = data_output_file is not None, max_memory = max_memory, emd_lead_time = lead_time_output_file is not None)
 
         if data_output_file is not None:
             self.save_scores(output_file = data_output_file)
+
+        if quarantine_output_file is not None:
+            self.save_quarantine(output_file = quarantine_output_file)
+
+        if lead_time_output_file is not None:
+            self.save_lead_time_curves(output_file = lead_time_output_file)
         
-        self.summarize(output_file = ens_output_file)
+        if num_shards is not None:
+            self.save_shard(output_file = shard_output_file)
+        else:
+            self.summarize(output_file = ens_output_file)
+            if n_boot is not None:
+                self.bootstrap(n_boot = n_boot, output_file = bootstrap_output_file)
 
 if __name__=="__main__":
 
@@ -560,12 +1583,42 @@ if __name__=="__main__":
     parser.add_argument('--targ_dir', type = str, help ='Path where targets are saved')
     parser.add_argument('--data_output_file', type = str, help ='Filepath where output data will be saved')
     parser.add_argument('--ens_output_file', type = str, help ='Filepath where resulting EarthNetScore will be saved')
+    parser.add_argument('--shard_index', '--shard-index', type = int, help ='Index of the shard of target cubes to compute')
+    parser.add_argument('--num_shards', '--num-shards', type = int, help ='Total number of shards of target cubes')
+    parser.add_argument('--shard_output_file', type = str, help ='Filepath where the partial result of the shard will be saved')
+    parser.add_argument('--merge', type = str, nargs = '+', help ='Filepaths of computed shards to merge into the EarthNetScore')
+    parser.add_argument('--compare', type = str, nargs = '+', help ='Filepaths of computed shards of a second experiment, compared with the merged shards by a paired bootstrap')
+    parser.add_argument('--lead_time_output_file', type = str, help ='Filepath where the subscores per lead time will be saved')
+    parser.add_argument('--n_boot', type = int, help ='Number of bootstrap replicates for confidence intervals of the EarthNetScore')
+    parser.add_argument('--bootstrap_output_file', type = str, help ='Filepath where the bootstrap confidence intervals or the comparison will be saved')
+    parser.add_argument('--robust', action = 'store_true', help ='Quarantine cubes that fail to score instead of aborting')
+    parser.add_argument('--timeout', type = float, help ='Time limit per cube in seconds in robust mode')
+    parser.add_argument('--quarantine_output_file', type = str, help ='Filepath where the list of quarantined cubes will be saved')
+    parser.add_argument('--n_workers', type = int, default = -1, help ='Number of worker processes, -1 uses all CPUs, 0 uses no multiprocessing')
+    parser.add_argument('--threads_per_worker', type = int, help ='Number of native (BLAS/OpenMP) threads per worker process')
+    parser.add_argument('--pin_cpus', action = 'store_true', help ='Pin every worker process to its own set of CPUs')
+    parser.add_argument('--benchmark', type = str, nargs = '+', help ='Time scoring with each processes x threads configuration, e.g. 64x1 16x4, instead of computing the EarthNetScore')
+    parser.add_argument('--quick', action = 'store_true', help ='Estimate the EarthNetScore from a stratified subsample of target cubes until the requested precision is reached')
+    parser.add_argument('--precision', type = float, default = 0.005, help ='Half-width of the 95%% interval at which the quick estimate stops')
+    parser.add_argument('--pixel_fraction', type = float, default = 0.1, help ='Fraction of pixels used for OLS and EMD in the quick estimate')
+    parser.add_argument('--max_memory', type = str, help ='Memory budget like 48GB, limits the number of workers and the dispatch of cubes')
+    parser.add_argument('--no_preflight', action = 'store_true', help ='Skip checking all predictions against their targets from the array headers before scoring')
+    parser.add_argument('--schedule', type = str, default = "cost", choices = ["cost", "fifo"], help ='Dispatch order of the cubes: most expensive first in batches, or one by one in filepath order')
 
     args = parser.parse_args()
 
     start = time.time()
 
-    EarthNetScore.get_ENS(args.pred_dir, args.targ_dir, data_output_file = args.data_output_file, ens_output_file = args.ens_output_file)
+    if args.merge is not None and args.compare is not None:
+        EarthNetScore.compare(args.merge, args.compare, n_boot = args.n_boot or 10000, output_file = args.bootstrap_output_file)
+    elif args.benchmark is not None:
+        EarthNetScore(args.pred_dir, args.targ_dir, preflight = not args.no_preflight).benchmark_setups(args.benchmark, pin_cpus = args.pin_cpus, schedule = args.schedule, output_file = args.ens_output_file)
+    elif args.quick:
+        EarthNetScore(args.pred_dir, args.targ_dir, preflight = not args.no_preflight).quick_scores(precision = args.precision, pixel_fraction = args.pixel_fraction, n_workers = args.n_workers, threads_per_worker = args.threads_per_worker, output_file = args.ens_output_file)
+    elif args.merge is not None:
+        EarthNetScore.merge_shards(args.merge, ens_output_file = args.ens_output_file, n_boot = args.n_boot, bootstrap_output_file = args.bootstrap_output_file, lead_time_output_file = args.lead_time_output_file)
+    else:
+        EarthNetScore.get_ENS(args.pred_dir, args.targ_dir, n_workers = args.n_workers, data_output_file = args.data_output_file, ens_output_file = args.ens_output_file, shard_index = args.shard_index, num_shards = args.num_shards, shard_output_file = args.shard_output_file, robust = args.robust, timeout = args.timeout, quarantine_output_file = args.quarantine_output_file, schedule = args.schedule, threads_per_worker = args.threads_per_worker, pin_cpus = args.pin_cpus, n_boot = args.n_boot, bootstrap_output_file = args.bootstrap_output_file, lead_time_output_file = args.lead_time_output_file, preflight = not args.no_preflight, max_memory = args.max_memory)
 
     end = time.time()
 
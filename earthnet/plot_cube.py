@@ -1,15 +1,17 @@
 """Tools for plotting Cubes
 """
 
-import matplotlib.pyplot as plt 
 import numpy as np
-import matplotlib.colors as clr
-import matplotlib.cm as cm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import copy
-import pandas as pd
+import functools
 
 from pathlib import Path
+from collections.abc import Mapping
+
+if __name__ == "__main__":
+    from store import load_cube
+else:
+    from earthnet.store import load_cube
 
 LANDCOVER_CLASSES = {
     0: "Clouds",
@@ -31,7 +33,27 @@ LANDCOVER_CLASSES = {
 
 LC_CONVERTED = {k: (i,LANDCOVER_CLASSES[k]) for i, k in enumerate(sorted(list(LANDCOVER_CLASSES.keys())))}
 LC_CONVERTED_CLASSES = {v[0]: v[1] for k, v in LC_CONVERTED.items()}
-lc_convert = np.vectorize(lambda x: LC_CONVERTED[x][0])
+LC_LUT = np.full(256, LC_CONVERTED[255][0], dtype = np.uint8)
+for k, v in LC_CONVERTED.items():
+    LC_LUT[k] = v[0]
+VEGETATION_CLASSES = [k for k in LANDCOVER_CLASSES if 63 < k < 105]
+
+
+def lc_convert(landcover):
+    """
+    
+    Convert S2GLC landcover codes to consecutive class indices (keys of `LC_CONVERTED_CLASSES`) by table lookup. Unknown codes map to "No data".
+
+    Args:
+        landcover (np.ndarray): S2GLC landcover codes
+
+    Returns:
+        np.ndarray: uint8 class indices of the same shape
+    """    
+    landcover = np.asarray(landcover)
+    if landcover.dtype != np.uint8:
+        landcover = np.clip(np.nan_to_num(landcover, nan = 255), 0, 255).astype(np.uint8)
+    return LC_LUT[landcover]
 
 COLORS = np.array(
     [[255,255,255],
@@ -51,59 +73,115 @@ COLORS = np.array(
     [255,255,255]]
 )
 
+NDVI_COLORS = ["#cbbe9a","#fffde4","#bccea5","#66985b","#2e6a32","#123f1e","#0e371a","#01140f","#000d0a"]
+
+RGB_RED = np.array([255, 0, 0], dtype = np.uint8)
+RGB_CLOUD = np.array([0, 0, 25], dtype = np.uint8)
+
+
+@functools.lru_cache(maxsize = None)
+def get_colormap(colormap = "ndvi"):
+    """Cached colormap, NaN and masked values are shown in red
+
+    Args:
+        colormap (str, optional): "ndvi" or the name of a matplotlib colormap. Defaults to "ndvi".
+
+    Returns:
+        matplotlib.colors.Colormap: Colormap, do not modify
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as clr
+
+    cmap = clr.LinearSegmentedColormap.from_list('ndvi', NDVI_COLORS, N=256) if colormap == "ndvi" else copy.copy(plt.get_cmap(colormap))
+    cmap.set_bad(color='red')
+    return cmap
+
+
+@functools.lru_cache(maxsize = None)
+def get_lut(colormap = "ndvi"):
+    """Cached 256-entry uint8 RGB lookup table of a colormap
+
+    Args:
+        colormap (str, optional): "ndvi" or the name of a matplotlib colormap. Defaults to "ndvi".
+
+    Returns:
+        np.ndarray: read-only lookup table of shape 256 x 3
+    """
+    lut = get_colormap(colormap)((np.arange(256) + 0.5) / 256, bytes = True)[:, :3]
+    lut.flags.writeable = False
+    return lut
+
+
 def colorize(data, colormap = "ndvi", mask_red = None, mask_blue = None):
-    t,h,w = data.shape
-    in_data = data.reshape(-1)
+    """Map values in [0, 1] to uint8 RGB colors by quantizing them and indexing a lookup table
+
+    Values below 0 or above 1 get the lowest or highest color, as in matplotlib colormaps.
+
+    Args:
+        data (np.ndarray): Values of shape t x h x w
+        colormap (str, optional): "ndvi" or the name of a matplotlib colormap. Defaults to "ndvi".
+        mask_red (np.ndarray, optional): Pixels to show in red, as are NaN values. Defaults to None.
+        mask_blue (np.ndarray, optional): Pixels to keep, all others are shown in dark blue (e.g. clouds). Defaults to None.
+
+    Returns:
+        np.ndarray: uint8 RGB array of shape t x h x w x 3
+    """
+    data = np.asarray(data)
+    if data.dtype.kind != "f":
+        data = data.astype(np.float64)
+
+    with np.errstate(invalid = "ignore"):
+        idxs = np.clip(data * 256, 0, 255).astype(np.uint8)
+    out = get_lut(colormap)[idxs]
+
+    red = np.isnan(data)
     if mask_red is not None:
-        in_data = np.ma.array(in_data, mask = mask_red.reshape(-1))  
+        red |= np.asarray(mask_red, dtype = bool).reshape(data.shape)
+    out[red] = RGB_RED
 
-    cmap = clr.LinearSegmentedColormap.from_list('ndvi', ["#cbbe9a","#fffde4","#bccea5","#66985b","#2e6a32","#123f1e","#0e371a","#01140f","#000d0a"], N=256) if colormap == "ndvi" else copy.copy(plt.get_cmap(colormap))
-    cmap.set_bad(color='red')
+    if mask_blue is not None:
+        out[~np.asarray(mask_blue, dtype = bool).reshape(data.shape)] = RGB_CLOUD
 
-    if mask_blue is None:
-        return cmap(in_data)[:,:3].reshape((t,h,w,3))
-    else:
-        out = cmap(in_data)[:,:3].reshape((t,h,w,3))
-        return np.stack([np.where(mask_blue, out[:,:,:,0],np.zeros_like(out[:,:,:,0])), 
-                            np.where(mask_blue, out[:,:,:,1],np.zeros_like(out[:,:,:,1])), 
-                            np.where(mask_blue, out[:,:,:,2],0.1*np.ones_like(out[:,:,:,2]))], axis = -1)
+    return out
 
 
 def gallery(array, ncols=10):
     nindex, height, width, intensity = array.shape
-    padded = np.zeros((nindex, height + 2, width + 2, intensity))
-    padded[:,1:-1,1:-1,:] = array
-    nindex, height, width, intensity = padded.shape
     nrows = nindex//ncols
     assert nindex == nrows*ncols
-    result = (padded.reshape(nrows, ncols, height, width, intensity)
-              .swapaxes(1,2)
-              .reshape(height*nrows, width*ncols, intensity))
+    result = np.zeros((nrows*(height + 2), ncols*(width + 2), intensity), dtype = array.dtype)
+    result.reshape(nrows, height + 2, ncols, width + 2, intensity)[:,1:-1,:,1:-1,:] = array.reshape(nrows, ncols, height, width, intensity).swapaxes(1,2)
     return result
 
 
-def cube_gallery(cube, variable = "rgb", vegetation_mask = None, cloud_mask = True, save_path = None):
+def _new_figure(pyplot = True, **kwargs):
+    """Figure managed by pyplot, or a standalone Figure if `pyplot` is False
     """
+    if pyplot:
+        import matplotlib.pyplot as plt
+        return plt.figure(**kwargs)
+    from matplotlib.figure import Figure
+    return Figure(**kwargs)
 
-    Plots a gallery view from a given Cube.
+
+def cube_frames(cube, variable = "rgb"):
+    """
+
+    Data of a given Cube needed for plotting a variable, with time as first axis.
 
     Args:
-        cube (np.ndarray): Numpy Array or loaded NPZ of Cube or path to Cube.
+        cube (np.ndarray): Numpy Array or loaded NPZ of Cube or path to Cube, which can also be the virtual path `store_dir/cubename.npz` into a store.
         variable (str, optional):  One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
-        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
-        cloud_mask (bool, optional): If True tries to use the last channel from the cubes sat imgs as blue cloud mask, 1 where no clouds, 0 where there are clouds. Defaults to True.
-        save_path (str, optional): If given, saves PNG to this path. Defaults to None.
 
     Returns:
-        plt.Figure: Matplotlib Figure
+        np.ndarray: array of shape t x h x w x c, a view if possible
     """    
-
     assert(variable in ["rgb", "ndvi", "rr","pp","tg","tn","tx"])
 
     if isinstance(cube, str) or isinstance(cube, Path):
-        cube = np.load(cube)
+        cube = load_cube(cube)
 
-    if isinstance(cube, np.lib.npyio.NpzFile):
+    if isinstance(cube, (np.lib.npyio.NpzFile, Mapping)):
         if variable in ["rgb","ndvi"]:
             if "highresdynamic" in cube:
                 data = cube["highresdynamic"]
@@ -116,6 +194,8 @@ def cube_gallery(cube, variable = "rgb", vegetation_mask = None, cloud_mask = Tr
         elif variable in ["rr","pp","tg","tn","tx"]:
             if "mesodynamic" in cube:
                 data = cube["mesodynamic"]
+                if data.shape[:2] == (1, 1): # compact EarthNet2021x conversion, see `earthnet.download_v2.expand_meso`
+                    data = np.broadcast_to(data, (80, 80) + data.shape[2:])
             else:
                 raise ValueError("data does not contain E-OBS.")
     elif isinstance(cube, np.ndarray):
@@ -129,18 +209,36 @@ def cube_gallery(cube, variable = "rgb", vegetation_mask = None, cloud_mask = Tr
         t_idx = [i for i,j in enumerate(data.shape) if j == max([j for j in data.shape if j != hw])][0]
         data = np.transpose(data,(t_idx,hw_idxs[0],hw_idxs[1],c_idx))
 
+    return data
+
+
+def colorize_frames(data, variable = "rgb", vegetation_mask = None, cloud_mask = True):
+    """
+
+    Colorize frames of a Cube, as returned by `cube_frames`.
+
+    Args:
+        data (np.ndarray): Frames of shape t x h x w x c
+        variable (str, optional):  One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
+        cloud_mask (bool, optional): If True tries to use the last channel from the cubes sat imgs as blue cloud mask, 1 where no clouds, 0 where there are clouds. Defaults to True.
+
+    Returns:
+        np.ndarray: uint8 RGB frames of shape t x h x w x 3
+    """    
+    hw = data.shape[1]
+
     if variable == "rgb":
-        targ = np.stack([data[:,:,:,2],data[:,:,:,1],data[:,:,:,0]], axis = -1)
-        targ[targ<0] = 0
-        targ[targ>0.5] = 0.5
-        targ = 2*targ
+        bgr = data[:,:,:,:3]
+        nan = np.isnan(bgr)[:,:,:,::-1]
+        with np.errstate(invalid = "ignore"):
+            targ = (np.clip(bgr, 0, 0.5) * 510).astype(np.uint8)[:,:,:,::-1]
         if data.shape[-1] > 4 and cloud_mask:
-            mask = data[:,:,:,-1]
-            zeros = np.zeros_like(targ)
-            zeros[:,:,:,2] = 0.1
-            targ = np.where(np.stack([mask]*3,-1).astype(np.uint8) | np.isnan(targ).astype(np.uint8), zeros, targ)
+            with np.errstate(invalid = "ignore"):
+                mask = data[:,:,:,-1].astype(np.uint8).astype(bool)
+            targ = np.where(mask[:,:,:,np.newaxis] | nan, RGB_CLOUD, targ)
         else:
-            targ[np.isnan(targ)] = 0
+            targ[nan] = 0
 
     elif variable == "ndvi":
         if data.shape[-1] == 1:
@@ -174,29 +272,94 @@ def cube_gallery(cube, variable = "rgb", vegetation_mask = None, cloud_mask = Tr
         targ = data[:,:,:, 2 if variable == "tg" else 3 if variable == "tn" else 4]
         targ = colorize(targ, colormap = 'coolwarm', mask_red = np.isnan(targ))
 
-    grid = gallery(targ)
+    return targ
+
+
+def gallery_image(cube, variable = "rgb", vegetation_mask = None, cloud_mask = True):
+    """
+
+    Gallery view of a given Cube as uint8 RGB image, without any plotting.
+
+    Args:
+        cube (np.ndarray): Numpy Array or loaded NPZ of Cube or path to Cube, which can also be the virtual path `store_dir/cubename.npz` into a store.
+        variable (str, optional):  One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
+        cloud_mask (bool, optional): If True tries to use the last channel from the cubes sat imgs as blue cloud mask, 1 where no clouds, 0 where there are clouds. Defaults to True.
+
+    Returns:
+        np.ndarray: uint8 RGB image, 10 frames per row
+    """    
+    return gallery(colorize_frames(cube_frames(cube, variable), variable = variable, vegetation_mask = vegetation_mask, cloud_mask = cloud_mask))
+
+
+def cube_gallery(cube, variable = "rgb", vegetation_mask = None, cloud_mask = True, save_path = None, pyplot = True):
+    """
 
-    fig = plt.figure(dpi = 300)
-    plt.imshow(grid)
-    plt.axis('off')
+    Plots a gallery view from a given Cube.
+
+    Args:
+        cube (np.ndarray): Numpy Array or loaded NPZ of Cube or path to Cube, which can also be the virtual path `store_dir/cubename.npz` into a store.
+        variable (str, optional):  One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
+        cloud_mask (bool, optional): If True tries to use the last channel from the cubes sat imgs as blue cloud mask, 1 where no clouds, 0 where there are clouds. Defaults to True.
+        save_path (str, optional): If given, saves PNG to this path. Defaults to None.
+        pyplot (bool, optional): If False, creates a standalone Figure that is not tracked by pyplot and is freed once it is no longer referenced, use this when plotting many cubes. Defaults to True.
+
+    Returns:
+        plt.Figure: Matplotlib Figure
+    """    
+    import matplotlib.colors as clr
+    import matplotlib.cm as cm
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+    grid = gallery_image(cube, variable = variable, vegetation_mask = vegetation_mask, cloud_mask = cloud_mask)
+
+    fig = _new_figure(pyplot, dpi = 300)
+    ax = fig.add_subplot()
+    ax.imshow(grid)
+    ax.axis('off')
     if variable != "rgb":
         colormap = {"ndvi": "ndvi", "rr": "Blues", "pp": "rainbow", "tg": "coolwarm", "tn": "coolwarm", "tx": "coolwarm"}[variable]
-        cmap = clr.LinearSegmentedColormap.from_list('ndvi', ["#cbbe9a","#fffde4","#bccea5","#66985b","#2e6a32","#123f1e","#0e371a","#01140f","#000d0a"], N=256) if colormap == "ndvi" else copy.copy(plt.get_cmap(colormap))
-        divider = make_axes_locatable(plt.gca())
+        cmap = get_colormap(colormap)
+        divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
         vmin, vmax = {"ndvi": (0,1), "rr": (0,50), "pp": (900,1100), "tg": (-50,50), "tn": (-50,50), "tx": (-50,50)}[variable]
         label = {"ndvi": "NDVI", "rr": "Precipitation in mm/d", "pp": "Sea-level pressure in hPa", "tg": "Mean temperature in °C", "tn": "Minimum Temperature in °C", "tx": "Maximum Temperature in °C"}[variable]
-        plt.colorbar(cm.ScalarMappable(norm = clr.Normalize(vmin = vmin, vmax = vmax), cmap = cmap), cax = cax, label = label)
+        fig.colorbar(cm.ScalarMappable(norm = clr.Normalize(vmin = vmin, vmax = vmax), cmap = cmap), cax = cax, label = label)
 
     if save_path is not None:
         save_path = Path(save_path)
         save_path.parents[0].mkdir(parents = True, exist_ok = True)
-        plt.savefig(save_path, dpi = 300, bbox_inches='tight', transparent=True)
+        fig.savefig(save_path, dpi = 300, bbox_inches='tight', transparent=True)
 
     return fig
 
 
-def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
+def sample_points(landcover = None, n = 8):
+    """
+
+    Random pixel coordinates for timeseries plots, stratified by landcover. Picks one random pixel of every vegetation class present, fills up with random pixels.
+
+    Args:
+        landcover (np.ndarray, optional): S2GLC landcover of shape 128 x 128. If None, all pixels are random. Defaults to None.
+        n (int, optional): Number of pixels. Defaults to 8.
+
+    Returns:
+        np.ndarray: array of shape n x 2 with pixel indices (row, column), vegetation pixels first, sorted by class
+    """    
+    if landcover is None:
+        coords = np.empty((0, 2), dtype = np.int64)
+    else:
+        landcover = np.asarray(landcover).reshape(-1)
+        idxs = np.random.permutation(np.flatnonzero((landcover > 63) & (landcover < 105)))
+        _, first = np.unique(landcover[idxs], return_index = True)
+        coords = np.stack(np.unravel_index(idxs[first[:n]], (128, 128)), axis = -1)
+    if coords.shape[0] < n:
+        coords = np.concatenate([coords, np.stack(np.unravel_index(np.random.choice(128*128, n - coords.shape[0]), (128, 128)), axis = -1)], axis = 0)
+    return coords
+
+
+def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None, pyplot = True, dpi = 450, fig = None):
     """
 
     Plots a timeseries view of a predicted cube vs its respective target.
@@ -206,27 +369,32 @@ def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
         targ (str, Path, np.lib.npyio.NpzFile, np.ndarray): Cube with target
         vegetation_mask (str, Path, np.lib.npyio.NpzFile, np.ndarray, optional): Cube with S2GLC Landcover mask. Defaults to None.
         save_path (str, optional): If given, saves PNG to this path. Defaults to None.
+        pyplot (bool, optional): If False, creates a standalone Figure that is not tracked by pyplot and is freed once it is no longer referenced, use this when plotting many cubes. Defaults to True.
+        dpi (int, optional): Resolution of the figure and the saved PNG. Defaults to 450.
+        fig (plt.Figure, optional): If given, this figure is cleared and drawn into instead of creating a new one, e.g. to render many pages with one figure. Defaults to None.
 
     Returns:
         plt.Figure: Matplotlib Figure
     """    
+    import matplotlib.colors as clr
+
     if isinstance(pred, str) or isinstance(pred, Path):
-        pred_cube = np.load(pred)
+        pred_cube = load_cube(pred)
         pred_ndvi = pred_cube["highresdynamic"].astype(np.float32)
-    elif isinstance(pred, np.lib.npyio.NpzFile):
+    elif isinstance(pred, (np.lib.npyio.NpzFile, Mapping)):
         pred_cube = pred
         pred_ndvi = pred_cube["highresdynamic"].astype(np.float32)
     else:
         assert(isinstance(pred, np.ndarray))
-        pred_ndvi = pred_ndvi
+        pred_ndvi = pred
     
     if pred_ndvi.shape[-2] > 1:
         pred_ndvi = (pred_ndvi[:,:,3,:] - pred_ndvi[:,:,2,:]) / (pred_ndvi[:,:,2,:] + pred_ndvi[:,:,3,:] + 1e-6)
     
     if isinstance(targ, str) or isinstance(targ, Path):
-        targ_cube = np.load(targ)
+        targ_cube = load_cube(targ)
         targ_data = targ_cube["highresdynamic"].astype(np.float32)
-    elif isinstance(targ, np.lib.npyio.NpzFile):
+    elif isinstance(targ, (np.lib.npyio.NpzFile, Mapping)):
         targ_cube = targ
         targ_data = targ_cube["highresdynamic"].astype(np.float32)
     else:
@@ -247,19 +415,20 @@ def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
             landcover = vegetation_mask["landcover"]
         else:
             landcover = vegetation_mask
-        temp = np.concatenate([landcover.reshape((1,128,128)), np.indices((128,128))], axis = 0)
-        df = pd.DataFrame(temp.reshape(3,-1).T, columns = ["lc", "x", "y"])
-        coords = df[(df.lc > 63) & (df.lc < 105)].groupby('lc').agg(np.random.choice).to_numpy()
-        if coords.shape[0] < 8:
-            coords = np.concatenate([coords, np.indices((128,128)).reshape(2,-1).T[np.random.choice(128*128, 8-coords.shape[0])]], axis = 0)
+        landcover = landcover.reshape((128,128))
+        coords = sample_points(landcover)
     else:
-        coords = np.indices((128,128)).reshape(2,-1).T[np.random.choice(128*128, 8)]
+        coords = sample_points()
 
-    fig, axs = plt.subplots(4,3, dpi = 450)
+    if fig is None:
+        fig = _new_figure(pyplot, dpi = dpi)
+    else:
+        fig.clear()
+        fig.set_dpi(dpi)
+    axs = fig.subplots(4,3)
     for idx, ax in enumerate(axs.reshape(-1)): 
         if idx == 0:
-            cmap = clr.LinearSegmentedColormap.from_list('ndvi', ["#cbbe9a","#fffde4","#bccea5","#66985b","#2e6a32","#123f1e","#0e371a","#01140f","#000d0a"], N=256)
-            cmap.set_bad(color='red')
+            cmap = get_colormap("ndvi")
             ndvi = ax.imshow(targ_ndvi.mean(-1), cmap = cmap, vmin = 0, vmax = 1)
             ncbar = fig.colorbar(ndvi, ax=axs[0,0])
             ncbar.ax.tick_params(labelsize=6)
@@ -285,7 +454,7 @@ def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
                 cmap = clr.ListedColormap(COLORS/255.)
                 bounds = [i-0.5 for i in range(16)]
                 norm = clr.BoundaryNorm(bounds, cmap.N)
-                lac = ax.imshow(lc_convert(landcover.reshape((128,128))), cmap = cmap, norm = norm)
+                lac = ax.imshow(lc_convert(landcover), cmap = cmap, norm = norm)
                 lcbar = fig.colorbar(lac, ax=axs[0,2], ticks=sorted(list(LC_CONVERTED_CLASSES.keys())))
                 lcbar.ax.set_yticklabels([LC_CONVERTED_CLASSES[i] for i in sorted(list(LC_CONVERTED_CLASSES.keys()))], fontsize = 3)
                 lcbar.ax.tick_params(labelsize=4)
@@ -312,11 +481,11 @@ def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
             if vegetation_mask is None:
                 ax.set_title(f"NDVI Point {i+1}", fontsize = 6, loc = "left")
             else:
-                lc = LANDCOVER_CLASSES[int(vegetation_mask["landcover"].reshape((128,128))[x,y])]
+                lc = LANDCOVER_CLASSES.get(int(landcover[x,y]), "No data")
                 ax.set_title(f"NDVI Point {i+1},\n{lc}", fontsize = 6, loc = "left")
             ax.tick_params(labelsize = 6)
 
-    plt.subplots_adjust(wspace=0.4, hspace=0.8)
+    fig.subplots_adjust(wspace=0.4, hspace=0.8)
 
     p00 = axs[0, 0].get_position()
     p01 = axs[0, 1].get_position()
@@ -350,7 +519,7 @@ def cube_ndvi_timeseries(pred, targ, vegetation_mask = None, save_path = None):
     if save_path is not None:
         save_path = Path(save_path)
         save_path.parents[0].mkdir(parents = True, exist_ok = True)
-        plt.savefig(save_path, dpi = 450, bbox_inches='tight', transparent=True)
+        fig.savefig(save_path, dpi = dpi, bbox_inches='tight', transparent=True)
 
     return fig
 
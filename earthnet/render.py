@@ -0,0 +1,511 @@
+"""Batch rendering of galleries, timeseries plots, animations and reports for many cubes in parallel.
+"""
+from typing import Optional, Sequence, Tuple, Union
+
+import json
+import zlib
+import shutil
+import struct
+import warnings
+import subprocess
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+if __name__ == "__main__":
+    from plot_cube import colorize_frames, cube_frames, _new_figure, gallery_image, cube_gallery, cube_ndvi_timeseries
+    from store import cubename_of, is_store, open_store
+    from parallel_score import _harmonic_means
+else:
+    from earthnet.plot_cube import colorize_frames, cube_frames, _new_figure, gallery_image, cube_gallery, cube_ndvi_timeseries
+    from earthnet.store import cubename_of, is_store, open_store
+    from earthnet.parallel_score import _harmonic_means
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def _png_header(image: np.ndarray) -> bytes:
+    h, w = image.shape[:2]
+    return b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2 if image.ndim == 3 else 0, 0, 0, 0))
+
+
+def _png_data(image: np.ndarray, level: int = 6) -> bytes:
+    """zlib compressed scanlines of an uint8 image, each with filter type 0
+    """
+    image = np.ascontiguousarray(image, dtype = np.uint8)
+    h = image.shape[0]
+    raw = np.empty((h, 1 + image[0].size), dtype = np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = image.reshape(h, -1)
+    return zlib.compress(raw.tobytes(), level)
+
+
+def write_png(path: Union[str, Path], image: np.ndarray, level: int = 6):
+    """Write an uint8 RGB or grayscale image as PNG, without matplotlib or PIL
+
+    Args:
+        path (Union[str, Path]): Output filepath
+        image (np.ndarray): uint8 image of shape h x w x 3 or h x w
+        level (int, optional): zlib compression level. Defaults to 6.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    with open(path, "wb") as fp:
+        fp.write(_png_header(image))
+        fp.write(_png_chunk(b"IDAT", _png_data(image, level)))
+        fp.write(_png_chunk(b"IEND", b""))
+
+
+class APNGWriter:
+    """Animated PNG writer, frames are compressed and written one at a time
+    """
+    def __init__(self, path: Union[str, Path], n_frames: int, fps: float = 4):
+        """Initialize APNGWriter
+
+        Args:
+            path (Union[str, Path]): Output filepath
+            n_frames (int): Number of frames that will be written
+            fps (float, optional): Frames per second. Defaults to 4.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.fp = open(self.path, "wb")
+        self.n_frames = n_frames
+        self.delay = (int(round(1000 / fps)), 1000)
+        self.sequence = 0
+        self.frame = 0
+
+    def write(self, image: np.ndarray):
+        if self.frame == 0:
+            self.fp.write(_png_header(image))
+            self.fp.write(_png_chunk(b"acTL", struct.pack(">II", self.n_frames, 0)))
+        h, w = image.shape[:2]
+        self.fp.write(_png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, w, h, 0, 0, self.delay[0], self.delay[1], 0, 0)))
+        self.sequence += 1
+        if self.frame == 0:
+            self.fp.write(_png_chunk(b"IDAT", _png_data(image)))
+        else:
+            self.fp.write(_png_chunk(b"fdAT", struct.pack(">I", self.sequence) + _png_data(image)))
+            self.sequence += 1
+        self.frame += 1
+
+    def close(self):
+        if self.frame != self.n_frames:
+            warnings.warn(f"{self.path} declares {self.n_frames} frames, but {self.frame} were written.")
+        self.fp.write(_png_chunk(b"IEND", b""))
+        self.fp.close()
+
+
+class PDFWriter:
+    """Multi-page PDF writer, every page is a single RGB image and written to disk immediately
+    """
+    def __init__(self, path: Union[str, Path], dpi: float = 150):
+        """Initialize PDFWriter
+
+        Args:
+            path (Union[str, Path]): Output filepath
+            dpi (float, optional): Resolution of the page images, determines the page size. Defaults to 150.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.fp = open(self.path, "wb")
+        self.dpi = dpi
+        self.offsets = {}
+        self.pages = []
+        self.fp.write(b"%PDF-1.4\n")
+
+    def _write_object(self, number: int, data: bytes, stream: Optional[bytes] = None):
+        self.offsets[number] = self.fp.tell()
+        self.fp.write(f"{number} 0 obj\n".encode() + data)
+        if stream is not None:
+            self.fp.write(b"\nstream\n" + stream + b"\nendstream")
+        self.fp.write(b"\nendobj\n")
+
+    def write(self, image: np.ndarray):
+        h, w = image.shape[:2]
+        width, height = w * 72 / self.dpi, h * 72 / self.dpi
+        number = 3 + 3 * len(self.pages)
+        content = f"q {width:.2f} 0 0 {height:.2f} 0 0 cm /Im0 Do Q".encode()
+        data = _png_data(image[:, :, :3])
+        self._write_object(number + 2, f"<< /Type /XObject /Subtype /Image /Width {w} /Height {h} /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns {w} >> /Length {len(data)} >>".encode(), data)
+        self._write_object(number + 1, f"<< /Length {len(content)} >>".encode(), content)
+        self._write_object(number, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:.2f} {height:.2f}] /Resources << /XObject << /Im0 {number + 2} 0 R >> >> /Contents {number + 1} 0 R >>".encode())
+        self.pages.append(number)
+
+    def close(self):
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        self._write_object(2, f"<< /Type /Pages /Kids [{' '.join(f'{page} 0 R' for page in self.pages)}] /Count {len(self.pages)} >>".encode())
+        xref = self.fp.tell()
+        size = max(self.offsets) + 1
+        self.fp.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+        self.fp.write("".join(f"{self.offsets[i]:010d} 00000 n \n" for i in range(1, size)).encode())
+        self.fp.write(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+        self.fp.close()
+
+
+class FFmpegWriter:
+    """Video or GIF writer piping raw frames into ffmpeg
+    """
+    def __init__(self, path: Union[str, Path], size: Tuple[int, int], fps: float = 4):
+        """Initialize FFmpegWriter
+
+        Args:
+            path (Union[str, Path]): Output filepath, the format is chosen by ffmpeg from the suffix
+            size (Tuple[int, int]): Height and width of the frames
+            fps (float, optional): Frames per second. Defaults to 4.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        h, w = size
+        cmd = [shutil.which("ffmpeg"), "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{w}x{h}", "-r", str(fps), "-i", "-"]
+        if self.path.suffix != ".gif":
+            cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+        self.proc = subprocess.Popen(cmd + [str(self.path)], stdin = subprocess.PIPE)
+
+    def write(self, image: np.ndarray):
+        self.proc.stdin.write(np.ascontiguousarray(image, dtype = np.uint8).tobytes())
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed writing {self.path}.")
+
+
+class PNGFramesWriter:
+    """Fallback writer saving every frame as a separate PNG into a directory
+    """
+    def __init__(self, path: Union[str, Path]):
+        """Initialize PNGFramesWriter
+
+        Args:
+            path (Union[str, Path]): Output directory
+        """
+        self.path = Path(path)
+        self.frame = 0
+
+    def write(self, image: np.ndarray):
+        write_png(self.path/f"frame_{self.frame:04d}.png", image)
+        self.frame += 1
+
+    def close(self):
+        pass
+
+
+def animation_writer(path: Union[str, Path], n_frames: int, size: Tuple[int, int], fps: float = 4):
+    """Writer for an animation, chosen by the suffix of `path`
+
+    ".png" and ".apng" give an animated PNG. Other suffixes (e.g. ".mp4", ".gif") need ffmpeg, without it the frames are saved as PNGs into the directory `path` without suffix. A path without suffix also gives PNG frames.
+
+    Args:
+        path (Union[str, Path]): Output filepath
+        n_frames (int): Number of frames
+        size (Tuple[int, int]): Height and width of the frames
+        fps (float, optional): Frames per second. Defaults to 4.
+
+    Returns:
+        Union[APNGWriter, FFmpegWriter, PNGFramesWriter]: Writer with methods `write(image)` and `close()` and attribute `path`
+    """
+    path = Path(path)
+    if path.suffix in [".png", ".apng"]:
+        return APNGWriter(path, n_frames, fps = fps)
+    if path.suffix and shutil.which("ffmpeg") is not None:
+        return FFmpegWriter(path, size, fps = fps)
+    if path.suffix:
+        warnings.warn(f"ffmpeg not found, saving frames of {path.name} as PNGs instead.")
+    return PNGFramesWriter(path.with_suffix(""))
+
+
+def _frame_reader(cube, variable: str):
+    """Number of frames and a function reading one frame of shape 1 x h x w x c
+
+    Cubes in a store are read frame by frame, other cubes are loaded once.
+    """
+    if isinstance(cube, (str, Path)) and not Path(cube).is_file() and is_store(Path(cube).parent):
+        store = open_store(Path(cube).parent)
+        key = "highresdynamic" if variable in ["rgb", "ndvi"] else "mesodynamic"
+        n_frames = store.shape(key)[-1]
+        def read(t):
+            frame = np.moveaxis(store.read(key, [Path(cube).name], time = slice(t, t + 1)), -1, 0)[:, 0]
+            if frame.shape[1:3] == (1, 1): # compact EarthNet2021x conversion, see `earthnet.download_v2.expand_meso`
+                frame = np.broadcast_to(frame, (1, 80, 80) + frame.shape[3:])
+            return frame
+        return n_frames, read
+    data = cube_frames(cube, variable)
+    return data.shape[0], lambda t: data[t:t + 1]
+
+
+def export_animation(cube, save_path: str, variable: str = "rgb", pred = None, fps: float = 4, scale: int = 1, vegetation_mask = None, cloud_mask: bool = True) -> Path:
+    """Export the frames of a cube as animation, colorizing and writing one frame at a time
+
+    Memory does not grow with the number of frames. With `pred`, prediction (left) and target (right) are shown side by side, prediction frames are aligned to the last target frames.
+
+    Args:
+        cube (np.ndarray): Target Cube as Numpy Array, loaded NPZ or path, which can also be the virtual path `store_dir/cubename.npz` into a store.
+        save_path (str): Output filepath, see `animation_writer` for the formats
+        variable (str, optional): One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        pred (optional): Predicted Cube as Numpy Array, loaded NPZ or path. Defaults to None.
+        fps (float, optional): Frames per second. Defaults to 4.
+        scale (int, optional): Integer upsampling factor of the frames. Defaults to 1.
+        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
+        cloud_mask (bool, optional): If True uses the last channel of the target as cloud mask. Defaults to True.
+
+    Returns:
+        Path: Path of the written animation or directory of frames
+    """
+    if isinstance(vegetation_mask, (str, Path)):
+        vegetation_mask = np.load(vegetation_mask)
+    if isinstance(vegetation_mask, np.lib.npyio.NpzFile):
+        vegetation_mask = vegetation_mask["landcover"]
+
+    n_frames, read_targ = _frame_reader(cube, variable)
+    panels = [read_targ]
+    if pred is not None:
+        n_pred, read_pred = _frame_reader(pred, variable)
+        offset = n_frames - n_pred
+        panels = [lambda t: read_pred(t - offset) if t >= offset else None, read_targ]
+
+    h, w = read_targ(0).shape[1:3]
+    gap = 2 if len(panels) > 1 else 0
+    frame = np.zeros((h * scale, len(panels) * w * scale + (len(panels) - 1) * gap, 3), dtype = np.uint8)
+
+    writer = animation_writer(save_path, n_frames, frame.shape[:2], fps = fps)
+    try:
+        for t in range(n_frames):
+            for i, read in enumerate(panels):
+                x0 = i * (w * scale + gap)
+                data = read(t)
+                if data is None:
+                    frame[:, x0:x0 + w * scale] = 0
+                    continue
+                image = colorize_frames(data, variable = variable, vegetation_mask = vegetation_mask, cloud_mask = cloud_mask)[0]
+                frame[:, x0:x0 + w * scale] = np.repeat(np.repeat(image, scale, 0), scale, 1) if scale > 1 else image
+            writer.write(frame)
+    finally:
+        writer.close()
+    return writer.path
+
+
+def render_gallery(cube, save_path: str, variable: str = "rgb", vegetation_mask = None, cloud_mask: bool = True, colorbar: bool = True):
+    """Render a gallery view of a cube to PNG
+
+    RGB galleries, and all galleries without colorbar, are written directly from the image array. Otherwise a standalone matplotlib Figure is used.
+
+    Args:
+        cube (np.ndarray): Numpy Array or loaded NPZ of Cube or path to Cube.
+        save_path (str): Output PNG filepath
+        variable (str, optional): One of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        vegetation_mask (np.ndarray, optional): If given uses this as red mask over non-vegetation. S2GLC data. Defaults to None.
+        cloud_mask (bool, optional): If True uses the last channel as cloud mask. Defaults to True.
+        colorbar (bool, optional): If True, adds a colorbar for variables other than "rgb". Defaults to True.
+    """
+    if variable == "rgb" or not colorbar:
+        write_png(save_path, gallery_image(cube, variable = variable, vegetation_mask = vegetation_mask, cloud_mask = cloud_mask))
+    else:
+        cube_gallery(cube, variable = variable, vegetation_mask = vegetation_mask, cloud_mask = cloud_mask, save_path = save_path, pyplot = False)
+
+
+def render_timeseries(pred, targ, save_path: str, vegetation_mask = None):
+    """Render a timeseries view of a predicted cube vs its target to PNG, see `cube_ndvi_timeseries`
+
+    Args:
+        pred (str, Path, np.lib.npyio.NpzFile, np.ndarray): Cube with prediction
+        targ (str, Path, np.lib.npyio.NpzFile, np.ndarray): Cube with target
+        save_path (str): Output PNG filepath
+        vegetation_mask (str, Path, np.lib.npyio.NpzFile, np.ndarray, optional): Cube with S2GLC Landcover mask. Defaults to None.
+    """
+    cube_ndvi_timeseries(pred, targ, vegetation_mask = vegetation_mask, save_path = save_path, pyplot = False)
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _render_task(task: dict) -> Tuple[str, Optional[str]]:
+    """Render a single task, runs inside a worker
+
+    Args:
+        task (dict): Has key "kind" ("gallery", "timeseries" or "animation"), "save_path" and the arguments of `render_gallery`, `render_timeseries` or `export_animation`.
+
+    Returns:
+        Tuple[str, Optional[str]]: output filepath, error message or None
+    """
+    task = dict(task)
+    kind = task.pop("kind")
+    try:
+        if kind == "gallery":
+            render_gallery(**task)
+        elif kind == "timeseries":
+            render_timeseries(**task)
+        else:
+            task["save_path"] = export_animation(**task)
+    except Exception as e:
+        return str(task["save_path"]), f"{type(e).__name__}: {e}"
+    return str(task["save_path"]), None
+
+
+def render_batch(cubes: Sequence, output_dir: str, kind: str = "gallery", variables: Union[str, Sequence[str]] = "rgb", num_workers: int = 1, colorbar: bool = True, suffix: str = ".png", fps: float = 4) -> Sequence[Tuple[str, str]]:
+    """Render galleries, timeseries plots or animations for many cubes across a process pool
+
+    Every worker uses the Agg backend and standalone figures, so memory does not grow with the number of cubes.
+
+    Args:
+        cubes (Sequence): For "gallery", paths to cubes. For "timeseries", pairs of paths (pred, targ). For "animation", either.
+        output_dir (str): Directory for the outputs, named `cubename_variable.png`, `cubename_timeseries.png` or `cubename_variable_anim{suffix}`
+        kind (str, optional): One of "gallery", "timeseries", "animation". Defaults to "gallery".
+        variables (Union[str, Sequence[str]], optional): Gallery or animation variables, one or more of "rgb", "ndvi", "rr","pp","tg","tn","tx". Defaults to "rgb".
+        num_workers (int, optional): Number of worker processes. Defaults to 1.
+        colorbar (bool, optional): If True, galleries other than "rgb" get a colorbar. Defaults to True.
+        suffix (str, optional): Animation format, see `animation_writer`. Defaults to ".png", i.e. animated PNG.
+        fps (float, optional): Frames per second of animations. Defaults to 4.
+
+    Returns:
+        Sequence[Tuple[str, str]]: output filepaths and error messages of failed renderings
+    """
+    assert(kind in ["gallery", "timeseries", "animation"])
+    output_dir = Path(output_dir)
+    if isinstance(variables, str):
+        variables = [variables]
+
+    tasks = []
+    for cube in cubes:
+        if kind == "gallery":
+            for variable in variables:
+                tasks.append({"kind": kind, "cube": cube, "save_path": output_dir/f"{cubename_of(cube)}_{variable}.png", "variable": variable, "colorbar": colorbar})
+        elif kind == "animation":
+            pred, targ = cube if isinstance(cube, (tuple, list)) else (None, cube)
+            for variable in variables:
+                tasks.append({"kind": kind, "cube": targ, "pred": pred, "save_path": output_dir/f"{cubename_of(targ)}_{variable}_anim{suffix}", "variable": variable, "fps": fps})
+        else:
+            pred, targ = cube
+            tasks.append({"kind": kind, "pred": pred, "targ": targ, "save_path": output_dir/f"{cubename_of(targ)}_timeseries.png"})
+
+    print(f"Rendering {len(tasks)} plots to {output_dir}...")
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers, _init_worker) as p:
+            results = list(tqdm(p.imap_unordered(_render_task, tasks), total = len(tasks)))
+    else:
+        _init_worker()
+        results = [_render_task(task) for task in tqdm(tasks)]
+
+    failed = [(path, error) for path, error in results if error is not None]
+    for path, error in failed:
+        print(f"Failed to render {path}: {error}")
+    print(f"Rendered {len(tasks) - len(failed)} plots.")
+    return failed
+
+
+def worst_cubes(scores, n: Optional[int] = 10) -> Sequence[Tuple[str, str]]:
+    """Select the cubes with the lowest EarthNetScore of their best prediction
+
+    Cubes with a subscore of 0 count as worst, cubes without any subscore come last.
+
+    Args:
+        scores (Union[str, dict, EarthNetScore]): Computed `EarthNetScore`, its `best_samples()`, or a shard JSON saved by `EarthNetScore.save_shard`
+        n (Optional[int], optional): Number of cubes, None for all. Defaults to 10.
+
+    Returns:
+        Sequence[Tuple[str, str]]: (pred_filepath, targ_filepath) pairs, worst first
+    """
+    if isinstance(scores, (str, Path)):
+        with open(scores, "r") as fp:
+            scores = json.load(fp)["cubes"]
+    elif hasattr(scores, "best_samples"):
+        scores = scores.best_samples()
+
+    cubes = list(scores)
+    subscores = np.array([[np.nan if scores[cube][key] is None else scores[cube][key] for key in ["MAD", "OLS", "EMD", "SSIM"]] for cube in cubes], dtype = np.float64).reshape(-1, 4)
+    ens = np.where((subscores == 0).any(1), 0, _harmonic_means(np.nan_to_num(subscores)))
+    return [(scores[cubes[i]]["pred_filepath"], scores[cubes[i]]["targ_filepath"]) for i in np.argsort(np.nan_to_num(ens, nan = np.inf), kind = "stable")[:n]]
+
+
+def render_worst(scores: str, output_dir: str, n: int = 10, variables: Union[str, Sequence[str]] = ("rgb", "ndvi"), num_workers: int = 1) -> Sequence[Tuple[str, str]]:
+    """Render timeseries plots and target galleries of the worst predicted cubes
+
+    Args:
+        scores (Union[str, dict, EarthNetScore]): see `worst_cubes`
+        output_dir (str): Directory for the PNGs
+        n (int, optional): Number of cubes. Defaults to 10.
+        variables (Union[str, Sequence[str]], optional): Gallery variables. Defaults to ("rgb", "ndvi").
+        num_workers (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        Sequence[Tuple[str, str]]: output filepaths and error messages of failed renderings
+    """
+    pairs = worst_cubes(scores, n = n)
+    failed = render_batch(pairs, output_dir, kind = "timeseries", num_workers = num_workers)
+    failed += render_batch([targ for _, targ in pairs], output_dir, kind = "gallery", variables = variables, num_workers = num_workers)
+    return failed
+
+
+def render_report(cubes, save_path: str, vegetation_masks: Optional[Sequence] = None, n: Optional[int] = None, dpi: int = 150) -> Sequence[Tuple[str, str]]:
+    """Render timeseries views of many cubes into a single multi-page PDF or HTML report
+
+    One figure is reused for all pages and every page is rasterized and written to disk as soon as it is drawn, so memory does not grow with the number of cubes.
+
+    Args:
+        cubes (Union[Sequence[Tuple[str, str]], str, dict, EarthNetScore]): (pred, targ) pairs, or scores as accepted by `worst_cubes`, which are reported worst first
+        save_path (str): Output filepath ending in ".pdf" or ".html"
+        vegetation_masks (Optional[Sequence], optional): S2GLC landcover of every cube, in the order of `cubes`. Defaults to None.
+        n (Optional[int], optional): Number of cubes if `cubes` are scores, None for all. Defaults to None.
+        dpi (int, optional): Resolution of the pages. Defaults to 150.
+
+    Returns:
+        Sequence[Tuple[str, str]]: target filepaths and error messages of failed pages
+    """
+    import base64
+
+    if not isinstance(cubes, (list, tuple)):
+        cubes = worst_cubes(cubes, n = n)
+    save_path = Path(save_path)
+    assert(save_path.suffix in [".pdf", ".html"]),f"Unknown report format {save_path.suffix}, use .pdf or .html"
+    save_path.parent.mkdir(parents = True, exist_ok = True)
+    if vegetation_masks is None:
+        vegetation_masks = [None] * len(cubes)
+    assert(len(vegetation_masks) == len(cubes))
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = _new_figure(False, dpi = dpi)
+    canvas = FigureCanvasAgg(fig)
+
+    failed = []
+    print(f"Rendering report of {len(cubes)} cubes to {save_path}...")
+    if save_path.suffix == ".pdf":
+        writer = PDFWriter(save_path, dpi = dpi)
+    else:
+        fp = open(save_path, "w")
+        fp.write("<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>EarthNet2021 Report</title></head>\n<body>\n")
+    try:
+        for (pred, targ), vegetation_mask in tqdm(zip(cubes, vegetation_masks), total = len(cubes)):
+            try:
+                cube_ndvi_timeseries(pred, targ, vegetation_mask = vegetation_mask, dpi = dpi, fig = fig)
+                fig.suptitle(cubename_of(targ), fontsize = 6)
+                canvas.draw()
+                image = np.asarray(canvas.buffer_rgba())[:, :, :3]
+            except Exception as e:
+                failed.append((str(targ), f"{type(e).__name__}: {e}"))
+                continue
+            if save_path.suffix == ".pdf":
+                writer.write(image)
+            else:
+                png = _png_header(image) + _png_chunk(b"IDAT", _png_data(image)) + _png_chunk(b"IEND", b"")
+                fp.write(f"<figure><img src=\"data:image/png;base64,{base64.b64encode(png).decode()}\"></figure>\n")
+    finally:
+        if save_path.suffix == ".pdf":
+            writer.close()
+        else:
+            fp.write("</body>\n</html>\n")
+            fp.close()
+
+    for path, error in failed:
+        print(f"Failed to render {path}: {error}")
+    print(f"Rendered {len(cubes) - len(failed)} pages.")
+    return failed
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire({"batch": render_batch, "worst": render_worst, "report": render_report})
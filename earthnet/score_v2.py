@@ -1,12 +1,14 @@
 
 
+from typing import Optional
+
 import numpy as np
-import xarray as xr
-import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from earthnet.workers import MemoryBudget, WorkerSetup, bounded_map
+
 
 def normalized_NSE(targ, pred, name_ndvi_pred = "ndvi_pred"):
     """Compute normalized Nash sutcliffe model efficiency of NDVI for one minicube
@@ -29,6 +31,7 @@ def normalized_NSE(targ, pred, name_ndvi_pred = "ndvi_pred"):
             pred (xr.Dataset): prediction minicube, contains `name_ndvi_pred` variable with NDVI predictions during the forecasting period.
             name_ndvi_pred (str, optional): Name of the NDVI prediction variable, defaults to `"ndvi_pred"`.
     """
+    import xarray as xr
 
     pred_start_idx = len(targ.time.isel(time = slice(4,None,5))) - len(pred.time)
 
@@ -36,7 +39,7 @@ def normalized_NSE(targ, pred, name_ndvi_pred = "ndvi_pred"):
     red = targ.s2_B04.isel(time = slice(4,None,5)).isel(time = slice(pred_start_idx, None))
     mask = targ.s2_mask.isel(time = slice(4,None,5)).isel(time = slice(pred_start_idx, None))
 
-    targ_ndvi = ((nir - red) / (nir + red + 1e-8)).where(mask == 0, np.NaN)
+    targ_ndvi = ((nir - red) / (nir + red + 1e-8)).where(mask == 0, np.nan)
     pred_ndvi = pred[name_ndvi_pred]
 
     nnse = 1 / (2 - (1 - (((targ_ndvi - pred_ndvi)**2).sum("time") / ((targ_ndvi - targ_ndvi.mean("time"))**2).sum("time"))))
@@ -48,7 +51,132 @@ def normalized_NSE(targ, pred, name_ndvi_pred = "ndvi_pred"):
     return df.drop(columns="sentinel:product_id", errors = "ignore")
 
 
+def target_state(targ, pred_length: int) -> dict:
+    """Everything of a target minicube needed for `nnse_from_state`, which does not depend on the prediction
+
+        Args:
+            targ (xr.Dataset): target minicube
+            pred_length (int): Number of predicted (5-daily) time steps
+
+        Returns:
+            dict: "ndvi" (float32, time x grid, NaN where cloudy), "denominator" (float32, sum over time of the squared anomalies of "ndvi"), "n_obs" (uint8), "landcover" (uint8, 0 where missing), "time", "dims" (names of the two grid dimensions) and "coords" (their coordinate values)
+    """
+    import xarray as xr
+
+    pred_start_idx = len(targ.time.isel(time = slice(4,None,5))) - pred_length
+
+    nir = targ.s2_B8A.isel(time = slice(4,None,5)).isel(time = slice(pred_start_idx, None))
+    red = targ.s2_B04.isel(time = slice(4,None,5)).isel(time = slice(pred_start_idx, None))
+    valid = targ.s2_mask.isel(time = slice(4,None,5)).isel(time = slice(pred_start_idx, None)) == 0
+
+    targ_ndvi = ((nir - red) / (nir + red + 1e-8)).where(valid, np.nan)
+    denominator = ((targ_ndvi - targ_ndvi.mean("time"))**2).sum("time")
+
+    n_obs = valid.sum("time")
+    assert(len(valid.time) < 256),"n_obs does not fit into uint8."
+
+    denominator, landcover, n_obs = xr.broadcast(denominator, targ.esawc_lc, n_obs)
+    dims = denominator.dims
+
+    return {
+        "ndvi": targ_ndvi.transpose("time", *dims).values.astype(np.float32),
+        "denominator": denominator.values.astype(np.float32),
+        "n_obs": n_obs.transpose(*dims).values.astype(np.uint8),
+        "landcover": np.nan_to_num(landcover.transpose(*dims).values, nan = 0).astype(np.uint8),
+        "time": targ_ndvi.time.values,
+        "dims": dims,
+        "coords": [denominator[dim].values for dim in dims]
+    }
+
+
+def nnse_from_state(state: dict, pred_ndvi) -> dict:
+    """Compute normalized Nash sutcliffe model efficiency of NDVI for one minicube from its `target_state`
+
+        Args:
+            state (dict): Output of `target_state`
+            pred_ndvi (xr.DataArray): NDVI predictions during the forecasting period
+
+        Returns:
+            dict: see `normalized_NSE_arrays`
+    """
+    pred_ndvi = pred_ndvi.reindex({"time": state["time"], **dict(zip(state["dims"], state["coords"]))}).transpose("time", *state["dims"]).values
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        nse = 1 - np.nansum((state["ndvi"] - pred_ndvi)**2, axis = 0) / state["denominator"]
+        nnse = 1 / (2 - nse)
+
+    return {
+        "NNSE": nnse.astype(np.float32).reshape(-1),
+        "landcover": state["landcover"].reshape(-1),
+        "n_obs": state["n_obs"].reshape(-1),
+        "dims": state["dims"],
+        "coords": state["coords"]
+    }
+
+
+def save_target_state(path: str, state: dict, targetfile: str):
+    """Save the `target_state` of a target minicube to the target cache
+
+    Args:
+        path (str): Cache file (`.npz`)
+        state (dict): Output of `target_state`
+        targetfile (str): Target minicube the state was computed from, its size and modification time are stored to detect changes
+    """
+    stat = Path(targetfile).stat()
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.with_name(path.stem + ".tmp.npz")
+    np.savez(tmp_path, ndvi = state["ndvi"], denominator = state["denominator"], n_obs = state["n_obs"], landcover = state["landcover"], time = state["time"], dims = np.array(state["dims"]), coord_0 = state["coords"][0], coord_1 = state["coords"][1], source = np.array([stat.st_size, stat.st_mtime_ns]))
+    tmp_path.replace(path)
+
+
+def load_target_state(path: str, targetfile: str, pred_length: int) -> Optional[dict]:
+    """Load the `target_state` of a target minicube from the target cache
+
+    Args:
+        path (str): Cache file (`.npz`)
+        targetfile (str): Target minicube the state was computed from
+        pred_length (int): Number of predicted (5-daily) time steps
+
+    Returns:
+        Optional[dict]: The state, None if it is not cached, the target minicube changed or it was cached for another prediction length
+    """
+    path = Path(path)
+    if not path.is_file():
+        return None
+    stat = Path(targetfile).stat()
+    with np.load(path) as cached:
+        if list(cached["source"]) != [stat.st_size, stat.st_mtime_ns] or len(cached["time"]) != pred_length:
+            return None
+        return {
+            "ndvi": cached["ndvi"],
+            "denominator": cached["denominator"],
+            "n_obs": cached["n_obs"],
+            "landcover": cached["landcover"],
+            "time": cached["time"],
+            "dims": tuple(str(dim) for dim in cached["dims"]),
+            "coords": [cached["coord_0"], cached["coord_1"]]
+        }
+
+
+def normalized_NSE_arrays(targ, pred, name_ndvi_pred = "ndvi_pred") -> dict:
+    """Compute normalized Nash sutcliffe model efficiency of NDVI for one minicube as compact arrays
+
+        Same scores as `normalized_NSE`, but as flat arrays in the row order of its DataFrame, which are much cheaper to send between processes.
+
+        Args:
+            targ (xr.Dataset): target minicube
+            pred (xr.Dataset): prediction minicube, contains `name_ndvi_pred` variable with NDVI predictions during the forecasting period.
+            name_ndvi_pred (str, optional): Name of the NDVI prediction variable, defaults to `"ndvi_pred"`.
+
+        Returns:
+            dict: "NNSE" (float32), "landcover" (uint8, 0 where missing), "n_obs" (uint8), each flattened over the grid, "dims" (names of the two grid dimensions) and "coords" (their coordinate values)
+    """
+    return nnse_from_state(target_state(targ, len(pred.time)), pred[name_ndvi_pred])
+
+
 def score_from_args(args):
+    import xarray as xr
 
     targetfile, predfile, name_ndvi_pred = args
 
@@ -60,7 +188,122 @@ def score_from_args(args):
 
     return curr_df
 
-def score_over_dataset(testset_dir, pred_dir, name_ndvi_pred = "ndvi_pred", verbose = True, num_workers = 1):
+
+def score_arrays_from_args(args) -> dict:
+    """Score one minicube in a worker, see `normalized_NSE_arrays`
+
+    Args:
+        args (tuple): cube code, target filepath, prediction filepath, name of the NDVI prediction variable, cache filepath or None
+
+    Returns:
+        dict: compact arrays of `normalized_NSE_arrays` and the cube code under "id"
+    """
+    import xarray as xr
+
+    code, targetfile, predfile, name_ndvi_pred, cachefile = args
+
+    with xr.open_dataset(predfile) as pred:
+        pred_ndvi = pred[name_ndvi_pred].load()
+
+    state = load_target_state(cachefile, targetfile, len(pred_ndvi.time)) if cachefile is not None else None
+    if state is None:
+        with xr.open_dataset(targetfile) as targ:
+            state = target_state(targ, len(pred_ndvi.time))
+        if cachefile is not None:
+            save_target_state(cachefile, state, targetfile)
+
+    arrays = nnse_from_state(state, pred_ndvi)
+    arrays["id"] = code
+
+    return arrays
+
+
+def check_prediction(args) -> list:
+    """Check a prediction minicube against its target from the NetCDF metadata only, runs inside a worker
+
+    Args:
+        args (tuple): target filepath, prediction filepath, name of the NDVI prediction variable
+
+    Returns:
+        list: problems, empty if the prediction can be scored
+    """
+    import xarray as xr
+
+    targetfile, predfile, name_ndvi_pred = args
+
+    problems = []
+    try:
+        targ = xr.open_dataset(targetfile)
+    except Exception as e:
+        return [f"Target cannot be read: {e!r}"]
+    if not Path(predfile).is_file():
+        targ.close()
+        return ["Prediction is missing."]
+    try:
+        pred = xr.open_dataset(predfile)
+    except Exception as e:
+        targ.close()
+        return [f"Prediction cannot be read: {e!r}"]
+
+    with targ, pred:
+        missing = [var for var in ["s2_B8A", "s2_B04", "s2_mask", "esawc_lc"] if var not in targ.variables]
+        if missing:
+            problems.append(f"Target has no {', '.join(missing)}.")
+        if name_ndvi_pred not in pred.data_vars:
+            problems.append(f"Prediction has no variable {name_ndvi_pred}, found {', '.join(map(str, pred.data_vars))}.")
+        elif "time" not in pred[name_ndvi_pred].dims:
+            problems.append(f"Prediction {name_ndvi_pred} has dimensions {pred[name_ndvi_pred].dims}, but no time.")
+        else:
+            ndvi_pred = pred[name_ndvi_pred]
+            if ndvi_pred.dtype.kind not in "fiu":
+                problems.append(f"Prediction {name_ndvi_pred} has non-numeric dtype {ndvi_pred.dtype}.")
+            if "s2_B8A" in targ.variables and "time" in targ.s2_B8A.dims:
+                n_targ = len(targ.time.isel(time = slice(4,None,5)))
+                if not 0 < ndvi_pred.sizes["time"] <= n_targ:
+                    problems.append(f"Prediction {name_ndvi_pred} has {ndvi_pred.sizes['time']} time steps, the target has {n_targ} (5-daily).")
+                grid = {dim: size for dim, size in targ.s2_B8A.sizes.items() if dim != "time"}
+                pred_grid = {dim: size for dim, size in ndvi_pred.sizes.items() if dim != "time"}
+                if grid != pred_grid:
+                    problems.append(f"Prediction {name_ndvi_pred} has grid {pred_grid}, but the target has {grid}.")
+
+    return problems
+
+
+def assemble_scores(results, ids, regions = None):
+    """Assemble the compact arrays of many minicubes into one DataFrame, like the concatenated DataFrames of `normalized_NSE`
+
+    Args:
+        results (Sequence[dict]): Outputs of `score_arrays_from_args`
+        ids (Sequence[str]): Cube id of every cube code
+        regions (Sequence[str], optional): Region of every cube code, if given added as column "region". Defaults to None.
+
+    Returns:
+        pd.DataFrame: one row per pixel, columns are the grid dimensions, "NNSE", "landcover", "n_obs", "id" (categorical) and optionally "region" (categorical)
+    """
+    import pandas as pd
+
+    assert(len(results) > 0),"No minicubes were scored."
+    dims = results[0]["dims"]
+    sizes = [len(result["NNSE"]) for result in results]
+    codes = np.repeat(np.array([result["id"] for result in results], dtype = np.int64), sizes)
+
+    columns = {}
+    for i, dim in enumerate(dims):
+        columns[dim] = np.concatenate([np.repeat(result["coords"][0], len(result["coords"][1])) if i == 0 else np.tile(result["coords"][1], len(result["coords"][0])) for result in results])
+    columns["NNSE"] = np.concatenate([result["NNSE"] for result in results])
+    landcover = np.concatenate([result["landcover"] for result in results]).astype(np.float32)
+    landcover[landcover == 0] = np.nan
+    columns["landcover"] = landcover
+    columns["n_obs"] = np.concatenate([result["n_obs"] for result in results])
+    categories, id_codes = np.unique(np.asarray(ids, dtype = object), return_inverse = True)
+    columns["id"] = pd.Categorical.from_codes(id_codes[codes], categories = categories)
+    if regions is not None:
+        columns["region"] = pd.Categorical(np.asarray(regions, dtype = object)[codes])
+
+    return pd.DataFrame(columns)
+
+
+def score_over_dataset(testset_dir, pred_dir, name_ndvi_pred = "ndvi_pred", verbose = True, num_workers = 1, threads_per_worker = None, pin_cpus = False, chunksize: Optional[int] = None, parquet_dir: Optional[str] = None, target_cache: Optional[str] = None, preflight: bool = True, max_memory: Optional[str] = None):
     """Compute normalized Nash sutcliffe model efficiency of NDVI for a full dataset
 
     Args:
@@ -69,45 +312,81 @@ def score_over_dataset(testset_dir, pred_dir, name_ndvi_pred = "ndvi_pred", verb
         name_ndvi_pred (str, optional): Name of the NDVI prediction variable, defaults to `"ndvi_pred"`.
         verbose (boolean, optional): Set to false to silence this function.
         num_workers (int, optional): Number of threads to use for scoring. Defaults to 1.
+        threads_per_worker (int, optional): Number of native (BLAS/OpenMP) threads per worker, if None the CPUs are divided among the workers. Defaults to None.
+        pin_cpus (boolean, optional): If True, pins every worker to its own set of CPUs. Defaults to False.
+        chunksize (int, optional): Number of minicubes sent to a worker at once, if None about 4 chunks per worker, at most 16 minicubes. Defaults to None.
+        parquet_dir (str, optional): If given, also writes the per-pixel scores as Parquet dataset, partitioned by landcover and region, to this directory. Needs pyarrow. Defaults to None.
+        target_cache (str, optional): Directory of the target cache. If given, the prediction-independent part of the score (target NDVI, cloud mask, observation count, landcover) is loaded from there, computed and saved only for new or changed target minicubes. Speeds up scoring many models on the same test set. Defaults to None.
+        preflight (boolean, optional): If True, first checks all predictions against their targets from the NetCDF metadata and raises an AssertionError listing all problems, before any scoring. Defaults to True.
+        max_memory (str, optional): Memory budget, e.g. "48GB". If given, the memory of scoring the largest minicube is measured first, `num_workers` is reduced to fit into the budget and minicubes are only dispatched while the budget allows (see `earthnet.workers.MemoryBudget`). Defaults to None.
     """
-
     targetfiles = list(Path(testset_dir).glob("**/*.nc"))
 
     pred_dir = Path(pred_dir)
 
     predfiles = []
     inputargs = []
-    for targetfile in targetfiles:
+    ids = []
+    regions = []
+    for code, targetfile in enumerate(targetfiles):
         cubename = targetfile.name
         region = targetfile.parent.stem
 
         predfile = pred_dir/region/cubename
         predfiles.append(predfile)
-        inputargs.append([targetfile, predfile, name_ndvi_pred])
+        cachefile = Path(target_cache)/region/(targetfile.stem + ".npz") if target_cache is not None else None
+        inputargs.append([code, targetfile, predfile, name_ndvi_pred, cachefile])
+        ids.append(targetfile.stem)
+        regions.append(region)
     
     if verbose:
         print(f"scoring {testset_dir} against {pred_dir}")
 
-    
-
-    with ProcessPoolExecutor(max_workers = num_workers) as pool:
-        if verbose:
-            dfs = list(tqdm(pool.map(score_from_args, inputargs), total = len(inputargs)))
+    if preflight:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            problems = list(pool.map(check_prediction, [args[1:4] for args in inputargs], chunksize = 16))
+        failed = [(args[2], problem) for args, problem in zip(inputargs, problems) if problem]
+        for predfile, problem in failed:
+            print(f"{predfile}: {' '.join(problem)}")
+        assert(len(failed) == 0),f"Preflight found problems with {len(failed)} of {len(inputargs)} predictions, see above."
+
+    budget = None
+    if max_memory is not None and len(inputargs) > 0:
+        largest = max(inputargs, key = lambda args: sum(Path(path).stat().st_size for path in args[1:3] if Path(path).is_file()))
+        budget = MemoryBudget.calibrate(max_memory, score_arrays_from_args, largest)
+        num_workers = budget.n_workers(num_workers)
+
+    if chunksize is None:
+        chunksize = int(min(16, max(1, np.ceil(len(inputargs) / (4 * num_workers)))))
+
+    setup = WorkerSetup(num_workers, threads_per_worker = threads_per_worker, pin_cpus = pin_cpus)
+    initializer, initargs = setup.pool_args()
+
+    with ProcessPoolExecutor(max_workers = num_workers, initializer = initializer, initargs = initargs) as pool:
+        if budget is not None:
+            results = bounded_map(pool, score_arrays_from_args, inputargs, budget.prefetch(num_workers), budget = budget)
         else:
-            dfs = list(pool.map(score_from_args, inputargs))
+            results = pool.map(score_arrays_from_args, inputargs, chunksize = chunksize)
+        results = list(tqdm(results, total = len(inputargs)) if verbose else results)
 
+    df = assemble_scores(results, ids, regions = regions if parquet_dir is not None else None)
+    del results
 
-    df = pd.concat(dfs).reset_index()
+    if parquet_dir is not None:
+        df.to_parquet(parquet_dir, partition_cols = ["landcover", "region"])
+        df = df.drop(columns = "region")
+        if verbose:
+            print(f"Saved per-pixel scores to {parquet_dir}")
 
-    tree_score = 2 - 1/df[df.landcover == 10.].NNSE.mean()
-    shrub_score = 2 - 1/df[df.landcover == 20.].NNSE.mean()
-    grass_score = 2 - 1/df[df.landcover == 30.].NNSE.mean()
-    crop_score = 2 - 1/df[df.landcover == 40.].NNSE.mean()
-    swamp_score = 2 - 1/df[df.landcover == 90.].NNSE.mean()
-    mangroves_score = 2 - 1/df[df.landcover == 95.].NNSE.mean()
-    moss_score = 2 - 1/df[df.landcover == 100.].NNSE.mean()
+    tree_score = 2 - 1/float(df[df.landcover == 10.].NNSE.mean())
+    shrub_score = 2 - 1/float(df[df.landcover == 20.].NNSE.mean())
+    grass_score = 2 - 1/float(df[df.landcover == 30.].NNSE.mean())
+    crop_score = 2 - 1/float(df[df.landcover == 40.].NNSE.mean())
+    swamp_score = 2 - 1/float(df[df.landcover == 90.].NNSE.mean())
+    mangroves_score = 2 - 1/float(df[df.landcover == 95.].NNSE.mean())
+    moss_score = 2 - 1/float(df[df.landcover == 100.].NNSE.mean())
 
-    veg_score = 2 - 1/df[df.landcover <= 30.].NNSE.mean()
+    veg_score = 2 - 1/float(df[df.landcover <= 30.].NNSE.mean())
 
     scores = {
         "veg_score": veg_score,
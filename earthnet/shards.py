@@ -0,0 +1,185 @@
+"""Streaming access to EarthNet2021 minicubes inside tarball shards, without extracting them.
+"""
+from typing import Iterator, Optional, Sequence, Tuple, Union
+
+import io
+import sys
+import json
+import random
+import tarfile
+import numpy as np
+from pathlib import Path
+
+if __name__ == "__main__":
+    from store import cubename_of
+else:
+    from earthnet.store import cubename_of
+
+
+def index_path(shard: Union[str, Path]) -> Path:
+    """Path of the member offset index of a shard
+
+    Args:
+        shard (Union[str, Path]): Path to uncompressed `.tar` shard
+
+    Returns:
+        Path: `shard.idx.json`
+    """
+    shard = Path(shard)
+    return shard.with_name(shard.name + ".idx.json")
+
+
+def index_shard(shard: Union[str, Path]) -> Sequence[Tuple[str, int, int]]:
+    """Build and save the member offset index of an uncompressed `.tar` shard
+
+    Only the tar headers are read, the data of the members is skipped.
+
+    Args:
+        shard (Union[str, Path]): Path to uncompressed `.tar` shard
+
+    Returns:
+        Sequence[Tuple[str, int, int]]: member name, offset of the data, size of the data, for every `.npz` member
+    """
+    with tarfile.open(shard, "r:") as tar:
+        index = [(member.name, member.offset_data, member.size) for member in tar if member.isfile() and member.name.endswith(".npz")]
+    with open(index_path(shard), "w") as fp:
+        json.dump(index, fp)
+    return index
+
+
+def repack_tarball(tarball: Union[str, Path], shard: Union[str, Path]) -> Sequence[Tuple[str, int, int]]:
+    """Repack a downloaded `.tar.gz` into an uncompressed sequential `.tar` shard with a member offset index
+
+    The tarball is streamed, nothing is extracted to disk. Only `.npz` members are kept. The shard is a plain tar file, so other tools can still read it.
+
+    Args:
+        tarball (Union[str, Path]): Path to `.tar.gz` as downloaded by `Downloader`
+        shard (Union[str, Path]): Path to the output `.tar` shard
+
+    Returns:
+        Sequence[Tuple[str, int, int]]: member offset index, see `index_shard`
+    """
+    shard = Path(shard)
+    shard.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = shard.with_name(shard.name + ".tmp")
+    with tarfile.open(tarball, "r|gz") as src, tarfile.open(tmp_path, "w", format = tarfile.GNU_FORMAT) as dst:
+        for member in src:
+            if member.isfile() and member.name.endswith(".npz"):
+                dst.addfile(member, src.extractfile(member))
+    tmp_path.replace(shard)
+    return index_shard(shard)
+
+
+def iter_shard(shard: Union[str, Path]) -> Iterator[Tuple[str, dict]]:
+    """Iterate over the minicubes of a single shard in storage order
+
+    Uses the member offset index if available, else streams the tar file, which also works for compressed `.tar.gz` tarballs.
+
+    Args:
+        shard (Union[str, Path]): Path to `.tar` shard or `.tar.gz` tarball
+
+    Yields:
+        Iterator[Tuple[str, dict]]: cubename, arrays of the minicube
+    """
+    if index_path(shard).is_file():
+        with open(index_path(shard), "r") as fp:
+            index = json.load(fp)
+        with open(shard, "rb") as fp:
+            for name, offset, size in index:
+                fp.seek(offset)
+                with np.load(io.BytesIO(fp.read(size))) as npz:
+                    yield cubename_of(name), dict(npz)
+    else:
+        with tarfile.open(shard, "r|*") as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(".npz"):
+                    with np.load(io.BytesIO(tar.extractfile(member).read())) as npz:
+                        yield cubename_of(member.name), dict(npz)
+
+
+def _worker_info() -> Tuple[int, int]:
+    """Worker id and number of workers of the current PyTorch DataLoader worker, (0, 1) outside of DataLoader workers
+    """
+    if "torch" in sys.modules:
+        info = sys.modules["torch"].utils.data.get_worker_info()
+        if info is not None:
+            return info.id, info.num_workers
+    return 0, 1
+
+
+class ShardDataset:
+    """Iterable over the minicubes in a set of shards, with shard-level and buffered sample-level shuffling
+
+    Shards are split among workers, every worker reads its shards sequentially, so the dataset never has to be extracted. Works as `torch.utils.data.IterableDataset`-like iterable, workers of a PyTorch DataLoader are detected automatically.
+
+    Example:
+
+        >>> dataset = ShardDataset("data/earthnet2021/shards/", shuffle_buffer = 256, seed = 42)
+        >>> for cubename, arrays in dataset:
+        ...     hrd = arrays["highresdynamic"]
+    """
+    def __init__(self, shards: Union[str, Sequence[str]], shuffle_buffer: int = 0, seed: Optional[int] = None, worker_id: Optional[int] = None, num_workers: Optional[int] = None):
+        """Initialize ShardDataset
+
+        Args:
+            shards (Union[str, Sequence[str]]): Directory with `.tar`/`.tar.gz` shards or list of shards
+            shuffle_buffer (int, optional): Size of the shuffle buffer, 0 disables shuffling. Defaults to 0.
+            seed (Optional[int], optional): Seed for shuffling, the shuffle order changes with every epoch. Defaults to None.
+            worker_id (Optional[int], optional): Index of this worker, if None uses the PyTorch DataLoader worker. Defaults to None.
+            num_workers (Optional[int], optional): Total number of workers, if None uses the PyTorch DataLoader workers. Defaults to None.
+        """
+        if isinstance(shards, (str, Path)) and Path(shards).is_dir():
+            shards = sorted(list(Path(shards).glob("*.tar")) + list(Path(shards).glob("*.tar.gz")))
+        elif isinstance(shards, (str, Path)):
+            shards = [shards]
+        self.shards = [Path(shard) for shard in shards]
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch, which changes the shuffle order
+
+        Args:
+            epoch (int): Epoch
+        """
+        self.epoch = epoch
+
+    def worker_shards(self) -> Sequence[Path]:
+        """Shards read by this worker
+
+        Returns:
+            Sequence[Path]: every `num_workers`-th shard, starting at `worker_id`
+        """
+        worker_id, num_workers = _worker_info()
+        worker_id = self.worker_id if self.worker_id is not None else worker_id
+        num_workers = self.num_workers if self.num_workers is not None else num_workers
+        return self.shards[worker_id::num_workers]
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        shards = list(self.worker_shards())
+        if self.shuffle_buffer <= 0:
+            for shard in shards:
+                yield from iter_shard(shard)
+            return
+
+        rng = random.Random(None if self.seed is None else f"{self.seed}-{self.epoch}-{','.join(str(shard) for shard in shards)}")
+        rng.shuffle(shards)
+        buffer = []
+        for shard in shards:
+            for sample in iter_shard(shard):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                idx = rng.randrange(len(buffer))
+                buffer[idx], sample = sample, buffer[idx]
+                yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(repack_tarball)
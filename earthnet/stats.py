@@ -0,0 +1,489 @@
+"""Streaming statistics of a dataset split with mergeable accumulators, e.g. for normalizing model inputs.
+"""
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import os
+import json
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+if __name__ == "__main__":
+    from store import cube_mask, cubename_of, is_cube_path
+else:
+    from earthnet.store import cube_mask, cubename_of, is_cube_path
+
+# Cached statistics are saved next to the split directory, not inside it, such that the split only contains minicubes
+STATS_SUFFIX = "_STATS.npz"
+
+BANDS = ["blue", "green", "red", "nir"]
+
+EOBS = ["rr", "pp", "tg", "tn", "tx"]
+
+# Histogram ranges, values outside fall into an underflow and an overflow bin. E-OBS is given raw for EarthNet2021x `.nc` minicubes and normalized for `.npz` minicubes.
+BAND_RANGE = (0., 1.)
+NDVI_RANGE = (-1., 1.)
+EOBS_RANGES = {
+    "nc": ([0., 900., -50., -50., -50.], [200., 1100., 50., 50., 50.]),
+    "npz": ([-0.5]*5, [1.5]*5),
+}
+
+
+class Welford:
+    """Running count, mean and sum of squared deviations per channel, mergeable with Chan's parallel update
+
+    NaNs are ignored.
+    """
+    def __init__(self, shape: Union[int, Tuple[int, ...]] = 1):
+        """Initialize Welford
+
+        Args:
+            shape (Union[int, Tuple[int, ...]], optional): Shape of the statistics, e.g. number of channels. Defaults to 1.
+        """
+        self.count = np.zeros(shape, dtype = np.int64)
+        self.mean = np.zeros(shape, dtype = np.float64)
+        self.m2 = np.zeros(shape, dtype = np.float64)
+
+    def merge_moments(self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray, index = slice(None)):
+        """Merge the moments of another sample into the statistics at `index`
+
+        Args:
+            count (np.ndarray): Number of values
+            mean (np.ndarray): Mean
+            m2 (np.ndarray): Sum of squared deviations from the mean
+            index (optional): Index into the statistics, must not contain duplicates. Defaults to all.
+        """
+        n_a, n_b = self.count[index], np.asarray(count, dtype = np.int64)
+        n = n_a + n_b
+        delta = np.where(n_b > 0, mean, 0) - self.mean[index]
+        frac = np.divide(n_b, n, out = np.zeros(np.shape(n)), where = n > 0)
+        self.mean[index] = self.mean[index] + delta * frac
+        self.m2[index] = self.m2[index] + np.where(n_b > 0, m2, 0) + delta**2 * n_a * frac
+        self.count[index] = n
+
+    def update(self, x: np.ndarray):
+        """Add values
+
+        Args:
+            x (np.ndarray): Values with the channels in the last axis
+        """
+        self.merge_moments(*moments(x.reshape(-1, self.count.size)))
+
+    def merge(self, other: "Welford"):
+        """Merge the statistics of another accumulator into this one
+
+        Args:
+            other (Welford): Accumulator of the same shape
+        """
+        self.merge_moments(other.count, other.mean, other.m2)
+
+    @property
+    def std(self) -> np.ndarray:
+        """Population standard deviation, NaN without values"""
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return np.sqrt(self.m2 / self.count)
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        return {f"{prefix}.count": self.count, f"{prefix}.mean": self.mean, f"{prefix}.m2": self.m2}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str) -> "Welford":
+        welford = cls(arrays[f"{prefix}.count"].shape)
+        welford.count, welford.mean, welford.m2 = [np.array(arrays[f"{prefix}.{k}"]) for k in ["count", "mean", "m2"]]
+        return welford
+
+
+def moments(x: np.ndarray, axis: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Count, mean and sum of squared deviations along an axis, ignoring NaNs
+
+    Args:
+        x (np.ndarray): Values
+        axis (int, optional): Axis to reduce. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: count, mean (0 without values), m2
+    """
+    valid = ~np.isnan(x)
+    count = valid.sum(axis)
+    mean = np.divide(np.nansum(x, axis, dtype = np.float64), count, out = np.zeros(count.shape), where = count > 0)
+    m2 = np.nansum((x - np.expand_dims(mean, axis))**2, axis, dtype = np.float64)
+    return count, mean, m2
+
+
+class Histogram:
+    """Fixed-bin histogram per channel, mergeable by adding the counts
+
+    Each channel has `bins` equally wide bins between its low and high value, plus one underflow and one overflow bin. NaNs are ignored.
+    """
+    def __init__(self, low: Union[float, Sequence[float]], high: Union[float, Sequence[float]], bins: int = 1000, channels: int = 1):
+        """Initialize Histogram
+
+        Args:
+            low (Union[float, Sequence[float]]): Lower edge, per channel or for all
+            high (Union[float, Sequence[float]]): Upper edge, per channel or for all
+            bins (int, optional): Number of bins between low and high. Defaults to 1000.
+            channels (int, optional): Number of channels. Defaults to 1.
+        """
+        self.low = np.broadcast_to(np.asarray(low, dtype = np.float64), (channels,)).copy()
+        self.high = np.broadcast_to(np.asarray(high, dtype = np.float64), (channels,)).copy()
+        self.counts = np.zeros((channels, bins + 2), dtype = np.int64)
+
+    @property
+    def bins(self) -> int:
+        return self.counts.shape[1] - 2
+
+    def update(self, x: np.ndarray):
+        """Add values
+
+        Args:
+            x (np.ndarray): Values with the channels in the last axis
+        """
+        channels = len(self.counts)
+        x = x.reshape(-1, channels)
+        valid = ~np.isnan(x)
+        with np.errstate(invalid = "ignore"):
+            idx = np.floor((x - self.low) / (self.high - self.low) * self.bins)
+        idx = np.clip(np.where(valid, idx, 0), -1, self.bins).astype(np.int64) + 1
+        idx += np.arange(channels) * (self.bins + 2)
+        self.counts += np.bincount(idx[valid], minlength = self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other: "Histogram"):
+        """Merge the counts of another histogram with the same bins into this one
+
+        Args:
+            other (Histogram): Histogram
+        """
+        assert(np.array_equal(self.low, other.low) and np.array_equal(self.high, other.high) and self.bins == other.bins),"Histograms have different bins."
+        self.counts += other.counts
+
+    def quantile(self, q: float) -> np.ndarray:
+        """Approximate quantile per channel, interpolated linearly within the bin
+
+        Quantiles in the underflow or overflow bin are clipped to the low or high edge.
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            np.ndarray: Quantile per channel, NaN without values
+        """
+        width = (self.high - self.low) / self.bins
+        result = np.full(len(self.counts), np.nan)
+        for c, counts in enumerate(self.counts):
+            total = counts.sum()
+            if total == 0:
+                continue
+            cumsum = np.cumsum(counts)
+            b = int(np.searchsorted(cumsum, q * total, side = "left"))
+            below = cumsum[b] - counts[b]
+            frac = (q * total - below) / counts[b] if counts[b] > 0 else 0.
+            result[c] = np.clip(self.low[c] + (b - 1 + frac) * width[c], self.low[c], self.high[c])
+        return result
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        return {f"{prefix}.low": self.low, f"{prefix}.high": self.high, f"{prefix}.counts": self.counts}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str) -> "Histogram":
+        counts = np.array(arrays[f"{prefix}.counts"])
+        histogram = cls(arrays[f"{prefix}.low"], arrays[f"{prefix}.high"], bins = counts.shape[1] - 2, channels = counts.shape[0])
+        histogram.counts = counts
+        return histogram
+
+
+def _read_nc(path: Path) -> dict:
+    import xarray as xr
+
+    EOBS_VARIABLES = [f"eobs_{var}" for var in EOBS]
+
+    with xr.open_dataset(path) as minicube:
+        hr = minicube.isel(time = slice(4, None, 5))
+        return {
+            "bands": hr[["s2_B02", "s2_B03", "s2_B04", "s2_B8A"]].to_array("band").transpose("lat", "lon", "band", "time").values,
+            "mask": (hr.s2_mask == 0).transpose("lat", "lon", "time").values,
+            "dates": hr.time.values.astype("datetime64[D]"),
+            "eobs": minicube[EOBS_VARIABLES].to_array("var").transpose("time", "var").values,
+            "dem": minicube.cop_dem.values[..., None],
+        }
+
+
+def _read_npz(path: Path, target: bool) -> dict:
+    npz = np.load(path)
+    hrd = npz["highresdynamic"]
+    t = hrd.shape[-1]
+    # Frames are 5-daily from the start date of the cubename, target files hold the last frames of the cube.
+    start, end = [np.datetime64(date) for date in cubename_of(path).split("_")[1:3]]
+    offset = (end - start).astype(int) // 5 + 1 - t if target else 0
+    arrays = {
+        "bands": hrd[:, :, :4, :],
+        "mask": cube_mask(hrd),
+        "dates": start + 5 * (offset + np.arange(t)),
+    }
+    if "mesodynamic" in npz.files:
+        arrays["eobs"] = np.moveaxis(npz["mesodynamic"], 2, -1)
+    if "highresstatic" in npz.files:
+        arrays["dem"] = npz["highresstatic"]
+    return arrays
+
+
+class SplitStats:
+    """Statistics of a dataset split, accumulated in a single pass over its minicubes
+
+    Holds per band, NDVI, E-OBS and DEM means and standard deviations, histograms of bands, NDVI and E-OBS, the cloud fraction of each minicube and timestep and the NDVI climatology per tile and day of year. Band, NDVI and climatology statistics only use non-masked pixels.
+
+    Statistics of different sets of minicubes are combined with `merge`. `manifest` records size and modification time of all minicubes included.
+    """
+    def __init__(self, split: str, file_format: str = "npz", bins: int = 1000):
+        """Initialize SplitStats
+
+        Args:
+            split (str): Name of the split
+            file_format (str, optional): "npz" (EarthNet2021) or "nc" (EarthNet2021x). Defaults to "npz".
+            bins (int, optional): Number of histogram bins. Defaults to 1000.
+        """
+        self.split = split
+        self.file_format = file_format
+        self.manifest = {}
+        self.bands = Welford(len(BANDS))
+        self.ndvi = Welford(1)
+        self.eobs = Welford(len(EOBS))
+        self.dem = Welford(1)
+        self.band_histogram = Histogram(*BAND_RANGE, bins = bins, channels = len(BANDS))
+        self.ndvi_histogram = Histogram(*NDVI_RANGE, bins = bins)
+        self.eobs_histogram = Histogram(*EOBS_RANGES[file_format], bins = bins, channels = len(EOBS))
+        self.cloud_fraction = {}
+        self.ndvi_climatology = {}
+
+    def add_cube(self, path: Union[str, Path], relpath: str, entry: Optional[list] = None):
+        """Add a minicube
+
+        Args:
+            path (Union[str, Path]): Path to the minicube
+            relpath (str): Path relative to the split directory
+            entry (Optional[list], optional): Manifest entry, size and modification time. Defaults to None.
+        """
+        path = Path(path)
+        arrays = _read_nc(path) if self.file_format == "nc" else _read_npz(path, target = "target" in Path(relpath).parts[:-1])
+
+        mask = arrays["mask"]
+        bands = np.where(mask[:, :, None, :], arrays["bands"], np.nan)
+        self.cloud_fraction[relpath] = (1 - mask.mean((0, 1))).astype(np.float32)
+
+        bands = np.moveaxis(bands, 2, -1)
+        self.bands.update(bands)
+        self.band_histogram.update(bands)
+
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            ndvi = (bands[..., 3] - bands[..., 2]) / (bands[..., 3] + bands[..., 2] + 1e-6)
+        self.ndvi.update(ndvi[..., None])
+        self.ndvi_histogram.update(ndvi[..., None])
+
+        tile = cubename_of(path).split("_")[0]
+        climatology = self.ndvi_climatology.setdefault(tile, Welford(366))
+        doy = (arrays["dates"] - arrays["dates"].astype("datetime64[Y]")).astype(int)
+        for frame, (count, mean, m2) in enumerate(zip(*moments(ndvi.reshape(-1, ndvi.shape[-1])))):
+            climatology.merge_moments(count, mean, m2, index = doy[frame])
+
+        if "eobs" in arrays:
+            self.eobs.update(arrays["eobs"])
+            self.eobs_histogram.update(arrays["eobs"])
+        if "dem" in arrays:
+            self.dem.update(arrays["dem"])
+
+        if entry is not None:
+            self.manifest[relpath] = entry
+
+    def merge(self, other: "SplitStats"):
+        """Merge the statistics of other minicubes of the same split into this one
+
+        Args:
+            other (SplitStats): Statistics of other minicubes
+        """
+        assert(self.split == other.split and self.file_format == other.file_format),f"Cannot merge statistics of {other.split} ({other.file_format}) into {self.split} ({self.file_format})."
+        for name in ["bands", "ndvi", "eobs", "dem", "band_histogram", "ndvi_histogram", "eobs_histogram"]:
+            getattr(self, name).merge(getattr(other, name))
+        for tile, climatology in other.ndvi_climatology.items():
+            self.ndvi_climatology.setdefault(tile, Welford(366)).merge(climatology)
+        self.cloud_fraction.update(other.cloud_fraction)
+        self.manifest.update(other.manifest)
+
+    def normalization(self) -> Dict[str, Dict[str, list]]:
+        """Means and standard deviations for normalizing model inputs
+
+        Returns:
+            Dict[str, Dict[str, list]]: {"bands", "ndvi", "eobs", "dem": {"mean", "std"}}
+        """
+        return {name: {"mean": getattr(self, name).mean.tolist(), "std": getattr(self, name).std.tolist()} for name in ["bands", "ndvi", "eobs", "dem"]}
+
+    def eobs_normalization(self, q: float = 0.001) -> Tuple[list, list]:
+        """Shift and scale mapping the `q` to `1 - q` quantiles of each E-OBS variable to 0 to 1
+
+        Same convention as `EOBS_SHIFT` and `EOBS_SCALE` in `earthnet.download_v2`, i.e. normalized = (x + shift)/scale. For `.npz` splits the E-OBS variables are already normalized.
+
+        Args:
+            q (float, optional): Quantile. Defaults to 0.001.
+
+        Returns:
+            Tuple[list, list]: shift and scale in the order of `EOBS`
+        """
+        low, high = self.eobs_histogram.quantile(q), self.eobs_histogram.quantile(1 - q)
+        return (-low).tolist(), (high - low).tolist()
+
+    def climatology(self, tile: str) -> Tuple[np.ndarray, np.ndarray]:
+        """NDVI climatology of a tile
+
+        Args:
+            tile (str): Tile, e.g. "32UNC"
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: mean and standard deviation per day of year (0 is January 1st), NaN without observations
+        """
+        climatology = self.ndvi_climatology[tile]
+        return np.where(climatology.count > 0, climatology.mean, np.nan), climatology.std
+
+    def save(self, stats_file: Union[str, Path]):
+        """Save the statistics as a single `.npz` file
+
+        Args:
+            stats_file (Union[str, Path]): Output filepath
+        """
+        stats_file = Path(stats_file)
+        arrays = {
+            "split": np.array(self.split),
+            "file_format": np.array(self.file_format),
+            "manifest": np.array(json.dumps(self.manifest)),
+            "cloud_fraction.relpaths": np.array(list(self.cloud_fraction), dtype = str),
+            "cloud_fraction.lengths": np.array([len(v) for v in self.cloud_fraction.values()], dtype = np.int64),
+            "cloud_fraction.values": np.concatenate(list(self.cloud_fraction.values()) or [np.zeros(0, dtype = np.float32)]),
+            "climatology.tiles": np.array(list(self.ndvi_climatology), dtype = str),
+        }
+        for name in ["bands", "ndvi", "eobs", "dem", "band_histogram", "ndvi_histogram", "eobs_histogram"]:
+            arrays.update(getattr(self, name).to_arrays(name))
+        for tile, climatology in self.ndvi_climatology.items():
+            arrays.update(climatology.to_arrays(f"climatology.{tile}"))
+
+        stats_file.parent.mkdir(parents = True, exist_ok = True)
+        tmp_file = stats_file.with_name(stats_file.name + ".tmp")
+        with open(tmp_file, "wb") as fp:
+            np.savez(fp, **arrays)
+        tmp_file.replace(stats_file)
+
+    @classmethod
+    def load(cls, stats_file: Union[str, Path]) -> Optional["SplitStats"]:
+        """Load statistics saved with `save`
+
+        Args:
+            stats_file (Union[str, Path]): Path to the statistics
+
+        Returns:
+            Optional[SplitStats]: Statistics, None if the file does not exist
+        """
+        if not Path(stats_file).is_file():
+            return None
+        with np.load(stats_file) as arrays:
+            counts = arrays["ndvi_histogram.counts"]
+            stats = cls(str(arrays["split"]), str(arrays["file_format"]), bins = counts.shape[1] - 2)
+            stats.manifest = json.loads(str(arrays["manifest"]))
+            for name in ["bands", "ndvi", "eobs", "dem"]:
+                setattr(stats, name, Welford.from_arrays(arrays, name))
+            for name in ["band_histogram", "ndvi_histogram", "eobs_histogram"]:
+                setattr(stats, name, Histogram.from_arrays(arrays, name))
+            values = np.split(arrays["cloud_fraction.values"], np.cumsum(arrays["cloud_fraction.lengths"])[:-1])
+            stats.cloud_fraction = dict(zip(arrays["cloud_fraction.relpaths"].tolist(), values))
+            stats.ndvi_climatology = {tile: Welford.from_arrays(arrays, f"climatology.{tile}") for tile in arrays["climatology.tiles"].tolist()}
+        return stats
+
+
+def _chunk_stats(task: tuple) -> Tuple[SplitStats, list]:
+    """Statistics of a chunk of minicubes, runs inside a worker
+
+    Args:
+        task (tuple): split directory, split name, file format, number of bins, list of (relative path, manifest entry)
+
+    Returns:
+        Tuple[SplitStats, list]: statistics, relative paths and error messages of minicubes that failed
+    """
+    split_dir, split, file_format, bins, entries = task
+    stats = SplitStats(split, file_format, bins = bins)
+    failed = []
+    for relpath, entry in entries:
+        try:
+            stats.add_cube(split_dir/relpath, relpath, entry)
+        except Exception as e:
+            failed.append((relpath, f"{type(e).__name__}: {e}"))
+    return stats, failed
+
+
+def compute_stats(split_dir: str, stats_file: Optional[str] = None, num_workers: int = 1, chunksize: int = 16, bins: int = 1000, overwrite: bool = False) -> SplitStats:
+    """Compute the statistics of a dataset split in a single parallel pass, see `SplitStats`
+
+    Each worker accumulates the statistics of a chunk of minicubes, which are then merged. The result is cached in `stats_file` together with the split name and the manifest (size and modification time) of all minicubes. If the cache is up to date, it is just loaded. If minicubes were added to the split, only those are read and merged into the cached statistics. If cached minicubes were changed or removed, everything is computed again.
+
+    Uses the `.nc` minicubes of EarthNet2021x if there are any, else the `.npz` minicubes of EarthNet2021. Minicubes that fail to load are reported and tried again on the next call.
+
+    Args:
+        split_dir (str): Directory of the split, e.g. `data/earthnet2021/train`
+        stats_file (Optional[str], optional): Path of the cached statistics. Defaults to `{split}_STATS.npz` next to `split_dir`, e.g. `data/earthnet2021/train_STATS.npz`.
+        num_workers (int, optional): Number of worker processes. Defaults to 1.
+        chunksize (int, optional): Number of minicubes accumulated by a worker at once. Defaults to 16.
+        bins (int, optional): Number of histogram bins. Defaults to 1000.
+        overwrite (bool, optional): If True, ignores the cached statistics. Defaults to False.
+
+    Returns:
+        SplitStats: Statistics of the split
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    split_dir = Path(split_dir)
+    split = split_dir.resolve().name
+    stats_file = Path(stats_file) if stats_file is not None else split_dir.resolve().parent/f"{split}{STATS_SUFFIX}"
+
+    paths = sorted(path for path in split_dir.glob("**/*.nc") if is_cube_path(path))
+    file_format = "nc" if len(paths) > 0 else "npz"
+    if file_format == "npz":
+        paths = sorted(path for path in split_dir.glob("**/*.npz") if is_cube_path(path))
+    assert(len(paths) > 0),f"No minicubes found in {split_dir}."
+
+    manifest = {}
+    for path in paths:
+        stat = os.stat(path)
+        manifest[str(path.relative_to(split_dir))] = [stat.st_size, stat.st_mtime_ns]
+
+    stats = None if overwrite else SplitStats.load(stats_file)
+    if stats is not None and (stats.split != split or stats.file_format != file_format or stats.eobs_histogram.bins != bins or any(manifest.get(relpath) != entry for relpath, entry in stats.manifest.items())):
+        print(f"Cached statistics in {stats_file} do not match the minicubes in {split_dir}, computing them again.")
+        stats = None
+    if stats is None:
+        stats = SplitStats(split, file_format, bins = bins)
+
+    entries = [(relpath, entry) for relpath, entry in manifest.items() if relpath not in stats.manifest]
+    if len(entries) == 0:
+        print(f"Statistics of {split} are up to date.")
+        return stats
+
+    print(f"Computing statistics of {len(entries)} of {len(manifest)} minicubes in {split_dir}...")
+    tasks = [(split_dir, split, file_format, bins, entries[i:i + chunksize]) for i in range(0, len(entries), chunksize)]
+
+    failed = []
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            for partial, chunk_failed in tqdm(pool.map(_chunk_stats, tasks), total = len(tasks)):
+                stats.merge(partial)
+                failed += chunk_failed
+    else:
+        for task in tqdm(tasks):
+            partial, chunk_failed = _chunk_stats(task)
+            stats.merge(partial)
+            failed += chunk_failed
+
+    for relpath, error in failed:
+        print(f"Failed to read {relpath}: {error}")
+
+    stats.save(stats_file)
+    print(f"Saved statistics of {len(stats.manifest)} minicubes to {stats_file}.")
+    return stats
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(compute_stats)
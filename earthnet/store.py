@@ -0,0 +1,364 @@
+"""Chunked array store for a whole EarthNet2021 split, compatible with the Zarr v2 format.
+"""
+from typing import Optional, Sequence, Union
+
+import re
+import json
+import zlib
+import functools
+import numpy as np
+from pathlib import Path
+from collections.abc import Mapping
+from tqdm import tqdm
+
+VARIABLES = ["highresdynamic", "highresstatic", "mesodynamic", "mesostatic"]
+
+DIMENSIONS = {
+    "highresdynamic": ["cube", "hr_y", "hr_x", "band", "time"],
+    "highresstatic": ["cube", "hr_y", "hr_x", "band"],
+    "mesodynamic": ["cube", "meso_y", "meso_x", "variable", "meso_time"],
+    "mesostatic": ["cube", "meso_y", "meso_x", "band"],
+}
+
+CUBENAME_REGEX = re.compile(r"\d{2}[A-Z]{3}_\d{4}-\d{2}-\d{2}_\d{4}-\d{2}-\d{2}(_\d+){8}")
+
+
+def cubename_of(path: Union[str, Path]) -> str:
+    """Cubename from a filename like `cubename.npz`, `target_cubename.npz` or `experiment_cubename.npz`
+
+    Args:
+        path (Union[str, Path]): Path or filename of a minicube
+
+    Returns:
+        str: cubename without prefix and suffix
+    """
+    stem = Path(path).name.split(".")[0]
+    match = CUBENAME_REGEX.search(stem)
+    return match.group(0) if match else stem
+
+
+def is_cube_path(path: Union[str, Path]) -> bool:
+    """Check if a filename contains a cubename, to skip other files like cached statistics in a dataset directory
+
+    Args:
+        path (Union[str, Path]): Path or filename
+
+    Returns:
+        bool: True if the filename contains a cubename
+    """
+    return CUBENAME_REGEX.search(Path(path).name) is not None
+
+
+def is_store(path: Union[str, Path]) -> bool:
+    """Check if a directory is a cube store written by `convert_to_store`
+
+    Args:
+        path (Union[str, Path]): Directory
+
+    Returns:
+        bool: True if `path` contains consolidated store metadata
+    """
+    return (Path(path)/".zmetadata").is_file()
+
+
+def _array_metadata(shape: Sequence[int], chunks: Sequence[int], dtype: np.dtype, level: int) -> dict:
+    return {
+        "chunks": list(chunks),
+        "compressor": {"id": "zlib", "level": level},
+        "dimension_separator": ".",
+        "dtype": dtype.str,
+        "fill_value": "NaN" if dtype.kind == "f" else 0,
+        "filters": None,
+        "order": "C",
+        "shape": list(shape),
+        "zarr_format": 2
+    }
+
+
+def _write_cube(task: tuple):
+    """Write all chunks of one minicube, runs inside a worker
+
+    Args:
+        task (tuple): store directory, cube index, path to `.npz`, array metadata per variable, compression level
+
+    Returns:
+        tuple: path to `.npz`, error message or None
+    """
+    store_dir, cube_idx, npz_path, arrays, level = task
+    try:
+        npz = np.load(npz_path)
+        for variable, meta in arrays.items():
+            data = np.ascontiguousarray(npz[variable], dtype = meta["dtype"])
+            assert(list(data.shape) == meta["shape"][1:]),f"{variable} has shape {data.shape}, but the store expects {tuple(meta['shape'][1:])}."
+            if data.ndim == 4:
+                for t in range(data.shape[-1]):
+                    chunk = np.ascontiguousarray(data[..., t])
+                    (store_dir/variable/f"{cube_idx}.0.0.0.{t}").write_bytes(zlib.compress(chunk.tobytes(), level))
+            else:
+                (store_dir/variable/f"{cube_idx}.0.0.0").write_bytes(zlib.compress(data.tobytes(), level))
+    except Exception as e:
+        return npz_path, f"{type(e).__name__}: {e}"
+    return npz_path, None
+
+
+def convert_to_store(input_dir: str, output_dir: str, num_workers: int = 1, level: int = 1):
+    """Pack all `.npz` minicubes of a split into one chunked array store
+
+    Every variable (of those in `VARIABLES` found in the first minicube) becomes one array with a leading cube dimension. Chunks hold a single frame of a single cube (static variables: a single cube), so a reader only decompresses what it needs. The cube index is the position of the cubename in the sorted list of filenames, which is saved in the store attributes. Minicubes that fail to convert are reported and left out. All minicubes need the shapes of the first one, dtypes are converted to those of the first one. The store follows the Zarr v2 format with consolidated metadata and zlib compression, so it can also be opened with `zarr.open_consolidated`.
+
+    Args:
+        input_dir (str): Directory with `.npz` minicubes of one split, e.g. `data/earthnet2021/train/`
+        output_dir (str): Directory of the store, e.g. `data/earthnet2021/train.zarr`
+        num_workers (int, optional): Number of worker processes. Defaults to 1.
+        level (int, optional): zlib compression level. Defaults to 1.
+
+    Returns:
+        list: paths and error messages of minicubes that failed to convert
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+
+    npz_paths = sorted([path for path in input_dir.glob("**/*.npz") if is_cube_path(path)], key = cubename_of)
+    assert(len(npz_paths) > 0),f"No minicubes found in {input_dir}."
+    cubenames = [cubename_of(path) for path in npz_paths]
+    assert(len(set(cubenames)) == len(cubenames)),"Cubenames in a store have to be unique."
+
+    print(f"Packing {len(npz_paths)} minicubes from {input_dir} into {output_dir}...")
+
+    first = np.load(npz_paths[0])
+    variables = [variable for variable in VARIABLES if variable in first]
+    arrays = {}
+    for variable in variables:
+        data = first[variable]
+        chunks = list(data.shape[:-1]) + [1] if data.ndim == 4 else list(data.shape)
+        arrays[variable] = _array_metadata([len(npz_paths)] + list(data.shape), [1] + chunks, data.dtype, level)
+        (output_dir/variable).mkdir(parents = True, exist_ok = True)
+
+    tasks = [(output_dir, cube_idx, npz_path, arrays, level) for cube_idx, npz_path in enumerate(npz_paths)]
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers = num_workers) as pool:
+            results = list(tqdm(pool.map(_write_cube, tasks, chunksize = 4), total = len(tasks)))
+    else:
+        results = [_write_cube(task) for task in tqdm(tasks)]
+
+    failed = [(str(path), error) for path, error in results if error is not None]
+    for path, error in failed:
+        print(f"Failed to pack {path}: {error}")
+
+    # Failed cubes are left out of the store, the chunks of the following cubes move up to keep the cube index contiguous.
+    packed = [cube_idx for cube_idx, (_, error) in enumerate(results) if error is None]
+    new_idxs = {cube_idx: new_idx for new_idx, cube_idx in enumerate(packed)}
+    for variable in variables:
+        for chunk in sorted((chunk for chunk in (output_dir/variable).iterdir() if not chunk.name.startswith(".")), key = lambda chunk: int(chunk.name.split(".")[0])):
+            cube_idx, rest = chunk.name.split(".", 1)
+            if int(cube_idx) not in new_idxs:
+                chunk.unlink()
+            elif new_idxs[int(cube_idx)] != int(cube_idx):
+                chunk.rename(chunk.with_name(f"{new_idxs[int(cube_idx)]}.{rest}"))
+
+    # Metadata is written last, so an interrupted conversion does not leave a store behind.
+    metadata = {".zgroup": {"zarr_format": 2}, ".zattrs": {"cubenames": [cubenames[cube_idx] for cube_idx in packed]}}
+    for variable, meta in arrays.items():
+        metadata[f"{variable}/.zarray"] = dict(meta, shape = [len(packed)] + meta["shape"][1:])
+        metadata[f"{variable}/.zattrs"] = {"_ARRAY_DIMENSIONS": DIMENSIONS[variable][:len(meta["shape"])]}
+
+    for key, value in metadata.items():
+        with open(output_dir/key, "w") as fp:
+            json.dump(value, fp)
+    with open(output_dir/".zmetadata", "w") as fp:
+        json.dump({"metadata": metadata, "zarr_consolidated_format": 1}, fp)
+
+    open_store.cache_clear()
+    print(f"Packed {len(tasks) - len(failed)} minicubes.")
+    return failed
+
+
+class CubeStore:
+    """Random access reader for a store written by `convert_to_store`
+
+    Example:
+
+        >>> store = CubeStore("data/earthnet2021/train.zarr")
+        >>> batch = store.read("highresdynamic", cubes = [0, 5, 7], time = slice(0, 10))
+        >>> cube = store.load("32UMC_2018-01-28_2018-11-23_1081_1209_2617_2745_22_102_48_128")
+    """
+    def __init__(self, store_dir: str):
+        """Initialize CubeStore
+
+        Args:
+            store_dir (str): Directory of the store
+        """
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir/".zmetadata", "r") as fp:
+            self.metadata = json.load(fp)["metadata"]
+        self.cubenames = self.metadata[".zattrs"]["cubenames"]
+        self.index = {cubename: idx for idx, cubename in enumerate(self.cubenames)}
+        self.arrays = {variable: self.metadata[f"{variable}/.zarray"] for variable in VARIABLES if f"{variable}/.zarray" in self.metadata}
+
+    def __len__(self) -> int:
+        return len(self.cubenames)
+
+    def __contains__(self, cubename: str) -> bool:
+        return cubename_of(cubename) in self.index
+
+    def cube_index(self, cube: Union[int, str]) -> int:
+        """Index of a cube in the store
+
+        Args:
+            cube (Union[int, str]): Cube index or cubename
+
+        Returns:
+            int: Cube index
+        """
+        if isinstance(cube, (int, np.integer)):
+            return int(cube)
+        return self.index[cubename_of(cube)]
+
+    def shape(self, variable: str) -> tuple:
+        """Shape of a variable, including the cube dimension
+
+        Args:
+            variable (str): One of "highresdynamic", "highresstatic", "mesodynamic", "mesostatic"
+
+        Returns:
+            tuple: shape
+        """
+        return tuple(self.arrays[variable]["shape"])
+
+    def _read_chunk(self, variable: str, key: str, chunk_shape: Sequence[int], dtype: np.dtype) -> np.ndarray:
+        path = self.store_dir/variable/key
+        if not path.is_file():
+            raise FileNotFoundError(f"Chunk {variable}/{key} is missing from the store {self.store_dir}.")
+        return np.frombuffer(zlib.decompress(path.read_bytes()), dtype = dtype).reshape(chunk_shape)
+
+    def read(self, variable: str, cubes: Sequence[Union[int, str]], time: Optional[slice] = None) -> np.ndarray:
+        """Read a batch of cubes, only decompressing the chunks of the requested frames
+
+        Args:
+            variable (str): One of "highresdynamic", "highresstatic", "mesodynamic", "mesostatic"
+            cubes (Sequence[Union[int, str]]): Cube indices or cubenames
+            time (Optional[slice], optional): Frames to read for dynamic variables. Defaults to None, i.e. all frames.
+
+        Returns:
+            np.ndarray: Batch with leading cube dimension, e.g. cubes x 128 x 128 x bands x frames for "highresdynamic"
+        """
+        meta = self.arrays[variable]
+        dtype = np.dtype(meta["dtype"])
+        shape, chunks = meta["shape"][1:], meta["chunks"][1:]
+        cube_idxs = [self.cube_index(cube) for cube in cubes]
+
+        if len(shape) == 4:
+            frames = range(shape[-1])[time if time is not None else slice(None)]
+            out = np.empty([len(cube_idxs)] + shape[:-1] + [len(frames)], dtype = dtype)
+            for i, cube_idx in enumerate(cube_idxs):
+                for j, t in enumerate(frames):
+                    out[i, ..., j] = self._read_chunk(variable, f"{cube_idx}.0.0.0.{t}", chunks[:-1], dtype)
+        else:
+            out = np.empty([len(cube_idxs)] + shape, dtype = dtype)
+            for i, cube_idx in enumerate(cube_idxs):
+                out[i] = self._read_chunk(variable, f"{cube_idx}.0.0.0", chunks, dtype)
+        return out
+
+    def load(self, cube: Union[int, str], time: Optional[slice] = None) -> "StoredCube":
+        """Load a single cube like a `.npz` minicube, variables are only read when accessed
+
+        Args:
+            cube (Union[int, str]): Cube index or cubename
+            time (Optional[slice], optional): Frames to read for "highresdynamic". Defaults to None, i.e. all frames.
+
+        Returns:
+            StoredCube: mapping with keys `['highresdynamic', 'highresstatic', 'mesodynamic', 'mesostatic']`
+        """
+        return StoredCube(self, self.cube_index(cube), time = time)
+
+
+class StoredCube(Mapping):
+    """A single cube of a store, accessed like a loaded `.npz` minicube
+
+    As with `np.lib.npyio.NpzFile`, a variable is read and decompressed on every access, so unused variables cost nothing.
+    """
+    def __init__(self, store: CubeStore, cube_idx: int, time: Optional[slice] = None):
+        """Initialize StoredCube
+
+        Args:
+            store (CubeStore): Reader of the store
+            cube_idx (int): Cube index
+            time (Optional[slice], optional): Frames to read for "highresdynamic". Defaults to None, i.e. all frames.
+        """
+        self.store = store
+        self.cube_idx = cube_idx
+        self.time = time
+        self.files = list(store.arrays)
+
+    def __getitem__(self, variable: str) -> np.ndarray:
+        if variable not in self.store.arrays:
+            raise KeyError(f"{variable} is not in the store {self.store.store_dir}.")
+        return self.store.read(variable, [self.cube_idx], time = self.time if variable == "highresdynamic" else None)[0]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+@functools.lru_cache(maxsize = 16)
+def open_store(store_dir: Union[str, Path]) -> CubeStore:
+    """Open a store once per process
+
+    Args:
+        store_dir (Union[str, Path]): Directory of the store
+
+    Returns:
+        CubeStore: Reader
+    """
+    return CubeStore(store_dir)
+
+
+def load_cube(path: Union[str, Path]):
+    """Load a minicube from a `.npz` file or from a store
+
+    Cubes inside a store are addressed by the virtual path `store_dir/cubename.npz`.
+
+    Args:
+        path (Union[str, Path]): Path to `.npz` minicube or virtual path into a store
+
+    Returns:
+        Union[np.lib.npyio.NpzFile, StoredCube]: Loaded minicube
+    """
+    path = Path(path)
+    if not path.is_file() and is_store(path.parent):
+        return open_store(path.parent).load(path.name)
+    return np.load(path)
+
+
+def store_paths(store_dir: Union[str, Path]) -> Sequence[Path]:
+    """Virtual paths `store_dir/cubename.npz` of all cubes in a store
+
+    Args:
+        store_dir (Union[str, Path]): Directory of the store
+
+    Returns:
+        Sequence[Path]: Virtual paths, can be passed to `load_cube`
+    """
+    return [Path(store_dir)/f"{cubename}.npz" for cubename in open_store(store_dir).cubenames]
+
+
+def cube_mask(highresdynamic: np.ndarray) -> np.ndarray:
+    """Boolean mask of a minicube from the cloud mask channel of `highresdynamic`
+
+    Only values of exactly 0 are non-masked. NaN and fractional values of the mask channel count as masked.
+
+    Args:
+        highresdynamic (np.ndarray): shape h,w,c,t, the last channel is 0 where non-masked and 1 where masked
+
+    Returns:
+        np.ndarray: shape h,w,t, True where non-masked
+    """
+    return highresdynamic[:, :, -1, :] == 0
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(convert_to_store)
@@ -0,0 +1,505 @@
+"""Worker pool utilities for long-running parallel scoring.
+"""
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import os
+import re
+import sys
+import time
+import queue
+import signal
+import warnings
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS"]
+
+
+def available_cpus() -> Sequence[int]:
+    """Get the CPUs this process may run on
+
+    Returns:
+        Sequence[int]: sorted CPU ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def limit_threads(n_threads: int):
+    """Limit the number of native threads used by BLAS, OpenMP and friends in this process
+
+    Sets the usual environment variables, which take effect for libraries loaded afterwards (e.g. in spawned processes). Libraries that are already loaded, as in forked workers, are limited through `threadpoolctl`. An already imported Numba is limited directly.
+
+    Args:
+        n_threads (int): Maximum number of threads
+    """
+    from threadpoolctl import threadpool_limits
+
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    if "numba" in sys.modules:
+        numba = sys.modules["numba"]
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    threadpool_limits(limits = n_threads)
+
+
+def init_worker(n_threads: int, cpu_queue = None):
+    """Worker initializer applying a thread budget and optionally pinning the worker to a set of CPUs
+
+    Args:
+        n_threads (int): Maximum number of native threads per worker
+        cpu_queue (multiprocessing.Queue, optional): Queue of CPU sets, each worker takes one. Defaults to None.
+    """
+    limit_threads(n_threads)
+    if cpu_queue is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpu_queue.get(timeout = 1))
+        except queue.Empty:
+            pass
+
+
+class WorkerSetup:
+    """Thread budget and CPU pinning of the workers of a process pool, processes x threads
+
+    Example:
+
+        >>> setup = WorkerSetup(n_workers = 16, threads_per_worker = 4, pin_cpus = True)
+        >>> with multiprocessing.Pool(16, *setup.pool_args()) as p:
+        ...     p.map(func, tasks)
+    """
+    def __init__(self, n_workers: int, threads_per_worker: Optional[int] = None, pin_cpus: bool = False):
+        """Initialize WorkerSetup
+
+        Args:
+            n_workers (int): Number of worker processes
+            threads_per_worker (Optional[int], optional): Number of native threads per worker, if None the available CPUs are divided among the workers. Defaults to None.
+            pin_cpus (bool, optional): If True, every worker is pinned to its own set of `threads_per_worker` CPUs. Defaults to False.
+        """
+        self.cpus = available_cpus()
+        self.n_workers = max(1, n_workers)
+        self.threads_per_worker = threads_per_worker if threads_per_worker is not None else max(1, len(self.cpus) // self.n_workers)
+        self.pin_cpus = pin_cpus
+
+    def cpu_sets(self) -> Sequence[Sequence[int]]:
+        """CPU sets of the workers, wraps around if there are less CPUs than workers x threads
+
+        Returns:
+            Sequence[Sequence[int]]: one set of CPUs per worker
+        """
+        return [sorted({self.cpus[(i * self.threads_per_worker + j) % len(self.cpus)] for j in range(self.threads_per_worker)}) for i in range(self.n_workers)]
+
+    def pool_args(self, worker: Optional[int] = None) -> Tuple[Callable, tuple]:
+        """Initializer and its arguments for a new pool, call once per pool
+
+        Args:
+            worker (Optional[int], optional): For a pool with a single worker, the index of the worker whose CPU set it gets. Defaults to None, i.e. a pool of all workers.
+
+        Returns:
+            Tuple[Callable, tuple]: initializer, initargs
+        """
+        if not self.pin_cpus:
+            return init_worker, (self.threads_per_worker, None)
+        cpu_queue = multiprocessing.Queue()
+        for cpu_set in (self.cpu_sets() if worker is None else [self.cpu_sets()[worker % self.n_workers]]):
+            cpu_queue.put(cpu_set)
+        return init_worker, (self.threads_per_worker, cpu_queue)
+
+    def __repr__(self) -> str:
+        return f"{self.n_workers} processes x {self.threads_per_worker} threads{' pinned' if self.pin_cpus else ''}"
+
+
+MEMORY_UNITS = {"": 1, "B": 1, "K": 1000, "KB": 1000, "KIB": 2**10, "M": 1000**2, "MB": 1000**2, "MIB": 2**20, "G": 1000**3, "GB": 1000**3, "GIB": 2**30, "T": 1000**4, "TB": 1000**4, "TIB": 2**40}
+
+
+def parse_memory(memory: Union[str, int, float]) -> int:
+    """Parse a memory size like "48GB", "512MiB" or a number of bytes
+
+    Args:
+        memory (Union[str, int, float]): Memory size
+
+    Returns:
+        int: Number of bytes
+    """
+    if isinstance(memory, (int, float)):
+        return int(memory)
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([a-zA-Z]*)\s*", memory)
+    assert(match is not None and match.group(2).upper() in MEMORY_UNITS),f"Cannot parse memory size {memory}."
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def _proc_kb(path: str, field: str) -> Optional[int]:
+    try:
+        with open(path, "r") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def process_memory(pid: Optional[int] = None) -> Optional[int]:
+    """Memory of a process, shared pages (e.g. of forked workers) are split proportionally among the processes sharing them
+
+    Uses the PSS from `/proc/<pid>/smaps_rollup` and falls back to the RSS. Linux only.
+
+    Args:
+        pid (Optional[int], optional): Process id, defaults to this process. Defaults to None.
+
+    Returns:
+        Optional[int]: Memory in bytes, None if unknown
+    """
+    pid = os.getpid() if pid is None else pid
+    pss = _proc_kb(f"/proc/{pid}/smaps_rollup", "Pss")
+    return pss if pss is not None else _proc_kb(f"/proc/{pid}/status", "VmRSS")
+
+
+def tree_memory(pid: Optional[int] = None) -> Optional[int]:
+    """Memory of a process and all its descendants, e.g. the main process and its worker pool, see `process_memory`
+
+    Args:
+        pid (Optional[int], optional): Process id, defaults to this process. Defaults to None.
+
+    Returns:
+        Optional[int]: Memory in bytes, None if unknown
+    """
+    pid = os.getpid() if pid is None else pid
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", "r") as fp:
+                ppid = int(fp.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += process_memory(current) or 0
+        stack.extend(children.get(current, []))
+    return total
+
+
+def _measure_task(args: Tuple[Callable, Any]) -> Tuple[int, int]:
+    """Run a task and measure its memory, runs inside a fresh worker
+
+    Returns:
+        Tuple[int, int]: private memory of the idle worker, peak increase of the resident memory during the task, both in bytes
+    """
+    import resource
+    func, task = args
+    private = _proc_kb("/proc/self/smaps_rollup", "Private_Dirty") or 0
+    before = _proc_kb("/proc/self/status", "VmRSS")
+    func(task)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    if before is None:
+        return private, peak
+    return private, max(0, peak - before)
+
+
+class MemoryBudget:
+    """Memory budget of a worker pool, sizes the pool and throttles the submission of tasks
+
+    The memory of one task is measured on a calibration task in a fresh worker, or given directly. The pool gets as many workers as fit into the budget, and tasks are only submitted while the memory of this process and its workers stays below the budget.
+
+    Example:
+
+        >>> budget = MemoryBudget.calibrate("48GB", CubeCalculator.get_scores, filepaths[0])
+        >>> n_workers = budget.n_workers(multiprocessing.cpu_count())
+        >>> with ProcessPoolExecutor(n_workers) as pool:
+        ...     results = list(bounded_map(pool, CubeCalculator.get_scores, filepaths, budget.prefetch(n_workers), budget = budget))
+    """
+    def __init__(self, max_memory: Union[str, int], task_memory: int, worker_memory: int = 0):
+        """Initialize MemoryBudget
+
+        Args:
+            max_memory (Union[str, int]): Budget, e.g. "48GB", see `parse_memory`
+            task_memory (int): Peak memory of one task in a worker in bytes
+            worker_memory (int, optional): Memory of an idle worker, not shared with this process, in bytes. Defaults to 0.
+        """
+        self.max_memory = parse_memory(max_memory)
+        self.task_memory = max(1, int(task_memory))
+        self.worker_memory = max(0, int(worker_memory))
+
+    @classmethod
+    def calibrate(cls, max_memory: Union[str, int], func: Callable, task: Any, **kwargs):
+        """Measure the memory of one task in a fresh worker process
+
+        Args:
+            max_memory (Union[str, int]): Budget, e.g. "48GB", see `parse_memory`
+            func (Callable): Function to call on the task, has to be picklable
+            task (Any): Calibration task, preferably the largest one
+
+        Returns:
+            MemoryBudget: Budget for tasks like `task`
+        """
+        with multiprocessing.Pool(1) as p:
+            worker_memory, task_memory = p.apply(_measure_task, ((func, task),))
+        budget = cls(max_memory, task_memory, worker_memory = worker_memory, **kwargs)
+        print(f"Calibrated {budget}.")
+        return budget
+
+    def n_workers(self, max_workers: int) -> int:
+        """Number of workers fitting into the budget, given the memory this process uses now
+
+        Args:
+            max_workers (int): Upper limit, e.g. the number of CPUs
+
+        Returns:
+            int: Number of workers, at least 1
+        """
+        free = self.max_memory - (tree_memory() or 0)
+        fit = int(free // (self.task_memory + self.worker_memory))
+        if fit < 1:
+            warnings.warn(f"A single worker needs about {(self.task_memory + self.worker_memory) / 2**30:.2f} GiB, more than the remaining budget of {free / 2**30:.2f} GiB.")
+        return max(1, min(max_workers, fit))
+
+    def prefetch(self, n_workers: int) -> int:
+        """Number of tasks to keep in flight, 2 per worker unless the budget is tight
+
+        Args:
+            n_workers (int): Number of workers
+
+        Returns:
+            int: Number of tasks submitted ahead
+        """
+        fit = int((self.max_memory - (tree_memory() or 0)) // self.task_memory)
+        return max(n_workers, min(2 * n_workers, fit))
+
+    def exceeded(self) -> bool:
+        """Check if one more task would exceed the budget
+
+        Returns:
+            bool: True if the memory of this process and its workers plus one task is above the budget
+        """
+        used = tree_memory()
+        return used is not None and used + self.task_memory > self.max_memory
+
+    def __repr__(self) -> str:
+        return f"memory budget of {self.max_memory / 2**30:.2f} GiB, {self.task_memory / 2**20:.0f} MiB per task, {self.worker_memory / 2**20:.0f} MiB per worker"
+
+
+def bounded_map(pool: ProcessPoolExecutor, func: Callable, tasks: Iterable, max_pending: int, budget: Optional[MemoryBudget] = None, ordered: bool = True) -> Iterator:
+    """Map over a `ProcessPoolExecutor`, submitting at most `max_pending` tasks ahead and only while the budget allows
+
+    Tasks are submitted one by one from this process, so unlike `multiprocessing.Pool.imap`, which hands the whole iterable to a background thread, the submission is actually held back. While one more task would exceed the budget, results of running tasks are awaited first. Without running tasks, the next task is submitted anyway.
+
+    Args:
+        pool (ProcessPoolExecutor): Pool
+        func (Callable): Function to call on every task, has to be picklable
+        tasks (Iterable): Tasks
+        max_pending (int): Maximum number of submitted, unfinished tasks
+        budget (Optional[MemoryBudget], optional): Memory budget. Defaults to None.
+        ordered (bool, optional): If True, yields results in order of the tasks, else in order of completion. Defaults to True.
+
+    Yields:
+        Iterator: Results
+    """
+    pending = deque()
+
+    def finished():
+        if ordered:
+            yield pending.popleft().result()
+        else:
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                yield future.result()
+
+    for task in tasks:
+        while pending and (len(pending) >= max_pending or (budget is not None and budget.exceeded())):
+            yield from finished()
+        pending.append(pool.submit(func, task))
+    while pending:
+        yield from finished()
+
+
+# Seconds a task may run over its time limit before its worker is killed from the parent process
+TIMEOUT_GRACE = 5.0
+
+
+class TaskTimeoutError(Exception):
+    """Raised inside a worker if a task exceeds its time limit.
+    """
+
+
+@contextmanager
+def time_limit(seconds: Optional[float]):
+    """Context manager raising TaskTimeoutError if the body runs longer than `seconds`
+
+    Uses SIGALRM, so it only works in the main thread of a process on Unix and triggers once the interpreter regains control from native code. If `seconds` is None or SIGALRM is unavailable, no limit is applied.
+
+    Args:
+        seconds (Optional[float]): Time limit in seconds
+    """
+    if seconds is None or not hasattr(signal, "SIGALRM"):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TaskTimeoutError(f"Task exceeded time limit of {seconds} seconds.")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class GuardedTask:
+    """Picklable wrapper running a function under a time limit and returning errors instead of raising them
+
+    Example:
+
+        >>> ok, result = GuardedTask(CubeCalculator.get_scores, timeout = 600)(filepaths)
+    """
+    def __init__(self, func: Callable, timeout: Optional[float] = None):
+        """Initialize GuardedTask
+
+        Args:
+            func (Callable): Function to call on a task, has to be picklable
+            timeout (Optional[float], optional): Time limit per task in seconds. Defaults to None.
+        """
+        self.func = func
+        self.timeout = timeout
+
+    def __call__(self, task: Any) -> Tuple[bool, Any]:
+        try:
+            with time_limit(self.timeout):
+                return True, self.func(task)
+        except Exception as e:
+            return False, f"{type(e).__name__}: {e}"
+
+
+def _kill_workers(pool: ProcessPoolExecutor):
+    """Terminate all worker processes of a pool, e.g. one stuck in native code
+    """
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+
+
+def _isolated_imap(guarded: GuardedTask, tasks: deque, n_workers: int, crashes: dict, max_retries: int = 2, setup: Optional[WorkerSetup] = None) -> Iterator[Tuple[Any, bool, Any]]:
+    """Run every task in a process of its own, up to `n_workers` at once, so a task crashing its worker takes down no other task
+
+    A crashed task is retried in a new process until it crashed more than `max_retries` times. Tasks running `TIMEOUT_GRACE` seconds over the time limit of `guarded` are killed.
+
+    Yields:
+        Iterator[Tuple[Any, bool, Any]]: task, success, result if success else error message
+    """
+    running = {}
+    free_workers = list(range(n_workers))
+    try:
+        while tasks or running:
+            while tasks and free_workers:
+                task, worker = tasks.popleft(), free_workers.pop()
+                initializer, initargs = setup.pool_args(worker = worker) if setup is not None else (None, ())
+                pool = ProcessPoolExecutor(max_workers = 1, initializer = initializer, initargs = initargs)
+                deadline = time.monotonic() + guarded.timeout + TIMEOUT_GRACE if guarded.timeout is not None else None
+                running[pool.submit(guarded, task)] = (task, pool, worker, deadline)
+
+            deadlines = [deadline for _, _, _, deadline in running.values() if deadline is not None]
+            next_deadline = min(deadlines) - time.monotonic() if deadlines else None
+            wait(running, timeout = None if next_deadline is None else max(0, next_deadline), return_when = FIRST_COMPLETED)
+
+            for future, (task, pool, worker, deadline) in list(running.items()):
+                if future.done():
+                    try:
+                        ok, result = future.result()
+                    except BrokenProcessPool:
+                        crashes[id(task)] = crashes.get(id(task), 0) + 1
+                        ok, result = False, f"Worker crashed {crashes[id(task)]} times."
+                        if crashes[id(task)] <= max_retries:
+                            tasks.append(task)
+                            ok = None
+                elif deadline is not None and deadline <= time.monotonic():
+                    _kill_workers(pool)
+                    ok, result = False, f"TaskTimeoutError: Task exceeded time limit of {guarded.timeout} seconds and was killed."
+                else:
+                    continue
+                del running[future]
+                pool.shutdown(wait = False)
+                free_workers.append(worker)
+                if ok is not None:
+                    yield task, ok, result
+    finally:
+        for _, pool, _, _ in running.values():
+            _kill_workers(pool)
+            pool.shutdown(wait = False)
+
+
+def robust_imap(func: Callable, tasks: Iterable, n_workers: int, timeout: Optional[float] = None, max_retries: int = 2, setup: Optional[WorkerSetup] = None, budget: Optional[MemoryBudget] = None) -> Iterator[Tuple[Any, bool, Any]]:
+    """Fault-isolated parallel map, yields results in order of completion
+
+    Exceptions and timeouts inside a task are caught in the worker and reported for that task only. If a worker process dies (e.g. segfault or OOM-kill), the tasks that were running are retried in parallel, each in a process of its own, so the crashing task is identified without stopping the others. A task crashing its worker more than `max_retries` times is reported as failed. Afterwards, the remaining tasks continue in a new pool.
+
+    The time limit is enforced twice: inside the worker with `time_limit`, which gives a clean error for tasks stalling in Python code, and from this process, which also catches tasks hanging in native code that never return to the interpreter. If a task is not finished `TIMEOUT_GRACE` seconds after its time limit, the pool is killed, the task is reported as timed out and the other running tasks are submitted again to a new pool. With a time limit, at most `n_workers` tasks are submitted at once, so every task starts right away.
+
+    Args:
+        func (Callable): Function to call on every task, has to be picklable
+        tasks (Iterable): Tasks
+        n_workers (int): Number of worker processes
+        timeout (Optional[float], optional): Time limit per task in seconds. Defaults to None.
+        max_retries (int, optional): Number of retries after a worker crash. Defaults to 2.
+        setup (Optional[WorkerSetup], optional): Thread budget and CPU pinning of the workers. Defaults to None.
+        budget (Optional[MemoryBudget], optional): If given, tasks are submitted `budget.prefetch` ahead and only while the memory stays below the budget. Defaults to None.
+
+    Yields:
+        Iterator[Tuple[Any, bool, Any]]: task, success, result if success else error message
+    """
+    guarded = GuardedTask(func, timeout = timeout)
+    pending = deque(tasks)
+    suspects = deque()
+    crashes = {}
+    max_running = budget.prefetch(n_workers) if budget is not None else 2 * n_workers
+    if timeout is not None:
+        max_running = n_workers
+
+    while pending or suspects:
+        if suspects:
+            yield from _isolated_imap(guarded, suspects, n_workers, crashes, max_retries = max_retries, setup = setup)
+            continue
+        initializer, initargs = setup.pool_args() if setup is not None else (None, ())
+        with ProcessPoolExecutor(max_workers = n_workers, initializer = initializer, initargs = initargs) as pool:
+            running = {}
+            deadlines = {}
+
+            def submit(task):
+                future = pool.submit(guarded, task)
+                running[future] = task
+                if timeout is not None:
+                    deadlines[future] = time.monotonic() + timeout + TIMEOUT_GRACE
+
+            try:
+                while pending or running:
+                    while pending and len(running) < max_running and not (running and budget is not None and budget.exceeded()):
+                        submit(pending.popleft())
+
+                    next_deadline = min(deadlines.values()) - time.monotonic() if deadlines else None
+                    done, _ = wait(running, timeout = None if next_deadline is None else max(0, next_deadline), return_when = FIRST_COMPLETED)
+                    for future in done:
+                        ok, result = future.result()
+                        deadlines.pop(future, None)
+                        yield running.pop(future), ok, result
+
+                    expired = [future for future, deadline in deadlines.items() if deadline <= time.monotonic() and not future.done()]
+                    if expired:
+                        _kill_workers(pool)
+                        for future in expired:
+                            deadlines.pop(future)
+                            yield running.pop(future), False, f"TaskTimeoutError: Task exceeded time limit of {timeout} seconds and was killed."
+                        pending.extendleft(reversed(list(running.values())))
+                        break
+            except BrokenProcessPool:
+                suspects.extend(running.values())
@@ -15,9 +15,14 @@ install_requires = [
     "pandas",
     "s3fs",
     "xarray",
-    "netcdf4"
+    "netcdf4",
+    "threadpoolctl"
 ]
 
+extras_require = {
+    "numba": ["numba"]
+}
+
 
 setup(name='earthnet', 
         version='0.3.10',
@@ -34,4 +39,5 @@ setup(name='earthnet',
                  ],
         packages=find_packages(),
         install_requires=install_requires,
+        extras_require=extras_require,
         )
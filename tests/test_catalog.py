@@ -0,0 +1,55 @@
+"""Minicube metadata catalog and its spatial and temporal queries.
+"""
+import numpy as np
+import pytest
+
+from earthnet.catalog import BBOX_COLUMNS, Catalog, build_catalog
+
+pd = pytest.importorskip("pandas")
+
+CUBES = {
+    "train/32UMC/32UMC_2017-06-20_2017-11-16_1081_1209_2617_2745_22_102_48_128.npz": ("train", ""),
+    "train/29SND/29SND_2018-01-28_2018-06-27_441_569_2745_2873_6_86_42_122.npz": ("train", ""),
+    "iid_test_split/context/32UMC/context_32UMC_2018-05-03_2018-09-30_1209_1337_2617_2745_22_102_48_128.npz": ("iid_test_split", "context"),
+    "iid_test_split/target/32UMC/target_32UMC_2018-05-03_2018-09-30_1209_1337_2617_2745_22_102_48_128.npz": ("iid_test_split", "target"),
+}
+
+
+def write_dataset(root):
+    for relpath in CUBES:
+        (root/relpath).parent.mkdir(parents = True, exist_ok = True)
+        np.savez(root/relpath, highresdynamic = np.zeros((2, 2, 5, 1), dtype = np.float32))
+    (root/"train_STATS.npz").write_bytes(b"")
+
+
+def test_build_and_query(tmp_path):
+    write_dataset(tmp_path/"data")
+
+    catalog = Catalog.build(tmp_path/"data", output_file = tmp_path/"catalog.sqlite")
+
+    assert len(catalog) == len(CUBES)
+    assert {row.path: (row.split, row.kind) for row in catalog.df.itertuples()} == {str(relpath): info for relpath, info in CUBES.items()}
+    assert catalog.cubenames(tile = "29SND") == ["29SND_2018-01-28_2018-06-27_441_569_2745_2873_6_86_42_122"]
+    assert len(catalog.query(split = "iid_test_split", kind = "target")) == 1
+    assert sorted(catalog.query(start = "2018-01-01", end = "2018-04-30").tile) == ["29SND"]
+    assert sorted(catalog.query(start = "2018-07-01").split) == ["iid_test_split", "iid_test_split"]
+
+    saved = Catalog(tmp_path/"catalog.sqlite", data_dir = tmp_path/"data")
+    assert saved.paths(split = "train") == catalog.paths(split = "train")
+    assert all(path.is_file() for path in saved.paths())
+
+
+def test_grid_index_equals_brute_force():
+    rng = np.random.default_rng(0)
+    n = 500
+    lon, lat = rng.uniform(-10, 30, n), rng.uniform(35, 60, n)
+    size = rng.uniform(0.01, 1.5, n)
+    df = pd.DataFrame({"cubename": [f"cube{i}" for i in range(n)], "tile": "32UMC", "split": "train", "kind": "", "path": [f"cube{i}.npz" for i in range(n)], "start_date": pd.Timestamp("2018-01-01"), "end_date": pd.Timestamp("2018-06-01")})
+    df[BBOX_COLUMNS[0]], df[BBOX_COLUMNS[1]], df[BBOX_COLUMNS[2]], df[BBOX_COLUMNS[3]] = lon, lat, lon + size, lat + size
+    df.loc[:9, BBOX_COLUMNS] = np.nan
+    catalog = Catalog(df, cell_size = 0.5)
+
+    for lon_min, lat_min, width, height in [(8.0, 47.5, 1.0, 1.0), (-12, 30, 50, 40), (0.25, 50.25, 0.1, 0.1), (-0.3, 40.1, 2.7, 0.4)]:
+        bbox = (lon_min, lat_min, lon_min + width, lat_min + height)
+        expected = df[(df.lon_min <= bbox[2]) & (df.lon_max >= bbox[0]) & (df.lat_min <= bbox[3]) & (df.lat_max >= bbox[1])]
+        assert sorted(catalog.cubenames(bbox = bbox)) == sorted(expected.cubename)
@@ -0,0 +1,47 @@
+"""Conversion of EarthNet2021x minicubes to EarthNet2021-like NPZ.
+"""
+import numpy as np
+import pytest
+
+from earthnet import download_v2
+from earthnet.plot_cube import cube_frames
+
+xr = pytest.importorskip("xarray")
+pd = pytest.importorskip("pandas")
+
+CUBENAME = "29SND_2018-09-03_2019-01-30_441_569_2745_2873_6_86_42_122"
+
+
+def write_minicube(path, t: int = 20, hw: int = 8, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    coords = {"time": pd.date_range("2018-09-03", periods = t), "lat": np.linspace(40, 39.9, hw), "lon": np.linspace(-8, -7.9, hw)}
+    ds = xr.Dataset({band: (("time", "lat", "lon"), rng.random((t, hw, hw)).astype(np.float32)) for band in ["s2_B02", "s2_B03", "s2_B04", "s2_B8A"]}, coords = coords)
+    ds["s2_mask"] = (("time", "lat", "lon"), rng.integers(0, 4, (t, hw, hw)).astype(np.float32))
+    ds["cop_dem"] = (("lat", "lon"), rng.random((hw, hw)).astype(np.float32) * 500)
+    for var in download_v2.EOBS_VARIABLES:
+        ds[var] = (("time",), rng.random(t).astype(np.float32) * 10)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    ds.to_netcdf(path)
+    return path
+
+
+def test_convert_split_compact_by_default(tmp_path):
+    source = write_minicube(tmp_path/"en21x"/"29SND"/f"{CUBENAME}.nc")
+
+    assert download_v2.convert_en21x_to_npz(tmp_path/"en21x", tmp_path/"npz") == []
+
+    npz = np.load(tmp_path/"npz"/"29SND"/f"{CUBENAME}.npz")
+    assert npz["mesodynamic"].shape == (1, 1, 5, 20) and npz["mesostatic"].shape == (1, 1, 1)
+    expected = download_v2.load_en21x_as_npz(source)
+    for key, array in download_v2.expand_meso(npz).items():
+        np.testing.assert_array_equal(array, expected[key])
+    np.testing.assert_array_equal(cube_frames(npz, "tg"), cube_frames(expected, "tg"))
+
+
+def test_convert_split_full_grid(tmp_path):
+    write_minicube(tmp_path/"en21x"/"29SND"/f"{CUBENAME}.nc")
+
+    assert download_v2.convert_en21x_to_npz(tmp_path/"en21x", tmp_path/"npz", compact = False) == []
+
+    npz = np.load(tmp_path/"npz"/"29SND"/f"{CUBENAME}.npz")
+    assert npz["mesodynamic"].shape == (80, 80, 5, 20) and npz["mesostatic"].shape == (80, 80, 1)
@@ -0,0 +1,24 @@
+"""Importing earthnet has to stay fast, heavy dependencies are only imported where they are used.
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+
+HEAVY_MODULES = ["skimage", "scipy", "xarray", "pandas", "matplotlib", "pyproj", "numba", "s3fs"]
+
+
+@pytest.mark.parametrize("module", ["earthnet", "earthnet.parallel_score", "earthnet.score_v2"])
+def test_import_is_lazy(module):
+    code = f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True, cwd = REPO_DIR)
+    assert result.stdout.split() == [], f"import {module} imported {result.stdout.strip()}"
+
+
+def test_lazy_attributes_resolve():
+    code = "import earthnet; [getattr(earthnet, name) for name in earthnet.__all__]; print('ok')"
+    result = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True, cwd = REPO_DIR)
+    assert result.stdout.strip() == "ok"
@@ -0,0 +1,127 @@
+"""Parity of the compiled EarthNetScore kernels with the NumPy/SciPy reference implementation.
+"""
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+
+from earthnet import kernels
+from earthnet.parallel_score import CubeCalculator
+
+requires_numba = pytest.mark.skipif(not kernels.HAS_NUMBA, reason = "Numba is not installed")
+
+
+def synthetic_cube(t: int, seed: int = 0, h: int = 6, w: int = 8):
+    """NDVI-like predictions, targets and masks of shape h,w,1,t with fully masked, sparse and dense pixels
+
+    Row 0 is fully masked, row 1 has a single non-masked value per 20 steps, row 2 has two, row 3 has a few and the remaining rows are dense.
+    """
+    rng = np.random.default_rng(seed)
+    preds = rng.uniform(-0.2, 0.9, (h, w, 1, t))
+    targs = np.clip(preds + rng.normal(0, 0.2, (h, w, 1, t)), -1, 1)
+    masks = rng.random((h, w, 1, t)) > 0.3
+    masks[0] = False
+    masks[1:3] = False
+    for start in range(0, t, 20):
+        masks[1, :, :, start + rng.integers(20)] = True
+        masks[2, :, :, start + rng.choice(20, 2, replace = False)] = True
+    masks[3] = rng.random((w, 1, t)) > 0.85
+    return preds, targs, masks
+
+
+def reference_slopes(preds: np.ndarray, targs: np.ndarray, masks: np.ndarray, noise: np.ndarray):
+    """Slopes from the regularized normal equations of `CubeCalculator.OLS`, one pixel at a time"""
+    n, t = preds.shape
+    x = np.linspace(1, 2, t)
+    btarg, bpred = np.zeros(n), np.zeros(n)
+    for i in range(n):
+        valid = masks[i].astype(bool)
+        if valid.sum() < 2:
+            A, Apred = np.zeros((t, 2)), np.zeros((t, 2))
+        else:
+            xmin, xmax = x[valid].min(), x[valid].max()
+            inside = (x >= xmin) & (x <= xmax)
+            a = 2 * ((x - xmin) / (xmax - xmin + 1e-8) + 1)
+            A = np.stack([a, np.ones(t)], axis = 1) * valid[:, None]
+            Apred = np.stack([a, np.ones(t)], axis = 1) * inside[:, None]
+        btarg[i] = (np.linalg.inv(A.T @ A + noise[i]) @ (A.T @ (targs[i] * valid)))[0]
+        bpred[i] = (np.linalg.inv(Apred.T @ Apred + noise[i]) @ (Apred.T @ (preds[i] * (Apred[:, 1] > 0))))[0]
+    return btarg, bpred
+
+
+@contextmanager
+def backend(name: str):
+    previous = CubeCalculator.backend
+    CubeCalculator.set_backend(name)
+    try:
+        yield
+    finally:
+        CubeCalculator.backend = previous
+
+
+@pytest.mark.parametrize("t", [20, 40, 60])
+def test_w1_distances(t):
+    preds, targs, masks = synthetic_cube(t)
+    preds, targs, masks = [np.reshape(a, (-1, t)) for a in (preds, targs, masks)]
+
+    dists = kernels.w1_distances(preds, targs, masks)
+    expected = np.apply_along_axis(CubeCalculator.compute_w1, -1, np.concatenate([preds, targs, masks], axis = -1))
+
+    np.testing.assert_allclose(dists, expected, rtol = 1e-10, atol = 1e-12)
+    assert np.isnan(dists[:8]).all()
+    assert np.isnan(dists[8:16]).all() == (t == 20)
+
+
+@pytest.mark.parametrize("t", [20, 40, 60])
+def test_ols_slopes(t):
+    preds, targs, masks = synthetic_cube(t)
+    preds, targs, masks = [np.reshape(a, (-1, t)) for a in (preds, targs, masks)]
+    noise = np.random.default_rng(1).random((len(preds), 2, 2)) / 10000
+
+    btarg, bpred = kernels.ols_slopes(preds, targs, masks, noise)
+    expected_btarg, expected_bpred = reference_slopes(preds, targs, masks, noise)
+
+    np.testing.assert_allclose(btarg, expected_btarg, rtol = 1e-7, atol = 1e-9)
+    np.testing.assert_allclose(bpred, expected_bpred, rtol = 1e-7, atol = 1e-9)
+    assert (btarg[:8] == 0).all() and (bpred[:8] == 0).all()
+
+
+def assert_debug_info_close(actual: dict, expected: dict):
+    assert actual.keys() == expected.keys()
+    for key in expected:
+        if key == "lead_time":
+            for a, b in zip(actual[key], expected[key]):
+                np.testing.assert_allclose(a, b, rtol = 1e-7, atol = 1e-9)
+        else:
+            np.testing.assert_allclose(actual[key], expected[key], rtol = 1e-7, atol = 1e-9, err_msg = key)
+
+
+@requires_numba
+@pytest.mark.parametrize("t", [20, 40, 60])
+@pytest.mark.parametrize("subscore", ["OLS", "EMD"])
+def test_subscores_numba_vs_numpy(subscore, t):
+    preds, targs, masks = synthetic_cube(t)
+
+    results = {}
+    for name in ["numpy", "numba"]:
+        np.random.seed(0)
+        with backend(name):
+            results[name] = getattr(CubeCalculator, subscore)(preds.copy(), targs.copy(), masks.copy())
+
+    np.testing.assert_allclose(results["numba"][0], results["numpy"][0], rtol = 1e-7)
+    assert_debug_info_close(results["numba"][1], results["numpy"][1])
+
+
+@requires_numba
+def test_ols_masks_in_place_numba_vs_numpy():
+    preds, targs, masks = synthetic_cube(60)
+
+    updated = {}
+    for name in ["numpy", "numba"]:
+        np.random.seed(0)
+        updated[name] = masks.copy()
+        with backend(name):
+            CubeCalculator.OLS(preds.copy(), targs.copy(), updated[name])
+
+    np.testing.assert_array_equal(updated["numba"], updated["numpy"])
+    assert not updated["numpy"][1].any()
@@ -0,0 +1,60 @@
+"""Manifests of downloaded files and verification and repair of datasets.
+"""
+import numpy as np
+
+from earthnet import manifest
+from earthnet.download import Downloader
+
+
+def write_files(root, n: int = 4):
+    relpaths = []
+    for i in range(n):
+        relpath = f"train/32UMC/cube{i}.npz"
+        (root/relpath).parent.mkdir(parents = True, exist_ok = True)
+        np.savez_compressed(root/relpath, highresdynamic = np.full((4, 4, 5, 2), i, dtype = np.float32))
+        relpaths.append(relpath)
+    return relpaths
+
+
+def flip_byte(path, position: int = -30):
+    data = bytearray(path.read_bytes())
+    data[position] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+
+def test_verify_against_manifest(tmp_path):
+    relpaths = write_files(tmp_path)
+    saved = manifest.update_manifest(tmp_path, {relpath: f"train_{i % 2}.tar.gz" for i, relpath in enumerate(relpaths)}, num_workers = 1)
+    assert manifest.load_manifest(tmp_path) == saved and saved[relpaths[0]]["size"] == (tmp_path/relpaths[0]).stat().st_size
+
+    assert manifest.verify_dataset(tmp_path, num_workers = 1) == {"missing": [], "corrupt": [], "sources": []}
+
+    flip_byte(tmp_path/relpaths[1])
+    (tmp_path/relpaths[2]).unlink()
+    assert manifest.verify_dataset(tmp_path, num_workers = 1) == {"missing": [relpaths[2]], "corrupt": [relpaths[1]], "sources": ["train_0.tar.gz", "train_1.tar.gz"]}
+
+
+def test_verify_without_manifest_builds_one(tmp_path):
+    relpaths = write_files(tmp_path)
+    (tmp_path/relpaths[3]).write_bytes((tmp_path/relpaths[3]).read_bytes()[:100])
+
+    report = manifest.verify_dataset(tmp_path, num_workers = 1)
+
+    assert report == {"missing": [], "corrupt": [relpaths[3]], "sources": []}
+    assert sorted(manifest.load_manifest(tmp_path)) == relpaths[:3]
+    flip_byte(tmp_path/relpaths[0])
+    assert manifest.verify_dataset(tmp_path, num_workers = 1)["corrupt"] == [relpaths[0]]
+
+
+def test_repair_fetches_only_broken_tarballs(tmp_path, monkeypatch):
+    relpaths = write_files(tmp_path)
+    manifest.update_manifest(tmp_path, {relpath: f"train_{i}.tar.gz" for i, relpath in enumerate(relpaths)}, num_workers = 1)
+    (tmp_path/relpaths[1]).unlink()
+
+    fetched = []
+    monkeypatch.setattr(Downloader, "__URL__", {"train": [(f"train_{i}.tar.gz", f"https://example.org/train_{i}.tar.gz", "sha") for i in range(4)]})
+    monkeypatch.setattr(Downloader, "fetch", lambda self, split, filename, *args, **kwargs: fetched.append((split, filename)))
+
+    report = Downloader.verify(tmp_path, repair = True, num_workers = 1)
+
+    assert report["missing"] == [relpaths[1]] and fetched == [("train", "train_1.tar.gz")]
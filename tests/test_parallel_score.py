@@ -0,0 +1,267 @@
+"""EarthNetScore subscores, lead time curves and aggregation.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+from earthnet import store
+from earthnet.parallel_score import CubeCalculator, EarthNetScore
+
+
+def ndvi_cube(t: int, seed: int = 0, h: int = 6, w: int = 8):
+    rng = np.random.default_rng(seed)
+    preds = rng.uniform(-0.2, 0.9, (h, w, 1, t))
+    targs = np.clip(preds + rng.normal(0, 0.2, (h, w, 1, t)), -1, 1)
+    masks = rng.random((h, w, 1, t)) > 0.3
+    return preds, targs, masks
+
+
+@pytest.mark.parametrize("t", [20, 60])
+def test_emd_without_lead_time(t):
+    preds, targs, masks = ndvi_cube(t)
+
+    emd, debug_info = CubeCalculator.EMD(preds, targs, masks, lead_time = True)
+    emd_only, debug_info_only = CubeCalculator.EMD(preds, targs, masks, lead_time = False)
+
+    assert emd_only == emd
+    values, weights = debug_info_only["lead_time"]
+    if t > 40:
+        assert len(values) == 0 and len(weights) == 0
+        assert len(debug_info["lead_time"][0]) == t // 20
+    else:
+        np.testing.assert_array_equal(values, debug_info["lead_time"][0])
+
+
+TILES = ["29SND", "32UMC", "33UUP"]
+
+
+def cubename(i: int) -> str:
+    return f"{TILES[i % 3]}_2018-{1 + (i * 5) % 12:02d}-01_2018-11-23_{1000 + i}_{1128 + i}_2617_2745_22_102_48_128"
+
+
+def write_dataset(root, n: int = 9, n_samples: int = 2, t: int = 4):
+    """Tiny target and prediction cubes, enough for matching paths and the preflight"""
+    for i in range(n):
+        tile, name = TILES[i % 3], cubename(i)
+        (root/"target"/tile).mkdir(parents = True, exist_ok = True)
+        np.savez(root/"target"/tile/f"target_{name}.npz", highresdynamic = np.zeros((8, 8, 5, t), dtype = np.float32))
+        (root/"preds"/tile).mkdir(parents = True, exist_ok = True)
+        for s in range(n_samples):
+            np.savez(root/"preds"/tile/f"exp{s}_{name}.npz", highresdynamic = np.zeros((8, 8, 4, t), dtype = np.float32))
+
+
+def scored(filepaths, seed: int = 0) -> dict:
+    """Synthetic subscores in the format of `EarthNetScore.compute_scores`"""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for paths in sorted(filepaths, key = lambda paths: (paths["targ_filepath"], paths["pred_filepath"])):
+        sample = {"pred_filepath": str(paths["pred_filepath"]), "targ_filepath": str(paths["targ_filepath"]), **dict(zip(["MAD", "OLS", "EMD", "SSIM"], rng.uniform(0.1, 0.9, 4).tolist()))}
+        data.setdefault(store.cubename_of(paths["targ_filepath"]), []).append(sample)
+    return data
+
+
+def test_shards_partition_targets_before_matching(tmp_path):
+    write_dataset(tmp_path)
+    full = EarthNetScore(tmp_path/"preds", tmp_path)
+    assert len(full.filepaths) == 18
+
+    seen = []
+    for shard_index in range(3):
+        shard = EarthNetScore(tmp_path/"preds", tmp_path, shard_index = shard_index, num_shards = 3)
+        filtered = EarthNetScore(tmp_path/"preds", tmp_path)
+        filtered.shard(shard_index, 3)
+        assert shard.filepaths == filtered.filepaths
+        seen.extend(str(paths["pred_filepath"]) for paths in shard.filepaths)
+    assert sorted(seen) == sorted(str(paths["pred_filepath"]) for paths in full.filepaths)
+
+
+def test_merged_shards_equal_single_run(tmp_path):
+    write_dataset(tmp_path)
+    full = EarthNetScore(tmp_path/"preds", tmp_path, preflight = False)
+    full.data = scored(full.filepaths)
+
+    shard_files = []
+    for shard_index in range(3):
+        shard = EarthNetScore(tmp_path/"preds", tmp_path, preflight = False, shard_index = shard_index, num_shards = 3)
+        shard.data = {cube: samples for cube, samples in full.data.items() if any(sample["targ_filepath"] == str(paths["targ_filepath"]) for sample in samples for paths in shard.filepaths)}
+        shard.save_shard(tmp_path/f"shard_{shard_index}.json")
+        shard_files.append(tmp_path/f"shard_{shard_index}.json")
+
+    assert EarthNetScore.merge_shards(shard_files) == full.summarize()
+
+
+def test_vectorized_harmonic_mean_equals_scalar():
+    from earthnet.parallel_score import _harmonic_means
+
+    rows = [[0.5, 0.2, 0.7, 0.9], [0.5, np.nan, 0.7, 0.9], [0.5, 0.0, 0.7, 0.9], [0.0, np.nan, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [np.nan] * 4, [1.0, 1.0, 0.999, 1.0]]
+    scalar = [EarthNetScore._EarthNetScore__harmonic_mean(None, row) for row in rows]
+
+    np.testing.assert_array_equal(_harmonic_means(np.array(rows)), [np.nan if value is None else value for value in scalar])
+
+
+@pytest.mark.parametrize("max_elements", [2**24, 50])
+def test_bootstrap_means_equal_explicit_resampling(max_elements):
+    from earthnet.parallel_score import _bootstrap_means
+
+    rng = np.random.default_rng(1)
+    scores = rng.uniform(0, 1, (20, 4))
+    scores[rng.random(scores.shape) < 0.2] = np.nan
+
+    means, = _bootstrap_means([scores], 30, seed = 3, max_elements = max_elements)
+
+    idxs = np.random.default_rng(3).integers(0, 20, (30, 20))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category = RuntimeWarning)
+        expected = np.nanmean(scores[idxs], axis = 1)
+    np.testing.assert_allclose(means, expected)
+
+
+def test_bootstrap_and_paired_comparison(tmp_path):
+    write_dataset(tmp_path)
+    ens_a = EarthNetScore(tmp_path/"preds", tmp_path, preflight = False)
+    ens_a.data = scored(ens_a.filepaths)
+    ens_b = EarthNetScore(tmp_path/"preds", tmp_path, preflight = False)
+    ens_b.data = {cube: [dict(sample, **{key: sample[key] * 0.8 for key in ["MAD", "OLS", "EMD", "SSIM"]}) for sample in samples] for cube, samples in ens_a.data.items()}
+
+    intervals = ens_a.bootstrap(n_boot = 500, seed = 0)
+    summary = ens_a.summarize()
+    for value, interval in zip(summary, intervals.values()):
+        assert interval["estimate"] == pytest.approx(value) and interval["lower"] <= value <= interval["upper"]
+
+    same = EarthNetScore.compare(ens_a, ens_a, n_boot = 200, seed = 0)
+    assert all(result["difference"] == 0 and result["p_value"] == 1 for result in same.values())
+    better = EarthNetScore.compare(ens_a, ens_b, n_boot = 200, seed = 0)
+    assert all(result["lower"] > 0 and result["p_value"] == 0 for result in better.values())
+
+
+def test_stratified_order_prefixes_are_proportional():
+    from earthnet.parallel_score import cube_stratum, stratified_order
+
+    cubenames = [cubename(i) for i in range(60)] + [f"exp1_{cubename(i)}" for i in range(60, 70)]
+    order = stratified_order(cubenames, seed = 1)
+
+    assert sorted(order) == sorted(cubenames) and order == stratified_order(list(reversed(cubenames)), seed = 1)
+    strata = [cube_stratum(name) for name in cubenames]
+    sizes = {stratum: strata.count(stratum) for stratum in set(strata)}
+    for k in range(1, len(order) + 1):
+        prefix = [cube_stratum(name) for name in order[:k]]
+        for stratum, size in sizes.items():
+            assert abs(prefix.count(stratum) - k * size / len(order)) <= 2
+
+
+def test_stratified_estimate_of_all_cubes_is_the_mean():
+    from earthnet.parallel_score import _stratified_estimate
+
+    rng = np.random.default_rng(0)
+    scores = rng.uniform(0, 1, (30, 4))
+    scores[rng.random(scores.shape) < 0.1] = np.nan
+    strata = [("29SND", "JJA"), ("32UMC", "DJF"), ("33UUP", "MAM")] * 10
+
+    mean, cov = _stratified_estimate(scores, strata, {stratum: 10 for stratum in set(strata)})
+    np.testing.assert_allclose(mean, np.nanmean(scores, axis = 0))
+    np.testing.assert_array_equal(cov, 0)
+
+    mean, cov = _stratified_estimate(scores[:15], strata[:15], {stratum: 10 for stratum in set(strata)})
+    assert (np.diag(cov) > 0).all()
+
+
+def test_pixel_subsample():
+    from earthnet.parallel_score import _subsample_pixels
+
+    preds, targs, masks = ndvi_cube(20, h = 8, w = 8)
+    all_pixels = _subsample_pixels([preds, targs, masks], 1, seed = 0)
+    assert CubeCalculator.EMD(*all_pixels)[0] == pytest.approx(CubeCalculator.EMD(preds, targs, masks)[0])
+
+    sub_preds, sub_targs = _subsample_pixels([preds, targs], 0.25, seed = 5)
+    assert sub_preds.shape == (16, 1, 1, 20)
+    rows = [np.flatnonzero((preds.reshape(64, 1, 1, 20) == pixel).all(axis = (1, 2, 3)))[0] for pixel in sub_preds]
+    np.testing.assert_array_equal(sub_targs, targs.reshape(64, 1, 1, 20)[rows])
+
+
+def lead_time_sample(rng, t: int) -> dict:
+    return {key: (rng.uniform(0, 1, n), (rng.random(n) > 0.2).astype(np.float64)) for key, n in zip(["MAD", "SSIM", "OLS", "EMD"], [t, t, max(1, t // 20), max(1, t // 20)])}
+
+
+def test_lead_time_curves_add_the_best_sample():
+    from earthnet.parallel_score import LeadTimeCurves
+
+    rng = np.random.default_rng(0)
+    good, bad = lead_time_sample(rng, 20), lead_time_sample(rng, 20)
+    scores = {"good": {"pred_filepath": "b", "MAD": 0.9, "OLS": 0.9, "EMD": 0.9, "SSIM": 0.9}, "bad": {"pred_filepath": "a", "MAD": 0.5, "OLS": None, "EMD": 0.5, "SSIM": 0.5}}
+
+    curves = LeadTimeCurves({"cube": 3})
+    curves.add_sample("cube", scores["bad"], bad)
+    curves.add_sample("cube", {"pred_filepath": "c"}, None)
+    assert curves.to_dict()["counts"]["MAD"] == []
+    curves.add_sample("cube", scores["good"], good)
+
+    expected = LeadTimeCurves()
+    expected.add(good)
+    assert curves.to_dict() == expected.to_dict() and "cube" not in curves.pending
+
+
+def test_merged_lead_time_curves_equal_single_pass():
+    from earthnet.parallel_score import LeadTimeCurves
+
+    rng = np.random.default_rng(0)
+    samples = [lead_time_sample(rng, t) for t in [20, 60, 40, 80, 20]]
+    full, parts = LeadTimeCurves(), [LeadTimeCurves(), LeadTimeCurves()]
+    for i, sample in enumerate(samples):
+        full.add(sample)
+        parts[i % 2].add(sample)
+    merged = LeadTimeCurves()
+    for part in parts:
+        merged.merge(part.to_dict())
+
+    for key in LeadTimeCurves.KEYS:
+        np.testing.assert_allclose(merged.sums[key], full.sums[key])
+        np.testing.assert_allclose(merged.counts[key], full.counts[key])
+    mad = np.zeros(80)
+    weight = np.zeros(80)
+    for values, weights in (sample["MAD"] for sample in samples):
+        mad[:len(values)] += values
+        weight[:len(values)] += weights
+    np.testing.assert_allclose(full.curves()["MAD"], mad / weight)
+    assert len(full.curves()["OLS"]) == 4
+
+
+def test_npz_headers_equal_arrays(tmp_path):
+    from earthnet.parallel_score import read_npz_headers
+
+    arrays = {"highresdynamic": np.zeros((8, 8, 5, 3), dtype = np.float16), "names": np.array(["a", "bc"]), "scalar": np.int64(3)}
+    np.savez(tmp_path/"plain.npz", **arrays)
+    np.savez_compressed(tmp_path/"compressed.npz", **arrays)
+
+    for path in [tmp_path/"plain.npz", tmp_path/"compressed.npz"]:
+        with np.load(path) as npz:
+            assert read_npz_headers(path) == {key: (npz[key].shape, npz[key].dtype) for key in npz.files}
+
+
+def test_preflight_reports_all_problems(tmp_path):
+    from earthnet.parallel_score import preflight_check
+
+    write_dataset(tmp_path, n = 6, n_samples = 1, t = 60)
+    broken = {
+        0: None,
+        1: np.zeros((8, 8, 4, 60), dtype = "<U1"),
+        2: np.zeros((8, 8, 3, 60), dtype = np.float32),
+        3: np.zeros((8, 8, 4, 50), dtype = np.float32),
+        4: np.zeros((8, 6, 4, 60), dtype = np.float32),
+    }
+    for i, array in broken.items():
+        path = tmp_path/"preds"/TILES[i % 3]/f"exp0_{cubename(i)}.npz"
+        if array is None:
+            path.write_bytes(b"not a zip file")
+        else:
+            np.savez(path, highresdynamic = array)
+
+    ens = EarthNetScore(tmp_path/"preds", tmp_path, preflight = False)
+    failed = preflight_check(ens.filepaths, n_workers = 0)
+
+    problems = {store.cubename_of(result["pred_filepath"]): " ".join(result["problems"]) for result in failed}
+    assert sorted(problems) == sorted(cubename(i) for i in broken)
+    for i, message in enumerate(["Prediction cannot be read", "non-numeric dtype", "3 bands", "50 frames", "but target highresdynamic has shape"]):
+        assert message in problems[cubename(i)]
+    with pytest.raises(AssertionError, match = "Preflight found problems with 5 of 6 predictions"):
+        EarthNetScore(tmp_path/"preds", tmp_path)
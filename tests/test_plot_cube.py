@@ -0,0 +1,34 @@
+"""Colormap lookup tables and landcover conversion.
+"""
+import numpy as np
+import pytest
+
+from earthnet import plot_cube
+
+pytest.importorskip("matplotlib")
+
+
+@pytest.mark.parametrize("colormap", ["ndvi", "viridis"])
+def test_colorize_equals_matplotlib(colormap):
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-0.2, 1.2, (3, 16, 16))
+    data[0, 0, :4] = [0, 1, np.nan, 0.5]
+    mask_red = rng.random(data.shape) < 0.1
+    mask_blue = rng.random(data.shape) > 0.1
+
+    out = plot_cube.colorize(data, colormap, mask_red = mask_red, mask_blue = mask_blue)
+
+    expected = plot_cube.get_colormap(colormap)(data, bytes = True)[..., :3]
+    expected[np.isnan(data) | mask_red] = plot_cube.RGB_RED
+    expected[~mask_blue] = plot_cube.RGB_CLOUD
+    assert out.dtype == np.uint8 and out.shape == data.shape + (3,)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_lc_convert_equals_dict_lookup():
+    codes = np.array([[0, 62, 73, 75], [82, 83, 102, 255], [1, 100, 250, 104]], dtype = np.uint8)
+
+    expected = np.vectorize(lambda code: plot_cube.LC_CONVERTED.get(code, plot_cube.LC_CONVERTED[255])[0])(codes)
+
+    np.testing.assert_array_equal(plot_cube.lc_convert(codes), expected)
+    np.testing.assert_array_equal(plot_cube.lc_convert(codes.astype(np.float32)), expected)
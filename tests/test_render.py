@@ -0,0 +1,135 @@
+"""Outputs of the batch renderer, the reports and the streaming PNG/APNG/PDF writers.
+"""
+import re
+import zlib
+import struct
+
+import numpy as np
+
+from earthnet.plot_cube import sample_points
+from earthnet.render import APNGWriter, PDFWriter, render_batch, render_report, worst_cubes, write_png
+
+CUBENAME = "29SND_2017-06-20_2017-11-16_2105_2233_2873_3001_32_112_44_124"
+
+
+def write_cube(path, t: int = 10, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    hrd = rng.uniform(0, 0.5, (128, 128, 5, t))
+    hrd[..., 4, :] = 0
+    np.savez(path, highresdynamic = hrd, highresstatic = rng.uniform(0, 500, (128, 128, 1)))
+    return path
+
+
+def png_chunks(path):
+    data = path.read_bytes()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, chunks = 8, []
+    while pos < len(data):
+        length, = struct.unpack(">I", data[pos:pos + 4])
+        tag, body = data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(tag + body)
+        chunks.append((tag, body))
+        pos += 12 + length
+    return chunks
+
+
+def test_write_png_round_trip(tmp_path):
+    image = np.random.default_rng(0).integers(0, 256, (7, 5, 3), dtype = np.uint8)
+    write_png(tmp_path/"image.png", image)
+
+    chunks = png_chunks(tmp_path/"image.png")
+    w, h = struct.unpack(">II", chunks[0][1][:8])
+    raw = np.frombuffer(zlib.decompress(b"".join(body for tag, body in chunks if tag == b"IDAT")), dtype = np.uint8).reshape(h, -1)
+    assert (w, h) == (5, 7)
+    np.testing.assert_array_equal(raw[:, 1:].reshape(image.shape), image)
+
+
+def test_apng_writer_frame_count(tmp_path):
+    writer = APNGWriter(tmp_path/"anim.png", n_frames = 3)
+    for i in range(3):
+        writer.write(np.full((4, 4, 3), 80 * i, dtype = np.uint8))
+    writer.close()
+
+    tags = [tag for tag, body in png_chunks(tmp_path/"anim.png")]
+    num_frames, = struct.unpack(">I", dict(png_chunks(tmp_path/"anim.png"))[b"acTL"][:4])
+    assert num_frames == 3 and tags.count(b"fcTL") == 3 and tags[-1] == b"IEND"
+
+
+def test_render_batch_animations_do_not_overwrite_galleries(tmp_path):
+    cube = write_cube(tmp_path/f"{CUBENAME}.npz")
+    out = tmp_path/"out"
+
+    assert render_batch([cube], out, kind = "gallery") == []
+    gallery = (out/f"{CUBENAME}_rgb.png").read_bytes()
+    assert render_batch([cube], out, kind = "animation") == []
+
+    assert (out/f"{CUBENAME}_rgb.png").read_bytes() == gallery
+    assert b"acTL" in (out/f"{CUBENAME}_rgb_anim.png").read_bytes()
+
+
+def test_worst_cubes_ranks_zero_subscores_first():
+    scores = {
+        "good": {"MAD": 0.9, "OLS": 0.8, "EMD": 0.9, "SSIM": 0.9},
+        "bad": {"MAD": 0.3, "OLS": 0.2, "EMD": 0.3, "SSIM": 0.4},
+        "zero": {"MAD": 0.9, "OLS": 0.0, "EMD": 0.9, "SSIM": 0.9},
+        "missing": {"MAD": None, "OLS": None, "EMD": None, "SSIM": None},
+        "partial": {"MAD": 0.5, "OLS": None, "EMD": 0.5, "SSIM": 0.5},
+    }
+    for cube, sample in scores.items():
+        sample.update(pred_filepath = f"pred_{cube}", targ_filepath = f"targ_{cube}")
+
+    worst = worst_cubes(scores, n = None)
+
+    assert [pred for pred, _ in worst] == ["pred_zero", "pred_bad", "pred_partial", "pred_good", "pred_missing"]
+    assert worst_cubes(scores, n = 2) == [("pred_zero", "targ_zero"), ("pred_bad", "targ_bad")]
+
+
+def test_sample_points_one_pixel_per_vegetation_class():
+    landcover = np.full((128, 128), 62, dtype = np.uint8)
+    landcover[10:20, 10:20] = 82
+    landcover[50, 50:60] = 73
+    landcover[100:, :] = 102
+
+    coords = sample_points(landcover, n = 8)
+
+    assert coords.shape == (8, 2)
+    assert landcover[tuple(coords[:3].T)].tolist() == [73, 82, 102]
+    assert ((coords >= 0) & (coords < 128)).all()
+
+
+def pdf_objects(path):
+    data = path.read_bytes()
+    xref = int(re.search(rb"startxref\n(\d+)", data).group(1))
+    size = int(re.search(rb"xref\n0 (\d+)", data[xref:]).group(1))
+    offsets = [int(line[:10]) for line in data[xref:].split(b"\n")[3:2 + size]]
+    for number, offset in enumerate(offsets, start = 1):
+        assert data[offset:].startswith(f"{number} 0 obj".encode())
+    return data
+
+
+def test_pdf_writer_pages(tmp_path):
+    writer = PDFWriter(tmp_path/"report.pdf", dpi = 72)
+    images = [np.random.default_rng(i).integers(0, 256, (6, 9, 3), dtype = np.uint8) for i in range(3)]
+    for image in images:
+        writer.write(image)
+    writer.close()
+
+    data = pdf_objects(tmp_path/"report.pdf")
+    assert b"/Count 3" in data and data.count(b"/Type /Page ") == 3 and b"/MediaBox [0 0 9.00 6.00]" in data
+    streams = re.findall(rb"/Subtype /Image .*?stream\n(.*?)\nendstream", data, re.S)
+    for image, stream in zip(images, streams):
+        raw = np.frombuffer(zlib.decompress(stream), dtype = np.uint8).reshape(6, -1)
+        np.testing.assert_array_equal(raw[:, 1:].reshape(image.shape), image)
+
+
+def test_render_report_skips_failed_cubes(tmp_path):
+    cubes = [(write_cube(tmp_path/f"pred_{i}.npz", seed = i), write_cube(tmp_path/f"target_{CUBENAME}_{i}.npz", seed = 10 + i)) for i in range(2)]
+    cubes.insert(1, (tmp_path/"missing.npz", tmp_path/"missing_target.npz"))
+
+    for suffix in [".pdf", ".html"]:
+        failed = render_report(cubes, tmp_path/f"report{suffix}", dpi = 30)
+        assert [path for path, _ in failed] == [str(tmp_path/"missing_target.npz")]
+
+    assert pdf_objects(tmp_path/"report.pdf").count(b"/Type /Page ") == 2
+    assert (tmp_path/"report.html").read_text().count("<img src=\"data:image/png;base64,") == 2
@@ -0,0 +1,110 @@
+"""Normalized NSE scoring of EarthNet2021x predictions.
+"""
+import numpy as np
+import pytest
+
+from earthnet import score_v2
+
+xr = pytest.importorskip("xarray")
+pd = pytest.importorskip("pandas")
+
+CUBENAMES = {"29SND": ["cube_a", "cube_b"], "32UMC": ["cube_c"]}
+
+
+def write_target(path, t: int = 100, hw: int = 6, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    coords = {"time": pd.date_range("2018-01-01", periods = t), "lat": np.linspace(40, 39.9, hw), "lon": np.linspace(-8, -7.9, hw)}
+    targ = xr.Dataset({band: (("time", "lat", "lon"), rng.uniform(0.05, 0.5, (t, hw, hw)).astype(np.float32)) for band in ["s2_B8A", "s2_B04"]}, coords = coords)
+    targ["s2_mask"] = (("time", "lat", "lon"), (rng.random((t, hw, hw)) > 0.7).astype(np.float32))
+    targ["esawc_lc"] = (("lat", "lon"), rng.choice([10., 20., 30., 40., np.nan], (hw, hw)))
+    path.parent.mkdir(parents = True, exist_ok = True)
+    targ.to_netcdf(path)
+    return targ
+
+
+def write_prediction(path, targ, n: int = 10, seed: int = 0, name: str = "ndvi_pred"):
+    rng = np.random.default_rng(seed)
+    time = targ.time.isel(time = slice(4, None, 5)).values[-n:]
+    pred = xr.Dataset({name: (("time", "lat", "lon"), rng.uniform(0, 1, (n, len(targ.lat), len(targ.lon))).astype(np.float32))}, coords = {"time": time, "lat": targ.lat.values, "lon": targ.lon.values})
+    path.parent.mkdir(parents = True, exist_ok = True)
+    pred.to_netcdf(path)
+
+
+def write_dataset(root, seed: int = 0):
+    i = 0
+    for region, cubenames in CUBENAMES.items():
+        for cubename in cubenames:
+            targ = write_target(root/"test"/region/f"{cubename}.nc", seed = seed + i)
+            write_prediction(root/"preds"/region/f"{cubename}.nc", targ, seed = seed + 10 + i)
+            i += 1
+
+
+def reference_scores(root):
+    frames = [score_v2.score_from_args((path, root/"preds"/path.parent.name/path.name, "ndvi_pred")).reset_index() for path in sorted((root/"test").glob("**/*.nc"))]
+    return pd.concat(frames).sort_values(["id", "lat", "lon"]).reset_index(drop = True)
+
+
+def sorted_scores(df):
+    return df.assign(id = df.id.astype(str)).sort_values(["id", "lat", "lon"]).reset_index(drop = True)
+
+
+def test_compact_arrays_equal_dataframes(tmp_path):
+    write_dataset(tmp_path)
+
+    scores = score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False, num_workers = 2, chunksize = 1)
+
+    expected = reference_scores(tmp_path)
+    df = sorted_scores(scores["all_scores"])
+    np.testing.assert_array_equal(df.id, expected.id)
+    for col in ["lat", "lon", "NNSE", "landcover", "n_obs"]:
+        np.testing.assert_allclose(df[col].to_numpy(dtype = np.float64), expected[col].to_numpy(dtype = np.float64))
+    assert scores["veg_score"] == pytest.approx(2 - 1 / expected[expected.landcover <= 30].NNSE.mean())
+
+
+def test_target_cache(tmp_path):
+    write_dataset(tmp_path)
+    uncached = sorted_scores(score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False)["all_scores"])
+
+    first = score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False, target_cache = tmp_path/"cache")
+    cachefile = tmp_path/"cache"/"29SND"/"cube_a.npz"
+    assert sorted(path.relative_to(tmp_path/"cache").as_posix() for path in (tmp_path/"cache").glob("**/*.npz")) == ["29SND/cube_a.npz", "29SND/cube_b.npz", "32UMC/cube_c.npz"]
+    mtime = cachefile.stat().st_mtime_ns
+    second = score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False, target_cache = tmp_path/"cache")
+    assert cachefile.stat().st_mtime_ns == mtime
+    pd.testing.assert_frame_equal(sorted_scores(first["all_scores"]), uncached)
+    pd.testing.assert_frame_equal(sorted_scores(second["all_scores"]), uncached)
+
+    assert score_v2.load_target_state(cachefile, tmp_path/"test"/"29SND"/"cube_a.nc", 9) is None
+    write_target(tmp_path/"test"/"29SND"/"cube_a.nc", seed = 99)
+    assert score_v2.load_target_state(cachefile, tmp_path/"test"/"29SND"/"cube_a.nc", 10) is None
+    changed = score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False, target_cache = tmp_path/"cache")
+    pd.testing.assert_frame_equal(sorted_scores(changed["all_scores"]), sorted_scores(score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False)["all_scores"]))
+    assert score_v2.load_target_state(cachefile, tmp_path/"test"/"29SND"/"cube_a.nc", 10) is not None
+
+
+def test_preflight_reports_all_problems(tmp_path):
+    write_dataset(tmp_path)
+    with xr.open_dataset(tmp_path/"test"/"29SND"/"cube_a.nc") as targ:
+        targ = targ.load()
+    write_prediction(tmp_path/"preds"/"29SND"/"cube_a.nc", targ, name = "ndvi")
+    write_prediction(tmp_path/"preds"/"29SND"/"cube_b.nc", targ.isel(lat = slice(0, 4)))
+    (tmp_path/"preds"/"32UMC"/"cube_c.nc").unlink()
+
+    problems = {cubename: " ".join(score_v2.check_prediction((tmp_path/"test"/region/f"{cubename}.nc", tmp_path/"preds"/region/f"{cubename}.nc", "ndvi_pred"))) for region, cubenames in CUBENAMES.items() for cubename in cubenames}
+
+    assert "has no variable ndvi_pred, found ndvi" in problems["cube_a"]
+    assert "has grid {'lat': 4, 'lon': 6}, but the target has {'lat': 6, 'lon': 6}" in problems["cube_b"]
+    assert problems["cube_c"] == "Prediction is missing."
+    with pytest.raises(AssertionError, match = "Preflight found problems with 3 of 3 predictions"):
+        score_v2.score_over_dataset(tmp_path/"test", tmp_path/"preds", verbose = False)
+
+
+def test_preflight_checks_time_steps(tmp_path):
+    targ = write_target(tmp_path/"test"/"29SND"/"cube_a.nc")
+    write_prediction(tmp_path/"preds"/"29SND"/"cube_a.nc", targ, n = 20)
+    assert score_v2.check_prediction((tmp_path/"test"/"29SND"/"cube_a.nc", tmp_path/"preds"/"29SND"/"cube_a.nc", "ndvi_pred")) == []
+
+    with xr.open_dataset(tmp_path/"preds"/"29SND"/"cube_a.nc") as pred:
+        pred = pred.load()
+    xr.concat([pred, pred.assign_coords(time = pred.time + np.timedelta64(100, "D"))], "time").to_netcdf(tmp_path/"preds"/"29SND"/"cube_a.nc")
+    assert score_v2.check_prediction((tmp_path/"test"/"29SND"/"cube_a.nc", tmp_path/"preds"/"29SND"/"cube_a.nc", "ndvi_pred")) == ["Prediction ndvi_pred has 40 time steps, the target has 20 (5-daily)."]
@@ -0,0 +1,58 @@
+"""Streaming minicubes from tarball shards.
+"""
+import io
+import tarfile
+
+import numpy as np
+
+from earthnet import shards
+
+
+def cubename(i: int) -> str:
+    return f"32UMC_2018-01-28_2018-11-23_{1000 + i}_1128_2617_2745_22_102_48_128"
+
+
+def write_tarball(path, cubes: range):
+    with tarfile.open(path, "w:gz") as tar:
+        for i in cubes:
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, highresdynamic = np.full((4, 4, 5, 2), i, dtype = np.float32))
+            member = tarfile.TarInfo(f"train/32UMC/{cubename(i)}.npz")
+            member.size = buffer.getbuffer().nbytes
+            buffer.seek(0)
+            tar.addfile(member, buffer)
+        readme = tarfile.TarInfo("train/README.txt")
+        readme.size = 5
+        tar.addfile(readme, io.BytesIO(b"hello"))
+    return path
+
+
+def test_repacked_shard_equals_tarball(tmp_path):
+    tarball = write_tarball(tmp_path/"train_0.tar.gz", range(5))
+
+    index = shards.repack_tarball(tarball, tmp_path/"shards"/"train_0.tar")
+
+    assert [name for name, _, _ in index] == [f"train/32UMC/{cubename(i)}.npz" for i in range(5)]
+    assert shards.index_path(tmp_path/"shards"/"train_0.tar").is_file()
+    indexed, streamed = list(shards.iter_shard(tmp_path/"shards"/"train_0.tar")), list(shards.iter_shard(tarball))
+    assert [name for name, _ in indexed] == [name for name, _ in streamed] == [cubename(i) for i in range(5)]
+    for (_, a), (_, b) in zip(indexed, streamed):
+        np.testing.assert_array_equal(a["highresdynamic"], b["highresdynamic"])
+
+
+def test_shard_dataset_workers_and_shuffling(tmp_path):
+    for s in range(3):
+        shards.repack_tarball(write_tarball(tmp_path/f"train_{s}.tar.gz", range(4 * s, 4 * s + 4)), tmp_path/"shards"/f"train_{s}.tar")
+    all_cubes = sorted(cubename(i) for i in range(12))
+
+    ordered = [name for name, _ in shards.ShardDataset(tmp_path/"shards")]
+    assert ordered == all_cubes
+    per_worker = [[name for name, _ in shards.ShardDataset(tmp_path/"shards", worker_id = w, num_workers = 2)] for w in range(2)]
+    assert sorted(per_worker[0] + per_worker[1]) == all_cubes
+
+    dataset = shards.ShardDataset(tmp_path/"shards", shuffle_buffer = 5, seed = 42)
+    first = [name for name, _ in dataset]
+    assert sorted(first) == all_cubes and first != ordered
+    assert [name for name, _ in dataset] == first
+    dataset.set_epoch(1)
+    assert [name for name, _ in dataset] != first
@@ -0,0 +1,70 @@
+"""Streaming dataset statistics and their cache.
+"""
+import numpy as np
+
+from earthnet import stats
+
+
+def test_merged_welford_equals_numpy():
+    rng = np.random.default_rng(0)
+    x = rng.normal(3, 2, (1000, 4))
+    x[rng.random(x.shape) < 0.1] = np.nan
+
+    welford = stats.Welford(4)
+    for part in np.array_split(x, [10, 400]):
+        partial = stats.Welford(4)
+        partial.update(part)
+        welford.merge(partial)
+
+    np.testing.assert_array_equal(welford.count, (~np.isnan(x)).sum(0))
+    np.testing.assert_allclose(welford.mean, np.nanmean(x, 0))
+    np.testing.assert_allclose(welford.std, np.nanstd(x, 0))
+
+
+def test_histogram_quantile():
+    x = np.random.default_rng(0).uniform(0, 1, (10000, 1))
+    histogram = stats.Histogram(0, 1, bins = 100)
+    histogram.update(x)
+
+    for q in [0.01, 0.5, 0.99]:
+        assert abs(histogram.quantile(q)[0] - np.quantile(x, q)) <= 0.01
+
+
+def write_cube(root, i: int, t: int = 6, seed: int = 0):
+    rng = np.random.default_rng(seed + i)
+    hrd = rng.random((8, 8, 5, t)).astype(np.float32)
+    hrd[..., 4, :] = rng.random((8, 8, t)) > 0.7
+    cubename = f"32UMC_2018-01-28_2018-11-23_{1081 + i}_1209_2617_2745_22_102_48_128"
+    (root/"32UMC").mkdir(parents = True, exist_ok = True)
+    np.savez(root/"32UMC"/f"{cubename}.npz", highresdynamic = hrd, highresstatic = rng.random((8, 8, 1)).astype(np.float32), mesodynamic = rng.random((2, 2, 5, t)).astype(np.float32))
+
+
+def assert_stats_equal(a, b):
+    assert a.manifest == b.manifest
+    assert a.cloud_fraction.keys() == b.cloud_fraction.keys()
+    for relpath in a.cloud_fraction:
+        np.testing.assert_array_equal(a.cloud_fraction[relpath], b.cloud_fraction[relpath])
+    for name in ["bands", "ndvi", "eobs", "dem"]:
+        np.testing.assert_array_equal(getattr(a, name).count, getattr(b, name).count)
+        np.testing.assert_allclose(getattr(a, name).mean, getattr(b, name).mean)
+        np.testing.assert_allclose(getattr(a, name).m2, getattr(b, name).m2)
+    for name in ["band_histogram", "ndvi_histogram", "eobs_histogram"]:
+        np.testing.assert_array_equal(getattr(a, name).counts, getattr(b, name).counts)
+    np.testing.assert_allclose(a.climatology("32UMC")[0], b.climatology("32UMC")[0])
+
+
+def test_incremental_update_equals_full_recompute(tmp_path):
+    split_dir = tmp_path/"train"
+    for i in range(3):
+        write_cube(split_dir, i)
+    stats.compute_stats(split_dir, chunksize = 2)
+    assert (tmp_path/"train_STATS.npz").is_file()
+
+    for i in range(3, 5):
+        write_cube(split_dir, i)
+    incremental = stats.compute_stats(split_dir, chunksize = 2)
+    full = stats.compute_stats(split_dir, stats_file = tmp_path/"full.npz", chunksize = 2, overwrite = True)
+
+    assert len(incremental.manifest) == 5
+    assert_stats_equal(incremental, full)
+    assert_stats_equal(stats.SplitStats.load(tmp_path/"train_STATS.npz"), full)
@@ -0,0 +1,72 @@
+"""Chunked store of a split and cloud masks.
+"""
+import numpy as np
+import pytest
+
+from earthnet import store
+
+
+def test_cube_mask_only_zero_is_valid():
+    hrd = np.zeros((2, 3, 5, 4))
+    hrd[0, 0, -1] = [0, 1, np.nan, 0.5]
+
+    mask = store.cube_mask(hrd)
+
+    assert mask.dtype == np.bool_ and mask.shape == (2, 3, 4)
+    np.testing.assert_array_equal(mask[0, 0], [True, False, False, False])
+    assert mask[1:].all() and mask[:, 1:].all()
+
+
+def write_split(root, n: int = 3, t: int = 4, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    cubes = {}
+    for i in range(n):
+        cubename = f"32UMC_2018-01-28_2018-11-23_{1081 + i}_1209_2617_2745_22_102_48_128"
+        cubes[cubename] = {"highresdynamic": rng.random((6, 6, 5, t)).astype(np.float32), "highresstatic": rng.random((6, 6, 1)).astype(np.float32), "mesodynamic": rng.random((2, 2, 5, 3 * t)).astype(np.float32), "mesostatic": rng.random((2, 2, 1)).astype(np.float32)}
+        (root/"32UMC").mkdir(parents = True, exist_ok = True)
+        np.savez_compressed(root/"32UMC"/f"{cubename}.npz", **cubes[cubename])
+    return cubes
+
+
+def test_store_round_trip(tmp_path):
+    cubes = write_split(tmp_path/"split")
+    assert store.convert_to_store(tmp_path/"split", tmp_path/"split.zarr") == []
+
+    cubestore = store.open_store(tmp_path/"split.zarr")
+    assert cubestore.cubenames == sorted(cubes)
+    for path in store.store_paths(tmp_path/"split.zarr"):
+        cube = store.load_cube(path)
+        assert set(cube) == set(store.VARIABLES)
+        for variable, data in cubes[store.cubename_of(path)].items():
+            np.testing.assert_array_equal(cube[variable], data)
+
+    cubename = sorted(cubes)[1]
+    batch = cubestore.read("highresdynamic", [cubename, 0], time = slice(1, 3))
+    np.testing.assert_array_equal(batch[0], cubes[cubename]["highresdynamic"][..., 1:3])
+
+
+def test_store_reads_variables_lazily_and_fails_on_missing_chunks(tmp_path):
+    cubes = write_split(tmp_path/"split")
+    store.convert_to_store(tmp_path/"split", tmp_path/"split.zarr")
+    for chunk in (tmp_path/"split.zarr"/"mesodynamic").glob("1.*"):
+        chunk.unlink()
+
+    cubename = sorted(cubes)[1]
+    cube = store.load_cube(tmp_path/"split.zarr"/f"{cubename}.npz")
+    np.testing.assert_array_equal(cube["highresdynamic"], cubes[cubename]["highresdynamic"])
+    with pytest.raises(FileNotFoundError):
+        cube["mesodynamic"]
+
+
+def test_store_leaves_out_failed_cubes(tmp_path):
+    cubes = write_split(tmp_path/"split")
+    broken = sorted(cubes)[1]
+    (tmp_path/"split"/"32UMC"/f"{broken}.npz").write_bytes(b"truncated")
+
+    failed = store.convert_to_store(tmp_path/"split", tmp_path/"split.zarr")
+
+    assert len(failed) == 1 and broken in failed[0][0]
+    cubestore = store.open_store(tmp_path/"split.zarr")
+    assert cubestore.cubenames == [cubename for cubename in sorted(cubes) if cubename != broken] and cubestore.shape("highresdynamic")[0] == 2
+    for cubename in cubestore.cubenames:
+        np.testing.assert_array_equal(cubestore.load(cubename)["mesodynamic"], cubes[cubename]["mesodynamic"])
@@ -0,0 +1,134 @@
+"""Fault-isolated worker pools.
+"""
+import os
+import time
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from earthnet import workers
+
+
+def crash_on_three(task: int) -> int:
+    if task == 3:
+        os._exit(1)
+    time.sleep(0.05)
+    return task * 2
+
+
+def sleep_and_return(task: int) -> int:
+    time.sleep(1)
+    return task
+
+
+def hang_in_python_or_native_code(task: int) -> int:
+    if task == 2:
+        time.sleep(30)
+    if task == 4:
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        time.sleep(30)
+    return task
+
+
+def allocate(size: int) -> int:
+    return int(np.ones(size, dtype = np.uint8).sum())
+
+
+def test_robust_imap_reports_crashing_task_only():
+    results = {task: (ok, result) for task, ok, result in workers.robust_imap(crash_on_three, range(12), n_workers = 3, max_retries = 1)}
+
+    assert sorted(results) == list(range(12))
+    assert results.pop(3) == (False, "Worker crashed 2 times.")
+    assert results == {task: (True, task * 2) for task in results}
+
+
+def test_robust_imap_times_out_hanging_tasks(monkeypatch):
+    monkeypatch.setattr(workers, "TIMEOUT_GRACE", 0.5)
+    start = time.monotonic()
+
+    results = {task: (ok, result) for task, ok, result in workers.robust_imap(hang_in_python_or_native_code, range(8), n_workers = 2, timeout = 1)}
+
+    assert time.monotonic() - start < 10
+    assert results.pop(2) == (False, "TaskTimeoutError: Task exceeded time limit of 1 seconds.")
+    assert results.pop(4) == (False, "TaskTimeoutError: Task exceeded time limit of 1 seconds and was killed.")
+    assert results == {task: (True, task) for task in results} and len(results) == 6
+
+
+def test_isolated_suspects_run_in_parallel():
+    guarded = workers.GuardedTask(sleep_and_return)
+    start = time.monotonic()
+
+    results = list(workers._isolated_imap(guarded, deque(range(4)), 4, {}))
+
+    assert sorted(results) == [(task, True, task) for task in range(4)]
+    assert time.monotonic() - start < 3
+
+
+def test_parse_memory():
+    assert workers.parse_memory("48GB") == 48 * 1000**3
+    assert workers.parse_memory(" 1.5 gib ") == int(1.5 * 2**30)
+    assert workers.parse_memory("512MiB") == 512 * 2**20
+    assert workers.parse_memory(1024) == 1024
+    with pytest.raises(AssertionError):
+        workers.parse_memory("12 apples")
+
+
+def test_memory_budget_sizes_the_pool(monkeypatch):
+    monkeypatch.setattr(workers, "tree_memory", lambda pid = None: 2 * 2**30)
+    budget = workers.MemoryBudget("10GiB", task_memory = 1.5 * 2**30, worker_memory = 0.5 * 2**30)
+
+    assert budget.n_workers(64) == 4 and budget.n_workers(2) == 2
+    assert budget.prefetch(4) == 5 and budget.prefetch(2) == 4
+    assert not budget.exceeded()
+    monkeypatch.setattr(workers, "tree_memory", lambda pid = None: 9 * 2**30)
+    assert budget.exceeded()
+    with pytest.warns(UserWarning):
+        assert budget.n_workers(64) == 1
+
+
+def test_memory_budget_calibration():
+    budget = workers.MemoryBudget.calibrate("8GB", allocate, 200 * 2**20)
+    assert 150 * 2**20 < budget.task_memory < 400 * 2**20
+
+
+class CountingPool(ThreadPoolExecutor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.running = self.max_running = 0
+
+    def submit(self, func, task):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        return super().submit(self.run, func, task)
+
+    def run(self, func, task):
+        result = func(task)
+        with self.lock:
+            self.running -= 1
+        return result
+
+
+class FullBudget:
+    def exceeded(self) -> bool:
+        return True
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_bounded_map_holds_back_submission(ordered):
+    def square(x):
+        time.sleep(0.001 * (x % 3))
+        return x * x
+
+    with CountingPool(max_workers = 4) as pool:
+        results = list(workers.bounded_map(pool, square, range(40), max_pending = 3, ordered = ordered))
+    assert (results if ordered else sorted(results)) == [x * x for x in range(40)] and pool.max_running <= 3
+
+    with CountingPool(max_workers = 4) as pool:
+        results = list(workers.bounded_map(pool, square, range(20), max_pending = 8, budget = FullBudget(), ordered = ordered))
+    assert sorted(results) == [x * x for x in range(20)] and pool.max_running == 1